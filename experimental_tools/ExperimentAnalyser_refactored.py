@@ -3,19 +3,21 @@
 import argparse
 from i_grip import Scene_refactored_multi as sc
 import cv2
+import numpy as np
 import pandas as pd
 import time
 
 class ExperimentAnalyser:
-    def __init__(self, device_id, device_data, name = None, display_replay = True, resolution=(1280,720), fps=60.0) -> None:
+    def __init__(self, device_id, device_data, name = None, display_replay = True, resolution=(1280,720), fps=60.0, headless = False) -> None:
 
-        
-        self.display_replay = display_replay
+        # headless analyses run without viewer nor video, as fast as the targets checks allow
+        self.headless = headless
+        self.display_replay = display_replay and not headless
         if name is None:
             self.name = f'ExperimentAnaliser'
         else:
             self.name = name
-        self.scene = sc.AnalysisScene( device_data, name = f'{self.name}_scene', fps = fps)
+        self.scene = sc.AnalysisScene( device_data, name = f'{self.name}_scene', fps = fps, draw_mesh = not headless)
         self.device_id = device_id
     
     def get_device_id(self):
@@ -24,6 +26,8 @@ class ExperimentAnalyser:
     def analyse(self, hands_label, obj_labels, all_trajectories:pd, name = None, video_path = None):
         print(f'all_trajectories: {all_trajectories}')
         self.scene.reset()
+        if self.headless:
+            video_path = None
         if video_path is not None:
             cap = cv2.VideoCapture(video_path)
             
@@ -79,32 +83,24 @@ class ExperimentAnalyser:
             
         # TODO : gérer les NaN dans les trajectoires
             # break
+        # a hand or an object enters the scene at the first row of its trajectory without NaN
+        hands_first_rows = self.get_first_valid_rows(hands)
+        objects_first_rows = self.get_first_valid_rows(objects)
+        timestamps = all_trajectories['Timestamps'].to_numpy()
         print('START')
         print(f'Number of frames: {len(all_trajectories)}')
-        for i, row in all_trajectories.iterrows():
-            hands_labels_to_remove = []
-            for hand_lab, traj in hands.items():
-                #  check if there is a NaN in the ith row of the trajectory
-                if not traj.iloc[i].isnull().values.any():
-                    # remove the NaN from the trajectory
-                    traj = traj.dropna()
-                    self.scene.new_hand(hand_lab, traj)
-                    hands_labels_to_remove.append(hand_lab)
-                    
-            for hand_lab in hands_labels_to_remove:
-                del hands[hand_lab]
-            
-            objects_labels_to_remove = []
-            for obj_lab, traj in objects.items():
-                if not traj.iloc[i].isnull().values.any():
-                    traj = traj.dropna()
-                    self.scene.new_object(obj_lab, traj, dataset='ycbv')
-                    objects_labels_to_remove.append(obj_lab)
+        t = time.time()
+        for i, timestamp in enumerate(timestamps):
+            for hand_lab in hands_first_rows.get(i, []):
+                # remove the NaN from the trajectory
+                self.scene.new_hand(hand_lab, hands[hand_lab].dropna())
+            for obj_lab in objects_first_rows.get(i, []):
+                self.scene.new_object(obj_lab, objects[obj_lab].dropna(), dataset='ycbv')
             
-            for obj_lab in objects_labels_to_remove:
-                del objects[obj_lab]
-            
-            self.scene.next_timestamp(row['Timestamps'])
+            # the recorded timestamps are the clock of the targets checks
+            self.scene.next_timestamp(timestamp)
+            if self.headless:
+                continue
             # self.scene.draw(cv_window_name)
             print('NEXT')
             if video_path is not None:
@@ -116,8 +112,19 @@ class ExperimentAnalyser:
                 cv2.waitKey(1)
             # sleep 30ms
             time.sleep(0.05)
+        if len(timestamps) > 0:
+            print(f'Analysed {len(timestamps)} frames in {time.time()-t:.2f} s, trial duration {timestamps[-1]-timestamps[0]:.2f} s')
         target_data = self.scene.get_target_data()
         return target_data
+    
+    def get_first_valid_rows(self, trajectories):
+        '''Returns a dict row index -> labels of the trajectories whose first row without NaN is this row'''
+        first_rows = {}
+        for label, traj in trajectories.items():
+            valid = ~traj.isnull().to_numpy().any(axis=1)
+            if valid.any():
+                first_rows.setdefault(int(np.argmax(valid)), []).append(label)
+        return first_rows
         
     def stop(self):
         print("Stopping scene...")
@@ -7,6 +7,7 @@ from tkinter import ttk
 import os
 import pandas as pd
 import threading
+from depth_utils import depth_recording_path, read_depth_recording, save_depth_dataframe, DEPTH_CHUNKS_SUFFIX
 
 class ExperimentPreProcessor:
     def __init__(self, name = None) -> None:
@@ -163,7 +164,7 @@ class ExperimentPreProcessor:
         recording_paths = [os.path.join(folder_path, video_file).split('_video.avi')[0] for video_file in self.video_files]
         
         self.video_paths = [path + '_video.avi' for path in recording_paths]
-        self.depthmap_paths = [path + '_depth_map.gzip' for path in recording_paths]
+        self.depthmap_paths = [depth_recording_path(path) for path in recording_paths]
         self.timestamps_paths = [path + '_timestamps.csv' for path in recording_paths]
         
         
@@ -266,19 +267,19 @@ class ExperimentPreProcessor:
         destination_paths = [os.path.join(self.destination_folder, video_file).split('_video.avi')[0] for video_file in self.video_files]
         
         stand_video_paths = [path + '_video_stand.avi' for path in destination_paths]
-        stand_depthmap_paths = [path + '_depth_map_stand.gzip' for path in destination_paths]
+        stand_depthmap_paths = [path + '_depth_map_stand' + DEPTH_CHUNKS_SUFFIX for path in destination_paths]
         stand_timestamps_paths = [path + '_timestamps_stand.gzip' for path in destination_paths]
         
         mov_video_paths = [path + '_video_movement.avi' for path in destination_paths]
-        mov_depthmap_paths = [path + '_depth_map_movement.gzip' for path in destination_paths]
+        mov_depthmap_paths = [path + '_depth_map_movement' + DEPTH_CHUNKS_SUFFIX for path in destination_paths]
         mov_timestamps_paths = [path + '_timestamps_movement.gzip' for path in destination_paths]
         
         contact_video_paths = [path + '_video_contact.avi' for path in destination_paths]
-        contact_depthmap_paths = [path + '_depth_map_contact.gzip' for path in destination_paths]
+        contact_depthmap_paths = [path + '_depth_map_contact' + DEPTH_CHUNKS_SUFFIX for path in destination_paths]
         contact_timestamps_paths = [path + '_timestamps_contact.gzip' for path in destination_paths]
         
         ret_video_paths = [path + '_video_return.avi' for path in destination_paths]
-        ret_depthmap_paths = [path + '_depth_map_return.gzip' for path in destination_paths]
+        ret_depthmap_paths = [path + '_depth_map_return' + DEPTH_CHUNKS_SUFFIX for path in destination_paths]
         ret_timestamps_paths = [path + '_timestamps_return.gzip' for path in destination_paths]
         print("begin video saving")
         for id, v_path in enumerate(video_paths):
@@ -316,27 +317,27 @@ class ExperimentPreProcessor:
             print(f'video {id} saved')
         print("begin depthmap saving")
         for id, d_path in enumerate(depthmap_paths):
-            df = pd.read_pickle(d_path, compression='gzip')
+            df = read_depth_recording(d_path)
             
             if start >0:
                 df_stand = df[:start]
                 df_stand.loc[:, 'Timestamps'] = df_stand['Timestamps'] - df_stand['Timestamps'].iloc[0]
-                df_stand.to_pickle(stand_depthmap_paths[id], compression='gzip')
+                save_depth_dataframe(stand_depthmap_paths[id], df_stand)
             else:
                 df_stand = pd.DataFrame(columns=df.columns)
             
             df_mov = df[start:end]
             df_mov.loc[:, 'Timestamps'] = df_mov['Timestamps'] - df_mov['Timestamps'].iloc[0]
-            df_mov.to_pickle(mov_depthmap_paths[id], compression='gzip')
+            save_depth_dataframe(mov_depthmap_paths[id], df_mov)
             
             df_con = df[end:return_mov_start]
             df_con.loc[:, 'Timestamps'] = df_con['Timestamps'] - df_con['Timestamps'].iloc[0]
-            df_con.to_pickle(contact_depthmap_paths[id], compression='gzip')
+            save_depth_dataframe(contact_depthmap_paths[id], df_con)
             
             if return_mov_start < nb_frames-1:
                 df_ret = df[return_mov_start:]
                 df_ret.loc[:, 'Timestamps'] = df_ret['Timestamps'] - df_ret['Timestamps'].iloc[0]
-                df_ret.to_pickle(ret_depthmap_paths[id], compression='gzip')
+                save_depth_dataframe(ret_depthmap_paths[id], df_ret)
             else:
                 df_ret = pd.DataFrame(columns=df.columns)
             
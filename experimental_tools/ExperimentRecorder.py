@@ -8,6 +8,8 @@ import numpy as np
 import time
 import pandas as pd
 import os
+from depth_utils import DepthChunkWriter, DEPTH_CHUNKS_SUFFIX
+from video_utils import VideoWriterThread
 
 class ExperimentRecorder:
     def __init__(self, main_path, device_id = None, resolution=(1280,720), fps=30.0):
@@ -26,9 +28,13 @@ class ExperimentRecorder:
         self.path_cam_np = os.path.join(self.main_path, f'cam_{self.cam_label}_{res[0]}_{res[1]}_data.npz')
         if not os.path.exists(self.path_cam_np):
             np.savez(self.path_cam_np, **self.device_data)
-        self.depth_map_series = []
+        self.depth_writer = None
+        self.video_writer = None
         self.time_series = []
+        self.nb_dropped_frames = 0
         self.recording = False
+        # set by the capture thread once the writers of the recording have received their last frame
+        self.recording_ended = threading.Event()
         print(f'Recorder with {device_id} built.')
         self.img = None
         obj_path = '.YCBV_test_pictures/javel.png'
@@ -56,7 +62,10 @@ class ExperimentRecorder:
 
             if self.new_rec:
                 self.new_rec = False
-                recorder = cv2.VideoWriter(self.path_vid, self.fourcc, self.fps, self.device_data['resolution'])
+                # frames are encoded on their own thread, so that encoding never delays the acquisition
+                self.video_writer = VideoWriterThread(self.path_vid, self.fourcc, self.fps, self.device_data['resolution'])
+                # depth maps are compressed and written to disk while recording
+                self.depth_writer = DepthChunkWriter(self.path_depth)
                 self.recording=True
                 
 
@@ -65,13 +74,25 @@ class ExperimentRecorder:
                 self.img[:self.obj_img.shape[0], :self.obj_img.shape[1]] = self.obj_img
             if self.recording:
                 t = pd.Timestamp.now()
-                self.time_series.append(t)
-                self.depth_map_series.append(map)
-                recorder.write(self.img)
+                # a frame dropped by one of the writers is dropped by both and not timestamped,
+                # so that video frames, depth maps and timestamps stay paired
+                if self.depth_writer.can_write() and self.video_writer.write(self.img):
+                    self.depth_writer.write(map, t.timestamp())
+                    self.time_series.append(t)
+                else:
+                    self.nb_dropped_frames += 1
                 if self.end_rec:
                     self.end_rec = False
-                    recorder.release()
+                    self.video_writer.finish()
+                    self.depth_writer.finish()
                     self.recording = False
+                    self.recording_ended.set()
+        if self.recording:
+            self.video_writer.finish()
+            self.depth_writer.finish()
+            self.recording = False
+        # a recording stopped after the end of the acquisition has nothing more to wait for
+        self.recording_ended.set()
     
     def save_data_task(self):
         #recorder = cv2.VideoWriter(self.path_vid, self.fourcc, 30.0,(1280,720))
@@ -81,32 +102,39 @@ class ExperimentRecorder:
             print("No recording to save")
             return
         print(f"Start saving {self.current_path}")
-        path= self.path_gzip
+        # wait for the capture thread to end the recording on its next frame, the writers are then joined by close
+        self.recording_ended.wait()
+        path= self.path_depth
         path_timestamps = self.path_timestamps
-        dm_series = self.depth_map_series
         t_series= self.time_series
-        df = pd.DataFrame({'Depth_maps': dm_series,
-                           'Date': t_series})
+        depth_writer = self.depth_writer
+        video_writer = self.video_writer
+        df = pd.DataFrame({'Date': t_series})
         df['Timestamps']= (df['Date']-df['Date'][0]).dt.total_seconds()
         t = time.time()
-        df.to_pickle(path, compression='gzip')
-        print('gzip compress time', time.time()-t)
+        if depth_writer is not None:
+            # the recorded timestamps are the replay clock of the depth maps
+            depth_writer.close(df['Timestamps'].to_numpy())
+        print('depth maps flush time', time.time()-t)
+        if video_writer is not None:
+            video_writer.close()
         #extract timestamps into new dataframe
         new_df = pd.DataFrame()
         new_df['Timestamps'] = df['Timestamps']
         #save timestamps as csv
         new_df.to_pickle(path_timestamps, compression='gzip')
-        print(f"Finished saving {path}")
+        print(f"Finished saving {path}, {len(t_series)} frames recorded, {self.nb_dropped_frames} dropped")
 
 
     def new_record(self, name):
         print(f"Starting recording {self.device_id} with config {name}")
         self.current_recording = name
         self.time_series=[]
-        self.depth_map_series=[]
+        self.nb_dropped_frames = 0
+        self.recording_ended.clear()
         self.current_path= os.path.join(self.main_path, name)
         self.path_vid = os.path.join(self.current_path, f'{name}_cam_{self.cam_label}_video.avi')
-        self.path_gzip = os.path.join(self.current_path,f'{name}_cam_{self.cam_label}_depth_map.gzip')
+        self.path_depth = os.path.join(self.current_path,f'{name}_cam_{self.cam_label}_depth_map{DEPTH_CHUNKS_SUFFIX}')
         self.path_timestamps = os.path.join(self.current_path,f'{name}_cam_{self.cam_label}_timestamps.csv')
         #self.recorder = cv2.VideoWriter(self.path_vid, self.fourcc, 30.0,(1280,720))
         self.new_rec = True
@@ -116,10 +144,11 @@ class ExperimentRecorder:
         print(f"Starting recording {self.device_id} with config {name}")
         self.current_recording = name
         self.time_series=[]
-        self.depth_map_series=[]
+        self.nb_dropped_frames = 0
+        self.recording_ended.clear()
         self.current_path= os.path.join(self.main_path, name)
         self.path_vid = os.path.join(self.current_path, f'{name}_cam_{self.cam_label}_video.avi')
-        self.path_gzip = os.path.join(self.current_path,f'{name}_cam_{self.cam_label}_depth_map.gzip')
+        self.path_depth = os.path.join(self.current_path,f'{name}_cam_{self.cam_label}_depth_map{DEPTH_CHUNKS_SUFFIX}')
         self.path_timestamps = os.path.join(self.current_path,f'{name}_cam_{self.cam_label}_timestamps.csv')
         self.new_rec = True
     
@@ -2,6 +2,8 @@
 
 import argparse
 import cv2
+import queue
+import threading
 import time 
 import os
 from i_grip import RgbdCameras as rgbd
@@ -9,9 +11,12 @@ from i_grip import Hands3DDetectors as hd
 from i_grip import Object2DDetectors as o2d
 from i_grip import ObjectPoseEstimators as ope
 from i_grip import Scene_refactored_multi as sc
+from i_grip.FramePreparers import FramePreparer
 
 class ExperimentReplayer:
-    def __init__(self, device_id, device_data, name = None, display_replay = True, resolution=(1280,720), fps=30.0) -> None:
+    def __init__(self, device_id, device_data, name = None, display_replay = True, resolution=(1280,720), fps=30.0, inference_options = None, headless = False) -> None:
+        '''In headless mode, nothing is displayed and the replay stages (decoding, hands, objects, scene) run as a pipeline,
+        each on its own thread, so that the replay goes as fast as its slowest stage'''
         os.environ['CUDA_VISIBLE_DEVICES'] = '0'
         self.device_id = device_id
         self.resolution = resolution
@@ -20,10 +25,12 @@ class ExperimentReplayer:
         self.fps = fps
         
         dataset = "ycbv"        
-        self.display_replay = display_replay
+        self.headless = headless
+        self.display_replay = display_replay and not headless
         
         self.rgbd_cam = rgbd.RgbdCamera(replay=True, cam_params= device_data, resolution=self.resolution, fps=fps)
         cam_data = self.rgbd_cam.get_device_data()
+        self.frame_preparer = FramePreparer.from_camera(self.rgbd_cam)
         print(f'cam_data: {cam_data}')
         cam_data_2 = {}
         for key in cam_data:
@@ -34,11 +41,13 @@ class ExperimentReplayer:
                                             hd.Hands3DDetector.VIDEO_FILE_MODE,
                                             use_gpu=True)
         self.object_detector = o2d.get_object_detector(dataset,
-                                                       cam_data_2)
+                                                       cam_data_2,
+                                                       inference_options=inference_options)
         self.object_pose_estimator = ope.get_pose_estimator(dataset,
                                                             cam_data_2,
                                                             use_tracking = True,
-                                                            fuse_detections=False)
+                                                            fuse_detections=False,
+                                                            inference_options=inference_options)
         print('Waiting for the camera to start...')
         time.sleep(4)
         print('Camera started')
@@ -46,7 +55,8 @@ class ExperimentReplayer:
             self.name = f'ExperimentReplayer_{dataset}'
         else:
             self.name = name
-        self.scene = sc.ReplayScene( cam_data_2, name = f'{self.name}_scene', dataset = dataset)
+        # headless replays build neither the mesh scene nor its viewer
+        self.scene = sc.ReplayScene( cam_data_2, name = f'{self.name}_scene', dataset = dataset, draw_mesh = not headless)
         # self.scene = sc.ReplayScene( device_data, name = f'{self.name}_scene')
         self.rgbd_cam.start()
     
@@ -65,8 +75,10 @@ class ExperimentReplayer:
         else:
             cv_window_name = f'{self.name} : Replaying'
         self.detect = True
-        failed_detections_count = 0
-        split_image = False
+        self.failed_detections_count = 0
+        self.split_image = False
+        if self.headless:
+            return self.replay_pipelined()
         print(f'all timestamps: {self.rgbd_cam.get_timestamps()}')
         for timestamp in self.rgbd_cam.get_timestamps():
             success, img, depth_map = self.rgbd_cam.next_frame()
@@ -82,11 +94,10 @@ class ExperimentReplayer:
             # img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
             # depth_map = cv2.rotate(depth_map, cv2.ROTATE_90_COUNTERCLOCKWISE)
             render_img = img.copy()
-            to_process_img = img.copy()
             fac = 2
             
-            to_process_img = cv2.cvtColor(to_process_img, cv2.COLOR_RGB2BGR)
-            # cv2.cvtColor(to_process_img, cv2.COLOR_RGB2BGR, to_process_img)
+            prepared_frames = self.frame_preparer.prepare(img)
+            to_process_img = prepared_frames['hands']
             
             # smol_to_process_img = cv2.resize(to_process_img, (int(self.resolution[0]/fac), int(self.resolution[1]/fac)))
             
@@ -106,73 +117,8 @@ class ExperimentReplayer:
             #     hand.label = hand.label + '_smol'
             self.scene.update_hands(hands, timestamp)
 
-            # Object detection
-            if self.detect:
-                if not split_image:
-                    self.object_detections = self.object_detector.detect(to_process_img)
-                else:
-                    half = int(to_process_img.shape[1]/2)
-                    print(f'to_process_img shape: {to_process_img.shape}')
-                    img1 = to_process_img[:, :int(to_process_img.shape[1]/2)]
-                    img2 = to_process_img[:, int(to_process_img.shape[1]/2):]    
-                    print(f'img1 shape: {img1.shape}')
-                    print(f'img2 shape: {img2.shape}')
-                    object_detections1 = self.object_detector.detect(img1)
-                    object_detections2 = self.object_detector.detect(img2)
-                    print(f'object_detections1: {object_detections1}')
-                    print(f'object_detections2: {object_detections2}')
-                    bbox1 = object_detections1.bboxes.cpu()
-                    bbox2 = object_detections2.bboxes.cpu()
-                    print(f'bbox1: {bbox1}')
-                    print(f'bbox2: {bbox2}')
-                    # add half to x coordinate of bbox2
-                    bbox2[:, 0] += half
-                    bbox2[:, 2] += half
-                    print(f'bbox2: {bbox2}')
-                    united_detection = object_detections1
-                    infos_u = united_detection.infos
-                    bbox_u = united_detection.bboxes.cpu()
-                    infos_2 = object_detections2.infos
-                    i=0
-                    for row in infos_u.iterrows():
-                        if row[1]['label'] not in infos_2['label'].values:
-                            infos_u.loc[len(infos_u)] = row[1]
-                        else:
-                            bbox_u[i, 0] = min(bbox_u[i, 0], bbox2[i, 0])
-                            bbox_u[i, 2] = min(bbox_u[i, 2], bbox2[i, 2])
-                            bbox_u[i, 1] = max(bbox_u[i, 1], bbox2[i, 1])
-                            bbox_u[i, 3] = max(bbox_u[i, 3], bbox2[i, 3])
-                    united_detection.bboxes = bbox_u.cuda().float()
-                    self.object_detections = united_detection
-                    
-                            
-                    
-                
-                if self.object_detections is not None:
-                    self.detect = False
-                    failed_detections_count += 1
-                if failed_detections_count > 3:
-                    split_image = True
-                print('detect')
-            else:
-                self.object_detections = None
-
-            # Object pose estimation
-            self.objects_pose = self.object_pose_estimator.estimate(to_process_img, detections = self.object_detections)
-            
-            # check if all objects are detected
-            expected_objects = sc.RigidObject.LABEL_EXPE_NAMES
-            for label in expected_objects:
-                if label not in self.objects_pose:
-                    self.detect = True
-                    
-            # remove unexpected objects
-            keys_to_remove = []
-            for label in self.objects_pose:
-                if label not in expected_objects:
-                    keys_to_remove.append(label)
-            for key in keys_to_remove:
-                del self.objects_pose[key]
+            # Object detection and pose estimation
+            self.objects_pose = self.detect_and_estimate_objects(prepared_frames, hands, (img.shape[1], img.shape[0]), timestamp)
                 
             self.scene.update_objects(self.objects_pose, timestamp)
             if self.display_replay:
@@ -190,6 +136,137 @@ class ExperimentReplayer:
         
         return hands_data, objects_data
         
+    def detect_and_estimate_objects(self, prepared_frames, hands, resolution, timestamp):
+        '''Runs the object detection when needed (some expected object is missing) and the pose estimation on a frame.
+        Returns the poses of the expected objects'''
+        to_process_img = prepared_frames['hands']
+        # Object detection
+        if self.detect:
+            if not self.split_image:
+                self.object_detections = self.object_detector.detect(prepared_frames['object_detection'])
+            else:
+                half = int(to_process_img.shape[1]/2)
+                print(f'to_process_img shape: {to_process_img.shape}')
+                img1 = to_process_img[:, :int(to_process_img.shape[1]/2)]
+                img2 = to_process_img[:, int(to_process_img.shape[1]/2):]    
+                print(f'img1 shape: {img1.shape}')
+                print(f'img2 shape: {img2.shape}')
+                object_detections1 = self.object_detector.detect(img1)
+                object_detections2 = self.object_detector.detect(img2)
+                print(f'object_detections1: {object_detections1}')
+                print(f'object_detections2: {object_detections2}')
+                # detections are inference tensors : copies are edited, on the device of the detector
+                bbox1 = object_detections1.bboxes.clone()
+                bbox2 = object_detections2.bboxes.clone()
+                print(f'bbox1: {bbox1}')
+                print(f'bbox2: {bbox2}')
+                # add half to x coordinate of bbox2
+                bbox2[:, 0] += half
+                bbox2[:, 2] += half
+                print(f'bbox2: {bbox2}')
+                united_detection = object_detections1
+                infos_u = united_detection.infos
+                bbox_u = united_detection.bboxes.clone()
+                infos_2 = object_detections2.infos
+                i=0
+                for row in infos_u.iterrows():
+                    if row[1]['label'] not in infos_2['label'].values:
+                        infos_u.loc[len(infos_u)] = row[1]
+                    else:
+                        bbox_u[i, 0] = min(bbox_u[i, 0], bbox2[i, 0])
+                        bbox_u[i, 2] = min(bbox_u[i, 2], bbox2[i, 2])
+                        bbox_u[i, 1] = max(bbox_u[i, 1], bbox2[i, 1])
+                        bbox_u[i, 3] = max(bbox_u[i, 3], bbox2[i, 3])
+                united_detection.bboxes = bbox_u.to(self.object_detector.device).float()
+                self.object_detections = united_detection
+                
+                        
+                
+            
+            if self.object_detections is not None:
+                self.detect = False
+                self.failed_detections_count += 1
+            if self.failed_detections_count > 3:
+                self.split_image = True
+            print('detect')
+        else:
+            self.object_detections = None
+
+        # Object pose estimation
+        hands_boxes = [hand.get_bbox(resolution) for hand in hands]
+        self.objects_pose = self.object_pose_estimator.estimate(prepared_frames['object_estimation'], detections = self.object_detections,
+                                                                occluders = hands_boxes, timestamp = timestamp)
+        
+        # check if all objects are detected
+        expected_objects = sc.RigidObject.LABEL_EXPE_NAMES
+        for label in expected_objects:
+            if label not in self.objects_pose:
+                self.detect = True
+                
+        # remove unexpected objects
+        keys_to_remove = []
+        for label in self.objects_pose:
+            if label not in expected_objects:
+                keys_to_remove.append(label)
+        for key in keys_to_remove:
+            del self.objects_pose[key]
+        return self.objects_pose
+    
+    def replay_pipelined(self):
+        '''Headless replay : frames flow in order through decoding, hands detection, objects detection and estimation,
+        and scene update, each stage running on its own thread and handing frames to the next one through a bounded queue'''
+        t_start = time.perf_counter()
+        stages = [ReplayStage('decoding', self.decode_frames_stage),
+                  ReplayStage('hands', self.hands_stage),
+                  ReplayStage('objects', self.objects_stage),
+                  ReplayStage('scene', self.scene_stage)]
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.output = next_stage.input
+        for stage in stages:
+            stage.start()
+        for timestamp in self.rgbd_cam.get_timestamps():
+            if any(stage.error is not None for stage in stages):
+                break
+            stages[0].input.put(dict(timestamp=timestamp))
+        stages[0].input.put(None)
+        for stage in stages:
+            stage.join()
+        for stage in stages:
+            if stage.error is not None:
+                raise RuntimeError(f'Headless replay failed in stage {stage.name}') from stage.error
+        wall_time = time.perf_counter()-t_start
+        print(f'Headless replay : {stages[-1].nb_frames} frames in {wall_time:.2f} s ({stages[-1].nb_frames/max(wall_time, 1e-9):.1f} fps)')
+        for stage in stages:
+            stage.report()
+        self.scene.pause_scene_display()
+        hands_data = self.scene.get_hands_data()
+        objects_data = self.scene.get_objects_data()
+        return hands_data, objects_data
+
+    def decode_frames_stage(self, frame):
+        success, img, depth_map = self.rgbd_cam.next_frame()
+        if not success or img is None:
+            return None
+        if img.shape[0] >= img.shape[1]:
+            img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        frame['prepared_frames'] = self.frame_preparer.prepare(img)
+        frame['depth_map'] = depth_map
+        frame['resolution'] = (img.shape[1], img.shape[0])
+        return frame
+
+    def hands_stage(self, frame):
+        frame['hands'] = self.hand_detector.get_hands(frame['prepared_frames']['hands'], frame['depth_map'], frame['timestamp'])
+        return frame
+
+    def objects_stage(self, frame):
+        frame['objects'] = self.detect_and_estimate_objects(frame['prepared_frames'], frame['hands'], frame['resolution'], frame['timestamp'])
+        return frame
+
+    def scene_stage(self, frame):
+        self.scene.update_hands(frame['hands'], frame['timestamp'])
+        self.scene.update_objects(frame['objects'], frame['timestamp'])
+        return None
+    
     def stop(self):
         print("Stopping experiment replayer...")
         print("Stopping hand detector...")
@@ -203,7 +280,57 @@ class ExperimentReplayer:
         print("Stopped scene...")
         
         cv2.destroyAllWindows()
-        
+
+
+class ReplayStage:
+    def __init__(self, name, process, queue_size = 4) -> None:
+        '''Stage of the headless replay pipeline : a thread applying process to the frames of its input queue, in order, 
+        and passing the results to the output queue (set to the input of the next stage). 
+        process may return None to drop a frame. A None frame ends the stage and is passed on.
+        If process raises, the error is kept in error, the next stages are ended and the input is drained until its None frame,
+        so that no stage stays blocked on a queue'''
+        self.name = name
+        self.process = process
+        self.input = queue.Queue(maxsize=queue_size)
+        self.output = None
+        self.nb_frames = 0
+        self.busy_time = 0.
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=f'replay_{name}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def run(self):
+        while True:
+            frame = self.input.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue
+            t = time.perf_counter()
+            try:
+                result = self.process(frame)
+            except Exception as e:
+                print(f'Replay stage {self.name} failed : {e}')
+                self.error = e
+                if self.output is not None:
+                    self.output.put(None)
+                continue
+            self.busy_time += time.perf_counter()-t
+            self.nb_frames += 1
+            if result is not None and self.output is not None:
+                self.output.put(result)
+        if self.error is None and self.output is not None:
+            self.output.put(None)
+
+    def report(self):
+        fps = self.nb_frames/self.busy_time if self.busy_time > 0 else float('inf')
+        print(f'  {self.name:>10} : {self.nb_frames} frames, {self.busy_time:.2f} s busy, {fps:.1f} fps, '
+              f'{1000*self.busy_time/max(self.nb_frames, 1):.1f} ms per frame')
 
         
 
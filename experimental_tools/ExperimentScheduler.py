@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import util
+
+import pandas as pd
+
+REPLAY = 'replay'
+ANALYSIS = 'analysis'
+PROCESSES = [REPLAY, ANALYSIS]
+
+DONE = 'done'
+FAILED = 'failed'
+
+_JOURNAL_SUFFIX = '_journal.jsonl'
+
+# state of a worker process : devices data, and replayers / analysers built once and reused for all its tasks
+_worker_devices_data = None
+_worker_processors = {}
+
+
+def journal_path(processing_path, process):
+    return os.path.join(processing_path, f'{process}{_JOURNAL_SUFFIX}')
+
+
+class ProcessingTask:
+    def __init__(self, process, pseudo, trial, device_id) -> None:
+        '''Processing of one trial of one participant with the data of one device, independent from all the other tasks.
+        Only the paths and the combination of the trial are sent to the worker, which rebuilds the trial'''
+        if process not in PROCESSES:
+            raise ValueError(f"Process {process} not supported. Supported processes are {PROCESSES}")
+        self.process = process
+        self.pseudo = pseudo
+        self.device_id = device_id
+        self.label = trial.label
+        self.participant_path = trial.participant_path
+        self.combination = trial.combination
+        self.participant_pre_processing_path = os.path.dirname(trial.pre_processing_path)
+        self.participant_replay_path = os.path.dirname(trial.replay_path)
+        self.participant_analysis_path = os.path.dirname(trial.analysis_path)
+        self.attempts = 0
+
+    @property
+    def key(self):
+        return f'{self.process}/{self.pseudo}/{self.label}/{self.device_id}'
+
+    def build_trial(self):
+        from Experiment_refactored import Trial
+        return Trial(self.label, self.participant_path, self.combination,
+                     participant_pre_processing_path=self.participant_pre_processing_path,
+                     participant_replay_path=self.participant_replay_path,
+                     participant_analysis_path=self.participant_analysis_path)
+
+
+def init_worker(devices_data, nb_threads):
+    '''Initializer of the worker processes : limits the threads of each worker so that the pool does not oversubscribe the cores'''
+    global _worker_devices_data
+    _worker_devices_data = devices_data
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(nb_threads)
+    import cv2
+    import torch
+    torch.set_num_threads(nb_threads)
+    cv2.setNumThreads(nb_threads)
+    # worker processes leave through os._exit, which skips atexit
+    util.Finalize(None, stop_worker_processors, exitpriority=10)
+
+
+def get_processor(process, device_id):
+    '''Returns the replayer or analyser of device_id of the current worker, building it (and loading its models) on first use'''
+    key = (process, device_id)
+    if key not in _worker_processors:
+        device_data = _worker_devices_data[device_id]
+        if process == REPLAY:
+            import ExperimentReplayer_refactored as erp
+            _worker_processors[key] = erp.ExperimentReplayer(device_id, device_data, headless=True)
+        else:
+            import ExperimentAnalyser_refactored as ea
+            _worker_processors[key] = ea.ExperimentAnalyser(device_id, device_data, headless=True)
+    return _worker_processors[key]
+
+
+def stop_processor(key):
+    processor = _worker_processors.pop(key, None)
+    if processor is not None:
+        try:
+            processor.stop()
+        except Exception as e:
+            print(f'Worker {os.getpid()} : could not stop {key} : {e}')
+
+
+def stop_worker_processors():
+    for key in list(_worker_processors.keys()):
+        stop_processor(key)
+
+
+def run_task(task):
+    '''Runs task in a worker process. Exceptions are returned rather than raised, with the traceback of the worker'''
+    t = time.perf_counter()
+    try:
+        processor = get_processor(task.process, task.device_id)
+        trial = task.build_trial()
+        if task.process == REPLAY:
+            meta_data = trial.replay(processor)
+        else:
+            meta_data = trial.analyse(processor)
+        return {'status': DONE, 'duration': time.perf_counter()-t, 'meta_data': meta_data, 'worker': os.getpid()}
+    except Exception:
+        # the processor may have been left mid-trial, the next task rebuilds it
+        stop_processor((task.process, task.device_id))
+        return {'status': FAILED, 'duration': time.perf_counter()-t, 'error': traceback.format_exc(), 'worker': os.getpid()}
+
+
+class ProgressJournal:
+    def __init__(self, path) -> None:
+        '''Append-only JSON lines record of the tasks run on a session, one line per attempt.
+        Tasks with a done entry are skipped when the processing is resumed'''
+        self.path = path
+        self.done = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of an interrupted run
+                        continue
+                    if entry.get('status') == DONE:
+                        self.done[entry['task']] = entry
+            print(f'Journal {self.path} : {len(self.done)} tasks already done')
+
+    def is_done(self, key):
+        return key in self.done
+
+    def write(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=str)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if entry['status'] == DONE:
+            self.done[entry['task']] = entry
+
+
+class ExperimentScheduler:
+    def __init__(self, devices_data, journal_path, nb_workers = None, max_retries = 2, overwrite = False) -> None:
+        '''Runs processing tasks on a pool of spawned worker processes.
+        Each worker keeps one replayer or analyser per device, so models are loaded once per worker and not once per trial.
+        Failed tasks are retried up to max_retries times, and every attempt is written to the journal at journal_path'''
+        if nb_workers is None or nb_workers <= 0:
+            nb_workers = os.cpu_count()
+        self.nb_workers = nb_workers
+        self.nb_threads = max(1, os.cpu_count()//self.nb_workers)
+        # np.load archives cannot be sent to the workers
+        self.devices_data = {device_id: {key: device_data[key] for key in device_data.keys()} for device_id, device_data in devices_data.items()}
+        self.max_retries = max_retries
+        self.overwrite = overwrite
+        self.journal = ProgressJournal(journal_path)
+        self.continue_processing = True
+        self.results = {}
+
+    def build_executor(self):
+        return ProcessPoolExecutor(max_workers=self.nb_workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_worker, initargs=(self.devices_data, self.nb_threads))
+
+    def run(self, tasks, on_task_done = None, on_idle = None):
+        '''Runs tasks and returns a dict task key -> (task, result) of the tasks done.
+        on_task_done(task, result) is called after each attempt, and on_idle() about every second while waiting, both in the calling thread'''
+        to_run = deque(task for task in tasks if self.overwrite or not self.journal.is_done(task.key))
+        print(f'Scheduling {len(to_run)} tasks on {self.nb_workers} workers ({self.nb_threads} threads each), {len(tasks)-len(to_run)} already done')
+        self.continue_processing = True
+        self.results = {}
+        self.nb_failed = 0
+        self.tasks_duration = 0
+        t = time.perf_counter()
+        executor = self.build_executor()
+        running = {}
+        try:
+            while to_run or running:
+                # a few tasks ahead per worker, so that retries and interruptions are taken into account quickly
+                while self.continue_processing and to_run and len(running) < 2*self.nb_workers:
+                    task = to_run.popleft()
+                    task.attempts += 1
+                    running[executor.submit(run_task, task)] = task
+                if not running:
+                    break
+                done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        broken = True
+                        result = {'status': FAILED, 'duration': None, 'error': 'worker process died', 'worker': None}
+                    self.record(task, result, on_task_done)
+                    if result['status'] == FAILED and task.attempts <= self.max_retries:
+                        to_run.append(task)
+                if broken:
+                    # all the tasks running on the pool are lost with it
+                    for future, task in running.items():
+                        self.record(task, {'status': FAILED, 'duration': None, 'error': 'worker pool broken', 'worker': None}, on_task_done)
+                        if task.attempts <= self.max_retries:
+                            to_run.append(task)
+                    running.clear()
+                    executor.shutdown(wait=False)
+                    executor = self.build_executor()
+                if on_idle is not None:
+                    on_idle()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.report(time.perf_counter()-t)
+        return self.results
+
+    def record(self, task, result, on_task_done = None):
+        entry = {'task': task.key,
+                 'process': task.process,
+                 'pseudo': task.pseudo,
+                 'trial': task.label,
+                 'device': task.device_id,
+                 'status': result['status'],
+                 'attempt': task.attempts,
+                 'duration': result['duration'],
+                 'worker': result['worker'],
+                 'date': pd.Timestamp.now().isoformat()}
+        if result['status'] == DONE:
+            entry['meta_data'] = result['meta_data']
+            self.results[task.key] = (task, result)
+            self.tasks_duration += result['duration']
+            print(f"Task {task.key} done in {result['duration']:.1f} s by worker {result['worker']}")
+        else:
+            entry['error'] = result['error']
+            self.nb_failed += 1
+            print(f"Task {task.key} failed (attempt {task.attempts}/{self.max_retries+1}) : \n{result['error']}")
+        self.journal.write(entry)
+        if on_task_done is not None:
+            on_task_done(task, result)
+
+    def report(self, wall_time):
+        print(f'{len(self.results)} tasks done, {self.nb_failed} failed attempts, in {wall_time:.1f} s')
+        if wall_time > 0 and self.tasks_duration > 0:
+            print(f'Tasks duration {self.tasks_duration:.1f} s, speed-up {self.tasks_duration/wall_time:.2f} on {self.nb_workers} workers')
+
+    def stop(self):
+        '''Running tasks are completed, the remaining ones are left for a later resume'''
+        print('Stopping scheduler after the running tasks...')
+        self.continue_processing = False
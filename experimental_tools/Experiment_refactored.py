@@ -12,6 +12,9 @@ import ExperimentRecorder as erc
 import ExperimentPreProcessor as epp
 import ExperimentReplayer_refactored as erp
 import ExperimentAnalyser_refactored as ea
+import ExperimentScheduler as es
+from depth_utils import DepthStore, DEPTH_CHUNKS_SUFFIX
+from data_utils import build_main_data, save_table, read_table, list_results, load_results_dataset
 import threading
 import cv2
 import pandas as pd
@@ -47,6 +50,8 @@ class Experiment:
         self.path = None       
         self.selected_session = None
         self.win = win 
+        # more than one worker processes the trials on a process pool
+        self.nb_workers = 1
         
     def set_path(self, path):
         path_exists = os.path.exists(path)
@@ -88,13 +93,22 @@ class Experiment:
     def select_participant(self, pseudo):
         return self.selected_session.select_participant(pseudo)
     
+    def set_nb_workers(self, nb_workers):
+        self.nb_workers = nb_workers
+    
     def process_selected_participants(self, process_labels):   
         if process_labels['Name'] == 'Replay':
-            self.selected_session.replay_selected_participants()
+            if self.nb_workers > 1:
+                self.selected_session.schedule_selected_participants(es.REPLAY, self.nb_workers)
+            else:
+                self.selected_session.replay_selected_participants()
         elif process_labels['Name'] == 'Pre-processing':
             self.selected_session.pre_process_selected_participants()
         elif process_labels['Name'] == 'Analysis':
-            self.selected_session.analyse_selected_participants()
+            if self.nb_workers > 1:
+                self.selected_session.schedule_selected_participants(es.ANALYSIS, self.nb_workers)
+            else:
+                self.selected_session.analyse_selected_participants()
         else:
             print(f"Process {process_labels['Name']} not supported")
             # def get_participants(self):
@@ -234,6 +248,7 @@ class Session:
         self.experiment_pre_processor = None
         self.experiment_replayer = None
         self.experiment_analyser = None
+        self.experiment_scheduler = None
     
     def build_progress_display(self):
         name = "Processing..."
@@ -507,14 +522,14 @@ class Session:
         self.save_processing_monitoring()
         self.experiment_pre_processor.stop()
         
-    def replay_selected_participants(self):    
+    def replay_selected_participants(self, headless = False):    
         self.fetch_participants_to_process()
         self.build_progress_display()
         
         for device_id, device_data in self.devices_data.items():
             print(f"Building experiment replayer for device {device_id} with device_data: resolution {device_data['resolution']}, matrix {device_data['matrix']}")
             self.current_device_id = device_id
-            self.experiment_replayer = erp.ExperimentReplayer(device_id, device_data)
+            self.experiment_replayer = erp.ExperimentReplayer(device_id, device_data, headless=headless)
             self.devices_progress_display.set_current(f"Processing device {device_id}")
             self.progress_window.update_idletasks()
             print("updating progress window")
@@ -545,14 +560,14 @@ class Session:
         # self.progress_window.destroy()
     
         
-    def analyse_selected_participants(self):
+    def analyse_selected_participants(self, headless = False):
         self.fetch_participants_to_process()
         self.build_progress_display()
         self.continue_processing = True
         for device_id, device_data in self.devices_data.items():
             print(f"Building experiment analyser for device {device_id} with device_data: resolution {device_data['resolution']}, matrix {device_data['matrix']}")
             self.current_device_id = device_id
-            self.experiment_analyser = ea.ExperimentAnalyser(device_id, device_data)
+            self.experiment_analyser = ea.ExperimentAnalyser(device_id, device_data, headless=headless)
             self.devices_progress_display.set_current(f"Processing device {device_id}")
             self.progress_window.update_idletasks()
             print("updating progress window")
@@ -581,9 +596,58 @@ class Session:
             print(f"Experiment analyser for device {device_id} stopped")
         print("All selected participants analysed")
         
+    def schedule_selected_participants(self, process, nb_workers = None):
+        '''Processes every (participant, trial, device) of the selected participants as an independent task on a process pool.
+        Progress is journaled in the processing folder, so that an interrupted processing resumes where it stopped'''
+        self.fetch_participants_to_process()
+        self.build_progress_display()
+        self.continue_processing = True
+        tasks = []
+        for device_id in self.devices_data.keys():
+            for participant in self.participants_to_process:
+                tasks += participant.get_processing_tasks(process, device_id)
+        date_column = 'Replay date' if process == es.REPLAY else 'Analysis date'
+        for participant in self.participants_to_process:
+            self.processing_monitoring_database.loc[self.processing_monitoring_database['Pseudo'] == participant.pseudo, date_column] = pd.Timestamp.now()
+        self.save_processing_monitoring()
+        
+        self.experiment_scheduler = es.ExperimentScheduler(self.devices_data, es.journal_path(self.processing_path, process), nb_workers=nb_workers)
+        self.devices_progress_display.set_current(f"Processing devices {list(self.devices_data.keys())}")
+        self.participants_progress_display.set_current(f"Processing participants {[participant.pseudo for participant in self.participants_to_process]}")
+        self.trials_progress_display.reset(len(tasks), "trials processed", f"{process} on {self.experiment_scheduler.nb_workers} workers")
+        
+        def on_task_done(task, result):
+            self.trials_progress_display.set_current(f"{task.key} {result['status']}")
+            if result['status'] == es.DONE:
+                self.trials_progress_display.increment()
+            self.progress_window.update()
+            
+        results = self.experiment_scheduler.run(tasks, on_task_done=on_task_done, on_idle=self.progress_window.update)
+        
+        if process == es.REPLAY:
+            for participant in self.participants_to_process:
+                participant.init_replay_data()
+                for task, result in results.values():
+                    if task.pseudo == participant.pseudo:
+                        participant.set_trial_meta_data(task.label, result['meta_data'])
+                participant.save_replay_data()
+        self.save_processing_monitoring()
+        self.experiment_scheduler = None
+        print(f"All selected participants processed ({process})")
+        
+    def load_replay_dataset(self, suffix = 'main', columns = None, pseudos = None, trials = None, devices = None):
+        '''Loads the replay results ending with suffix ('main', 'hand_traj', 'traj') of the session into a single dataframe'''
+        return load_results_dataset(self.replay_path, suffix, columns=columns, pseudos=pseudos, trials=trials, devices=devices)
+    
+    def load_analysis_dataset(self, suffix = 'target_data', columns = None, pseudos = None, trials = None, devices = None):
+        '''Loads the analysis results of the session into a single dataframe'''
+        return load_results_dataset(self.analysis_path, suffix, columns=columns, pseudos=pseudos, trials=trials, devices=devices)
+        
     def interrupt_processing(self):
         print("Interrupting pre-processing...")
         self.continue_processing = False
+        if self.experiment_scheduler is not None:
+            self.experiment_scheduler.stop()
         
     def is_data_available(self):
         return self.all_data_available
@@ -1131,9 +1195,7 @@ class Participant:
             trials_check.to_csv(check_path, index=False)
             print(f'saved to {check_path}')
                 
-    def replay(self, experiment_replayer):
-        
-        print( f"Replaying pseudo '{self.pseudo}'")
+    def init_replay_data(self):
         # create a dict to store 'Trial_duration' and 'Trial_data_extration_duration' for each trial
         trials_meta_data = ['Found', 'Trial_duration', 'Trial_data_extration_duration']
         # create an empty dataframe to store the trials_meta_data, same row index as self.combinations
@@ -1141,6 +1203,29 @@ class Participant:
         trials_meta_data_df['Found'] = False
         # concatenate the two dataframes into a dataframe self.data
         self.data = pd.concat([self.combinations_data, trials_meta_data_df], axis=1)
+    
+    def set_trial_meta_data(self, trial_label, trial_meta_data):
+        # put True in the 'Found' column of the self.data dataframe
+        self.data.loc[self.data['Trial Folder'] == trial_label, 'Found'] = True
+        for key in trial_meta_data.keys():
+            self.data.loc[self.data['Trial Folder'] == trial_label, key] = trial_meta_data[key]
+    
+    def save_replay_data(self):
+        #write the participant data to a csv file
+        self.data.to_csv(self.data_csv_path, index=False)
+    
+    def get_processing_tasks(self, process, device_id):
+        '''Returns the tasks of the trials of the participant that remain to be processed for device_id, without asking'''
+        if process == es.REPLAY:
+            trials = [trial for trial in self.replayable_trials if not trial.was_replayed(device_ID=device_id)]
+        else:
+            trials = [trial for trial in self.analyzable_trials if not trial.was_analysed(device_ID=device_id)]
+        return [es.ProcessingTask(process, self.pseudo, trial, device_id) for trial in trials]
+                
+    def replay(self, experiment_replayer):
+        
+        print( f"Replaying pseudo '{self.pseudo}'")
+        self.init_replay_data()
         #loop over trials
         global_answer = None
         replayer_ID = experiment_replayer.get_device_id()
@@ -1160,14 +1245,9 @@ class Participant:
             trial_meta_data = trial.replay(experiment_replayer)
             self.progress_display.increment()
             self.progress_window.update()
-            # put True in the 'Found' column of the self.data dataframe
-            self.data.loc[self.data['Trial Folder'] == trial.label, 'Found'] = True
-            
-            for key in trial_meta_data.keys():
-                self.data.loc[self.data['Trial Folder'] == trial.label, key] = trial_meta_data[key]
+            self.set_trial_meta_data(trial.label, trial_meta_data)
         
-        #write the participant data to a csv file
-        self.data.to_csv(self.data_csv_path, index=False)
+        self.save_replay_data()
         
         print(f"Processed pseudo '{self.pseudo}'")
         print(f"Participant '{self.pseudo}' missing trial {len(self.missing_trial_folders)} folders ")
@@ -1313,10 +1393,11 @@ class Trial:
             print('Trial {} not pre-processed'.format(self.label))
             return pre_processed
         pre_processed = True
-        file_suffixes =  ['depth_map_movement.gzip', 
+        # depth maps are either chunked recordings or gzip pickles (older pre-processings)
+        file_suffixes =  [('depth_map_movement'+DEPTH_CHUNKS_SUFFIX, 'depth_map_movement.gzip'), 
                           'timestamps_movement.gzip', 
                           'video_movement.avi',
-                          'depth_map_contact.gzip', 
+                          ('depth_map_contact'+DEPTH_CHUNKS_SUFFIX, 'depth_map_contact.gzip'), 
                           'timestamps_contact.gzip',
                           'video_contact.avi'
                         #   'depth_map_return.gzip',
@@ -1360,24 +1441,23 @@ class Trial:
             replayed = False
             return replayed
         replayed = True
-        files_suffixes = ['hand_traj.csv', 
-                          'main.csv']
+        # results are parquet files, or csv files (older replays)
+        files_suffixes = ['hand_traj', 
+                          'main']
         for suffix in files_suffixes:
+            file_count = len(list_results(self.replay_path, suffix, device_ID))
             if device_ID is not None:
-                file_count = len([f for f in os.listdir(self.replay_path) if f.endswith(suffix) and device_ID in f])
                 nmin = 1
             else:
-                file_count = len([f for f in os.listdir(self.replay_path) if f.endswith(suffix)])
                 nmin = 2
             if file_count <nmin:
                 replayed = False
                 print(f"Trial '{self.label}' not replayed: missing file with suffix '{suffix}'")
                 break
+        file_count = len([name for name in list_results(self.replay_path, 'traj', device_ID) if 'obj' in name])
         if device_ID is not None:
-            file_count = len([f for f in os.listdir(self.replay_path) if f.endswith('traj.csv')and 'obj' in f and device_ID in f])
             nmin = 1
         else:
-            file_count = len([f for f in os.listdir(self.replay_path) if f.endswith('traj.csv')and 'obj' in f])
             nmin = 2
         if file_count <nmin:
             replayed = False
@@ -1400,12 +1480,11 @@ class Trial:
             analysed = False
             return analysed
         analysed = True
-        file_suffix = 'target_data.csv'
+        file_suffix = 'target_data'
+        file_count = len(list_results(self.analysis_path, file_suffix, device_ID))
         if device_ID is not None:
-            file_count = len([f for f in os.listdir(self.analysis_path) if f.endswith(file_suffix) and device_ID in f])
             nmin = 1
         else:
-            file_count = len([f for f in os.listdir(self.analysis_path) if f.endswith(file_suffix)])
             nmin = 2
         if file_count <nmin:
             analysed = False
@@ -1436,15 +1515,16 @@ class Trial:
         # print('device_id', device_id)
         # print('folder', self.pre_processing_path)
         #get the .gzip file with device_id in the name
-        depth_file_list = [f for f in os.listdir(self.pre_processing_path) if device_id in f and f.endswith(".gzip") and 'depth_map' in f and sequence in f]
+        depth_file_list = [f for f in os.listdir(self.pre_processing_path) if device_id in f and f.endswith((DEPTH_CHUNKS_SUFFIX, ".gzip")) and 'depth_map' in f and sequence in f]
         # print('depth_file_list', depth_file_list)
-        depth_file = depth_file_list[0]
-        #extract data from the first file into a dataframe
-        timestamps_and_depth = pd.read_pickle(os.path.join(self.pre_processing_path, depth_file), compression='gzip')
+        # chunked recordings first
+        depth_file = sorted(depth_file_list, key=lambda f: not f.endswith(DEPTH_CHUNKS_SUFFIX))[0]
+        #memory-map the depth maps of the first file, converted once into a depth store
+        depth_store = DepthStore.from_recording(os.path.join(self.pre_processing_path, depth_file))
         #get the video file with device_id in the name
         video = [f for f in os.listdir(self.pre_processing_path) if device_id in f and f.endswith(".avi") and sequence in f][0]
         #merge the two dataframes into a single dataframe
-        replay = timestamps_and_depth.to_dict(orient='list')
+        replay = depth_store.to_replay()
         replay['Video'] = os.path.join(self.pre_processing_path, video)
         
         #get the current pandas timestamp
@@ -1456,37 +1536,14 @@ class Trial:
         
         #compute the duration of the trial
         # get first and last timestamps and compute the duration of the trial
-        first_timestamp = timestamps_and_depth['Timestamps'].iloc[0]
-        last_timestamp = timestamps_and_depth['Timestamps'].iloc[-1]
+        first_timestamp = depth_store.timestamps[0]
+        last_timestamp = depth_store.timestamps[-1]
         self.duration = last_timestamp - first_timestamp
         self.meta_data = {'Trial_duration': [self.duration], 'Trial_data_extration_duration': [replay_duration]}
         
         timestamps_only = pd.read_pickle(os.path.join(self.pre_processing_path, f"{self.label}_cam_{device_id}_timestamps_{sequence}.gzip"), compression='gzip')
-        self.main_data = timestamps_only
-        
-        hand_keys = sc.GraspingHand.MAIN_DATA_KEYS
-        for hand_id, hand_data in self.hands_data.items():
-            hand_summary = pd.DataFrame()
-            hand_summary['Timestamps'] = hand_data['Timestamps']
-            for key in hand_keys:
-                if key != 'Timestamps':
-                    hand_summary[hand_id + '_' + key] = hand_data[key]
-            # add the hand_summary to the main_data starting at the row corresponding to the first timestamp
-            self.main_data = pd.merge(self.main_data, hand_summary, on='Timestamps', how='left')
-        
-        object_keys = sc.RigidObject.MAIN_DATA_KEYS
-        for object_id, object_data in self.objects_data.items():
-            
-            object_summary = pd.DataFrame()
-            object_summary['Timestamps'] = object_data['Timestamps']
-            for key in object_keys:
-                if key != 'Timestamps':
-                    object_summary[object_id + '_' + key] = object_data[key]
-            # print(f'object_summary: \n{object_summary}')
-            # print(f'object_keys: \n{object_keys}')
-            
-            # add the object_summary to the main_data starting at the row corresponding to the first timestamp
-            self.main_data = pd.merge(self.main_data, object_summary, on='Timestamps', how='left')
+        # one row per recorded timestamp, with the columns of all the hands and objects
+        self.main_data = build_main_data(timestamps_only, self.hands_data, sc.GraspingHand.MAIN_DATA_KEYS, self.objects_data, sc.RigidObject.MAIN_DATA_KEYS)
         
         self.save_replay_data(device_id)
         return self.meta_data
@@ -1500,14 +1557,14 @@ class Trial:
             os.mkdir(self.analysis_path)
             
         device_id = experiment_analyser.get_device_id()
-        main_data_file = [f for f in os.listdir(self.replay_path) if f.endswith('main.csv') and device_id in f][0]
+        main_data_file = list_results(self.replay_path, 'main', device_id)[0]
         video_name = [f for f in os.listdir(self.pre_processing_path) if device_id in f and f.endswith(".avi") and 'movement' in f][0]
         video_path = os.path.join(self.pre_processing_path, video_name)
         print(f'video_path: {video_path}')
 
         
         hands_labels = []
-        hands_trajs = [f for f in os.listdir(self.replay_path) if f.endswith('hand_traj.csv') and device_id in f]
+        hands_trajs = list_results(self.replay_path, 'hand_traj', device_id)
         for hand_traj in hands_trajs:
             hand_label = hand_traj.split('_')[-3]
             # hand_label = hand_traj.split('_')[-3]+'_'+hand_traj.split('_')[-2]
@@ -1518,7 +1575,7 @@ class Trial:
         print(f'hands_labels: {hands_labels}')
         
         objects_labels = []
-        objects_trajs = [f for f in os.listdir(self.replay_path) if f.endswith('_traj.csv') and 'obj' in f and device_id in f]
+        objects_trajs = [name for name in list_results(self.replay_path, '_traj', device_id) if 'obj' in name]
         for object_traj in objects_trajs:
             object_label = object_traj.split('_')[-3]+'_'+object_traj.split('_')[-2]
             objects_labels.append(object_label)
@@ -1528,41 +1585,41 @@ class Trial:
         
         main_data_path = os.path.join(self.replay_path, main_data_file)
         print(f'main_data_path: {main_data_path}')
-        main_data = pd.read_csv(main_data_path)
+        main_data = read_table(main_data_path)
         
         hand_target_data = experiment_analyser.analyse(hands_labels, objects_labels, main_data, video_path=video_path)
         for hand, target_data in hand_target_data.items():
-            target_data.to_csv(os.path.join(self.analysis_path, f"{self.label}_cam_{device_id}_{hand}_target_data.csv"), index=False)
+            save_table(target_data, os.path.join(self.analysis_path, f"{self.label}_cam_{device_id}_{hand}_target_data"))
 
     def save_replay_data(self, device_id):
-        #write hands_data and objects_data to csv files
+        #write hands_data and objects_data to parquet files (and csv files if asked for)
         for hand_id, hand_data in self.hands_data.items():
             hand_data = hand_data.drop_duplicates(subset=['Timestamps'])
-            hand_data.to_csv(os.path.join(self.replay_path, f"{self.label}_cam_{device_id}_{hand_id}_traj.csv"), index=False)
+            save_table(hand_data, os.path.join(self.replay_path, f"{self.label}_cam_{device_id}_{hand_id}_traj"))
         for object_id, object_data in self.objects_data.items():
             object_data = object_data.drop_duplicates(subset=['Timestamps'])
-            object_data.to_csv(os.path.join(self.replay_path, f"{self.label}_cam_{device_id}_{object_id}_traj.csv"),index=False)
-        main_data = self.main_data.drop_duplicates(subset=['Timestamps'])
-        main_data.to_csv(os.path.join(self.replay_path, f"{self.label}_cam_{device_id}_main.csv"), index=False)
+            save_table(object_data, os.path.join(self.replay_path, f"{self.label}_cam_{device_id}_{object_id}_traj"))
+        # main data has one row per timestamp already
+        save_table(self.main_data, os.path.join(self.replay_path, f"{self.label}_cam_{device_id}_main"))
     
     def read_replay_data(self, device_id):
-        # list all files from the trial folder, files only, that end with hand_traj.csv
-        hand_files = [f for f in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, f)) and device_id in f and f.endswith(f"hand_traj.csv")]
+        # list all results from the trial folder that end with hand_traj
+        hand_files = list_results(self.path, "hand_traj", device_id)
         for hand_file in hand_files:
-            # get the hand id from the file name : between device_id and .csv
-            hand_id = hand_file.split(device_id)[1].split(".csv")[0]
-            hand_data = pd.read_csv(os.path.join(self.path, hand_file))
+            # get the hand id from the file name : after device_id
+            hand_id = hand_file.split(device_id)[1]
+            hand_data = read_table(os.path.join(self.path, hand_file))
             self.hands_data[hand_id] = hand_data
             
-        # list all files from the trial folder, files only, that end with object_traj.csv
-        object_files = [f for f in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, f)) and device_id in f and f.endswith(f"object_traj.csv")]
+        # list all results from the trial folder that end with object_traj
+        object_files = list_results(self.path, "object_traj", device_id)
         for object_file in object_files:
-            # get the object id from the file name : between device_id and .csv
-            object_id = object_file.split(device_id)[1].split(".csv")[0]
-            object_data = pd.read_csv(os.path.join(self.path, object_file))
+            # get the object id from the file name : after device_id
+            object_id = object_file.split(device_id)[1]
+            object_data = read_table(os.path.join(self.path, object_file))
             self.objects_data[object_id] = object_data
             
-        self.main_data = pd.read_csv(os.path.join(self.path, f"{self.label}_cam_{device_id}_main.csv"))
+        self.main_data = read_table(os.path.join(self.path, f"{self.label}_cam_{device_id}_main"))
     
     def analyse_data(self, experiment_analyser):
         
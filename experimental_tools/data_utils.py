@@ -0,0 +1,159 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+PARQUET_SUFFIX = '.parquet'
+CSV_SUFFIX = '.csv'
+# formats of the replay and analysis results, by order of preference when reading
+RESULTS_SUFFIXES = (PARQUET_SUFFIX, CSV_SUFFIX)
+# csv copies of the results, e.g. for spreadsheets
+_WRITE_CSV = False
+
+
+def trajectory_columns(label, trajectory, keys):
+    '''Returns the keys columns of trajectory, renamed label_key and indexed by their sorted timestamps.
+    Only the first row of each timestamp is kept'''
+    keys = [key for key in keys if key != 'Timestamps']
+    columns = trajectory[['Timestamps']+keys].drop_duplicates(subset=['Timestamps']).set_index('Timestamps').sort_index()
+    columns.columns = [f'{label}_{key}' for key in keys]
+    return columns
+
+
+def get_matching_tolerance(timestamps):
+    '''Half the shortest interval between two recorded frames : a trajectory row is matched to its own frame, never to a neighbouring one'''
+    intervals = np.diff(np.unique(timestamps))
+    if len(intervals) == 0:
+        return 0.
+    return intervals.min()/2
+
+
+def build_main_data(timestamps, hands_data, hand_keys, objects_data, object_keys, tolerance = None):
+    '''Builds the main data of a trial in one pass : one row per recorded timestamp, and the columns of every hand and object.
+    Each trajectory is aligned on the recorded timestamps by nearest timestamp within tolerance (see get_matching_tolerance),
+    so that timestamps recomputed with a rounding error still match. Rows are left empty where a hand or an object was not tracked,
+    and the columns of a trajectory matching none of the recorded timestamps are left empty with a warning'''
+    main_data = timestamps.drop_duplicates(subset=['Timestamps'])
+    target = pd.Index(main_data['Timestamps'].to_numpy(dtype=np.float64))
+    if tolerance is None:
+        tolerance = get_matching_tolerance(target)
+    columns = [trajectory_columns(hand_id, hand_data, hand_keys) for hand_id, hand_data in hands_data.items()]
+    columns += [trajectory_columns(object_id, object_data, object_keys) for object_id, object_data in objects_data.items()]
+    aligned = []
+    for trajectory in columns:
+        if len(trajectory) == 0:
+            aligned.append(trajectory.reindex(target))
+            continue
+        # position in trajectory of the nearest row of each recorded timestamp, -1 beyond tolerance
+        rows = trajectory.index.get_indexer(target, method='nearest', tolerance=tolerance)
+        if np.count_nonzero(rows >= 0) == 0:
+            # e.g. a stale file of another recording : left empty, as an untracked hand or object
+            print(f'build_main_data: WARNING none of the {len(trajectory)} timestamps of {list(trajectory.columns)} match the recorded timestamps (tolerance {tolerance} s), columns left empty')
+            aligned.append(trajectory.reindex(target))
+            continue
+        trajectory = trajectory.reset_index(drop=True).reindex(rows)
+        trajectory.index = target
+        aligned.append(trajectory)
+    if len(aligned) == 0:
+        return main_data
+    wide = pd.concat(aligned, axis=1)
+    main_data = main_data.reset_index(drop=True)
+    return pd.concat([main_data, wide.reset_index(drop=True)], axis=1)
+
+
+def save_table(df, path, write_csv = _WRITE_CSV):
+    '''Saves df at path (without extension) as a typed parquet file, and as csv if write_csv.
+    Falls back to csv when pyarrow is not installed or df cannot be stored as parquet'''
+    parquet_path = path+PARQUET_SUFFIX
+    if pq is not None:
+        try:
+            df.to_parquet(parquet_path, index=False)
+        except (ValueError, TypeError) as e:
+            print(f'save_table: {path} cannot be written as parquet ({e}), writing csv')
+            write_csv = True
+            # a former parquet file would be read instead of the csv
+            if os.path.exists(parquet_path):
+                os.remove(parquet_path)
+    else:
+        write_csv = True
+    if write_csv:
+        df.to_csv(path+CSV_SUFFIX, index=False)
+
+
+def read_table(path, columns = None):
+    '''Reads the table saved at path (without extension), parquet first, then csv.
+    Only columns are read if given, those missing from the table are ignored'''
+    parquet_path = path+PARQUET_SUFFIX
+    if pq is not None and os.path.exists(parquet_path):
+        if columns is not None:
+            names = pq.read_schema(parquet_path).names
+            columns = [column for column in columns if column in names]
+        return pd.read_parquet(parquet_path, columns=columns)
+    csv_path = path+CSV_SUFFIX
+    if os.path.exists(csv_path):
+        if columns is not None:
+            columns = set(columns)
+            return pd.read_csv(csv_path, usecols=lambda column: column in columns)
+        return pd.read_csv(csv_path)
+    raise FileNotFoundError(f'No table found at {path} ({" or ".join(RESULTS_SUFFIXES)})')
+
+
+def list_results(folder, suffix, device_id = None):
+    '''Returns the sorted names, without extension, of the results of folder ending with suffix, whatever their format'''
+    names = set()
+    for f in os.listdir(folder):
+        name, ext = os.path.splitext(f)
+        if ext in RESULTS_SUFFIXES and name.endswith(suffix) and (device_id is None or device_id in name):
+            names.add(name)
+    return sorted(names)
+
+
+def parse_result_name(name, trial_label, suffix):
+    '''Returns the device id and the label (hand or object, empty for the main data) of a result named trial_label_cam_device_label_suffix'''
+    prefix = f'{trial_label}_cam_'
+    if not name.startswith(prefix):
+        return None, None
+    device_id, _, label = name[len(prefix):-len(suffix)].partition('_')
+    return device_id, label.strip('_')
+
+
+def load_results_dataset(root, suffix, columns = None, pseudos = None, trials = None, devices = None, nb_threads = 8):
+    '''Loads the results ending with suffix of a session processing folder (Replay or Analysis), laid out as root/pseudo/trial/.
+    Only the given columns, participants, trials and devices are read, the files being read in parallel.
+    Returns a single dataframe, with Pseudo, Trial, Device and Label columns identifying the rows'''
+    files = []
+    for pseudo in sorted(os.listdir(root)):
+        pseudo_path = os.path.join(root, pseudo)
+        if not os.path.isdir(pseudo_path) or (pseudos is not None and pseudo not in pseudos):
+            continue
+        for trial in sorted(os.listdir(pseudo_path)):
+            trial_path = os.path.join(pseudo_path, trial)
+            if not os.path.isdir(trial_path) or (trials is not None and trial not in trials):
+                continue
+            for name in list_results(trial_path, suffix):
+                device_id, label = parse_result_name(name, trial, suffix)
+                if device_id is None or (devices is not None and device_id not in devices):
+                    continue
+                files.append((os.path.join(trial_path, name), pseudo, trial, device_id, label))
+
+    def load(file):
+        path, pseudo, trial, device_id, label = file
+        table = read_table(path, columns)
+        table.insert(0, 'Label', label)
+        table.insert(0, 'Device', device_id)
+        table.insert(0, 'Trial', trial)
+        table.insert(0, 'Pseudo', pseudo)
+        return table
+
+    print(f'Loading {len(files)} {suffix} results from {root}')
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        tables = list(executor.map(load, files))
+    if len(tables) == 0:
+        return pd.DataFrame(columns=['Pseudo', 'Trial', 'Device', 'Label'])
+    return pd.concat(tables, ignore_index=True)
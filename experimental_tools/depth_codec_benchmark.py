@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from depth_utils import DEPTH_CODECS, encode_depth_frames, decode_depth_frames, read_depth_recording
+
+
+def benchmark_gzip_pickle(df):
+    '''Former storage : gzip compressed pickle of the whole DataFrame of a trial'''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'depth_map.gzip')
+        t = time.perf_counter()
+        df.to_pickle(path, compression='gzip')
+        encode_time = time.perf_counter()-t
+        size = os.path.getsize(path)
+        t = time.perf_counter()
+        pd.read_pickle(path, compression='gzip')
+        decode_time = time.perf_counter()-t
+    return size, encode_time, decode_time
+
+
+def benchmark_codec(frames, codec, level, chunk_size):
+    size = 0
+    encode_time = 0
+    decode_time = 0
+    for start in range(0, len(frames), chunk_size):
+        chunk = frames[start:start+chunk_size]
+        t = time.perf_counter()
+        payload = encode_depth_frames(chunk, codec, level)
+        encode_time += time.perf_counter()-t
+        t = time.perf_counter()
+        decoded = decode_depth_frames(payload, codec, chunk.shape)
+        decode_time += time.perf_counter()-t
+        if not np.array_equal(decoded, chunk):
+            raise ValueError(f'codec {codec} is not lossless')
+        size += len(payload)
+    return size, encode_time, decode_time
+
+
+def print_result(name, raw_size, size, encode_time, decode_time):
+    mb = raw_size/1e6
+    print(f'{name:>16} : ratio {raw_size/size:6.2f}, encode {mb/encode_time:8.1f} MB/s, decode {mb/decode_time:8.1f} MB/s')
+
+
+def main(recordings, codecs, level, chunk_size):
+    for path in recordings:
+        df = read_depth_recording(path)
+        frames = np.stack(df['Depth_maps'].to_list()).astype(np.uint16)
+        raw_size = frames.nbytes
+        print(f'{path} : {len(frames)} frames, {raw_size/1e6:.1f} MB')
+        print_result('gzip pickle', raw_size, *benchmark_gzip_pickle(df))
+        for codec in codecs:
+            try:
+                print_result(codec, raw_size, *benchmark_codec(frames, codec, level, chunk_size))
+            except ValueError as e:
+                print(f'{codec:>16} : {e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the depth codecs with the former gzip pickles on recorded trials")
+    parser.add_argument('recordings', nargs='+', help="Depth recordings (.gzip or .chunks) of recorded trials")
+    parser.add_argument('-c', '--codecs', nargs='+', choices=DEPTH_CODECS, default=DEPTH_CODECS, help="Codecs to compare")
+    parser.add_argument('-l', '--level', type=int, default=1, help="Compression level of the codecs")
+    parser.add_argument('-cs', '--chunk_size', type=int, default=15, help="Frames per chunk")
+    args = vars(parser.parse_args())
+    main(**args)
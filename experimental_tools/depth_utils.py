@@ -0,0 +1,400 @@
+import os
+import queue
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+import pandas as pd
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Chunked depth recordings : a sequence of independent chunks, each made of a header,
+# the timestamps of its frames and the depth maps compressed with one of DEPTH_CODECS.
+# The first frame of a chunk is a keyframe, so that any frame is decoded from its chunk only
+_CHUNK_MAGIC = b'DCHK'
+_CHUNK_HEADER_DTYPE = np.dtype([('magic', 'S4'),
+                                ('codec', 'S12'),
+                                ('nb_frames', '<u4'),
+                                ('height', '<u4'),
+                                ('width', '<u4'),
+                                ('payload_size', '<u8')])
+DEPTH_CHUNKS_SUFFIX = '.chunks'
+DEPTH_CHUNKS_INDEX_SUFFIX = '.index.npz'
+DEPTH_CODECS = ['zlib', 'lz4', 'delta-zlib', 'delta-lz4', 'png']
+DEFAULT_DEPTH_CODEC = 'delta-zlib'
+
+
+def to_byte_planes(frames):
+    '''Splits uint16 frames into their low and high byte planes, which compress much better separately'''
+    return np.ascontiguousarray(np.moveaxis(frames.view(np.uint8).reshape(frames.shape+(2,)), -1, 0))
+
+def from_byte_planes(planes, shape):
+    return np.ascontiguousarray(np.moveaxis(planes.reshape((2,)+shape), 0, -1)).view(np.uint16).reshape(shape)
+
+def delta_encode(frames):
+    '''Differences between consecutive frames, modulo 2**16 so that they are exactly reversible'''
+    deltas = frames.copy()
+    deltas[1:] -= frames[:-1]
+    return deltas
+
+def delta_decode(deltas):
+    return np.cumsum(deltas, axis=0, dtype=np.uint16)
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, level)
+
+def _lz4_compress(data, level):
+    if lz4_frame is None:
+        raise ValueError('the lz4 depth codecs need the lz4 package')
+    return lz4_frame.compress(data, compression_level=level)
+
+def _lz4_decompress(data):
+    if lz4_frame is None:
+        raise ValueError('the lz4 depth codecs need the lz4 package')
+    return lz4_frame.decompress(data)
+
+_ENTROPY_CODERS = {'zlib' : (_zlib_compress, zlib.decompress),
+                   'lz4' : (_lz4_compress, _lz4_decompress)}
+
+def encode_depth_frames(frames, codec = DEFAULT_DEPTH_CODEC, level = 1):
+    '''Losslessly compresses a (n, h, w) uint16 array of consecutive depth maps.
+    codec is 'zlib', 'lz4' (raw frames), 'delta-zlib', 'delta-lz4' (differences between frames, split in byte planes),
+    or 'png' (16 bits png of each frame, as a baseline)'''
+    frames = np.ascontiguousarray(frames, dtype=np.uint16)
+    if codec == 'png':
+        encoded = [cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, level])[1].tobytes() for frame in frames]
+        sizes = np.array([len(data) for data in encoded], dtype='<u4')
+        return sizes.tobytes() + b''.join(encoded)
+    if codec.startswith('delta-'):
+        compress, _ = _ENTROPY_CODERS[codec[len('delta-'):]]
+        return compress(to_byte_planes(delta_encode(frames)).tobytes(), level)
+    compress, _ = _ENTROPY_CODERS[codec]
+    return compress(frames.tobytes(), level)
+
+def decode_depth_frames(payload, codec, shape):
+    '''Inverse of encode_depth_frames, shape being (n, h, w)'''
+    if codec == 'png':
+        sizes = np.frombuffer(payload[:4*shape[0]], dtype='<u4')
+        ends = 4*shape[0] + np.cumsum(sizes)
+        frames = np.empty(shape, dtype=np.uint16)
+        for i, (start, end) in enumerate(zip(ends-sizes, ends)):
+            frames[i] = cv2.imdecode(np.frombuffer(payload[start:end], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        return frames
+    if codec.startswith('delta-'):
+        _, decompress = _ENTROPY_CODERS[codec[len('delta-'):]]
+        planes = np.frombuffer(decompress(payload), dtype=np.uint8)
+        return delta_decode(from_byte_planes(planes, shape))
+    _, decompress = _ENTROPY_CODERS[codec]
+    return np.frombuffer(decompress(payload), dtype=np.uint16).reshape(shape)
+
+
+class DepthChunkWriter:
+    def __init__(self, path, chunk_size = 15, queue_size = 4, codec = DEFAULT_DEPTH_CODEC, compression_level = 1) -> None:
+        '''Streams depth maps to disk while recording : frames are gathered in chunks of chunk_size frames,
+        compressed with codec (see encode_depth_frames) and appended to path by a background thread. At most queue_size chunks wait to be written :
+        write never blocks, a frame that would complete a chunk while the queue is full is dropped and counted, like the frames of VideoWriterThread.
+        The index of the chunks (offsets, first frames, timestamps) is saved next to path by close,
+        with the recorded timestamps of the frames (s from the first frame) if given'''
+        self.path = path
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.compression_level = compression_level
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.chunk = None
+        self.chunk_timestamps = []
+        self.nb_frames = 0
+        self.nb_dropped_frames = 0
+        self.timestamps = []
+        self.chunks_offsets = []
+        self.chunks_first_frames = []
+        self.finished = threading.Event()
+        self.file = open(self.path, 'wb')
+        self.thread = threading.Thread(target=self.write_task, daemon=True)
+        self.thread.start()
+
+    def can_write(self):
+        '''False when the next frame would complete a chunk that cannot be queued, i.e. when it would be dropped'''
+        nb_chunk_frames = 0 if self.chunk is None else len(self.chunk_timestamps)
+        return nb_chunk_frames + 1 < self.chunk_size or not self.queue.full()
+
+    def write(self, depth_map, timestamp, block = False):
+        '''Adds a depth map and its timestamp (s since epoch) to the recording, returns False if it was dropped.
+        With block, waits for room in the queue instead of dropping the frame (recordings written offline)'''
+        if not block and not self.can_write():
+            self.nb_dropped_frames += 1
+            return False
+        if self.chunk is None:
+            self.chunk = np.empty((self.chunk_size,)+depth_map.shape, dtype=np.uint16)
+            self.chunk_timestamps = []
+        self.chunk[len(self.chunk_timestamps)] = depth_map
+        self.chunk_timestamps.append(timestamp)
+        self.nb_frames += 1
+        if len(self.chunk_timestamps) == self.chunk_size:
+            # cannot fail, can_write checked there was room in the queue
+            self.flush(block=block)
+        return True
+
+    def flush(self, block = False):
+        '''Hands the current chunk over to the writing thread, returns False if the queue was full'''
+        if self.chunk is None or len(self.chunk_timestamps) == 0:
+            return True
+        try:
+            self.queue.put((self.chunk[:len(self.chunk_timestamps)], np.array(self.chunk_timestamps, dtype=np.float64)), block=block)
+        except queue.Full:
+            return False
+        self.chunk = None
+        return True
+
+    def finish(self):
+        '''Ends the recording without waiting : the last frames are queued if there is room, by close otherwise'''
+        self.flush()
+        self.finished.set()
+
+    def close(self, recorded_timestamps = None):
+        '''Waits for every chunk to be written, and saves the index.
+        recorded_timestamps are the Timestamps of the recording, used as replay clock'''
+        self.finished.set()
+        self.flush(block=True)
+        self.thread.join()
+        if recorded_timestamps is not None:
+            save_chunks_index(self.path, np.array(self.chunks_offsets, dtype=np.int64), np.array(self.chunks_first_frames, dtype=np.int64),
+                              np.array(self.timestamps, dtype=np.float64), recorded_timestamps)
+        print(f'{self.path} : {self.nb_frames} depth maps written, {self.nb_dropped_frames} dropped')
+        return self.path
+
+    def write_task(self):
+        offset = 0
+        while True:
+            try:
+                frames, timestamps = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                # the last chunk is queued before it is released
+                if self.finished.is_set() and self.chunk is None and self.queue.empty():
+                    break
+                continue
+            payload = encode_depth_frames(frames, self.codec, self.compression_level)
+            header = np.array([(_CHUNK_MAGIC, self.codec, len(frames), frames.shape[1], frames.shape[2], len(payload))], dtype=_CHUNK_HEADER_DTYPE)
+            self.file.write(header.tobytes())
+            self.file.write(timestamps.tobytes())
+            self.file.write(payload)
+            self.chunks_offsets.append(offset)
+            self.chunks_first_frames.append(len(self.timestamps))
+            self.timestamps.extend(timestamps.tolist())
+            offset += header.nbytes + timestamps.nbytes + len(payload)
+        self.file.close()
+        save_chunks_index(self.path, np.array(self.chunks_offsets, dtype=np.int64),
+                          np.array(self.chunks_first_frames, dtype=np.int64), np.array(self.timestamps, dtype=np.float64))
+
+
+def save_depth_recording(path, depth_maps, timestamps, chunk_size = 15, codec = DEFAULT_DEPTH_CODEC, compression_level = 1, recorded_timestamps = None):
+    '''Writes depth maps and their timestamps (s) as a chunked depth recording'''
+    writer = DepthChunkWriter(path, chunk_size=chunk_size, codec=codec, compression_level=compression_level)
+    for depth_map, timestamp in zip(depth_maps, timestamps):
+        writer.write(depth_map, timestamp, block=True)
+    return writer.close(recorded_timestamps)
+
+
+def save_depth_dataframe(path, df, **kwargs):
+    '''Writes a DataFrame of depth maps (Depth_maps, Date, Timestamps) as a chunked depth recording, keeping its Timestamps'''
+    timestamps = df['Date'].astype('int64').to_numpy()/1e9
+    return save_depth_recording(path, df['Depth_maps'], timestamps, recorded_timestamps=df['Timestamps'].to_numpy(dtype=np.float64), **kwargs)
+
+
+def save_chunks_index(path, offsets, first_frames, timestamps, recorded_timestamps = None):
+    index = dict(offsets=offsets, first_frames=first_frames, timestamps=timestamps)
+    if recorded_timestamps is not None:
+        index['recorded_timestamps'] = np.asarray(recorded_timestamps, dtype=np.float64)
+    np.savez(path + DEPTH_CHUNKS_INDEX_SUFFIX, **index)
+
+
+def load_recorded_timestamps(path):
+    '''Returns the recorded Timestamps (s from the first frame) of a chunked recording, as saved in the timestamps files.
+    They are the replay clock : hands and objects trajectories are joined to the timestamps files on these exact values.
+    Recordings without them (or whose index was lost) fall back to timestamps computed from the dates of the frames'''
+    index_path = path + DEPTH_CHUNKS_INDEX_SUFFIX
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            if 'recorded_timestamps' in index.files:
+                return index['recorded_timestamps']
+    _, _, dates = load_chunks_index(path)
+    print(f'{path} : no recorded timestamps, replay timestamps computed from the frames dates')
+    return dates - dates[0] if len(dates) > 0 else dates
+
+
+def read_chunk_header(f):
+    header_bytes = f.read(_CHUNK_HEADER_DTYPE.itemsize)
+    if len(header_bytes) < _CHUNK_HEADER_DTYPE.itemsize:
+        return None
+    header = np.frombuffer(header_bytes, dtype=_CHUNK_HEADER_DTYPE)[0]
+    if header['magic'] != _CHUNK_MAGIC:
+        raise ValueError(f'Corrupted depth chunks file at offset {f.tell()-len(header_bytes)}')
+    return header
+
+
+def load_chunks_index(path):
+    '''Returns (offsets, first_frames, timestamps) of the chunks of path.
+    The index is rebuilt from the chunk headers if it is missing, e.g. after a crash during the recording'''
+    index_path = path + DEPTH_CHUNKS_INDEX_SUFFIX
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            return index['offsets'], index['first_frames'], index['timestamps']
+    offsets, first_frames, timestamps = [], [], []
+    with open(path, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = read_chunk_header(f)
+            if header is None:
+                break
+            chunk_timestamps = np.frombuffer(f.read(8*int(header['nb_frames'])), dtype=np.float64)
+            payload_size = int(header['payload_size'])
+            if f.seek(payload_size, os.SEEK_CUR) > os.fstat(f.fileno()).st_size:
+                # truncated last chunk
+                break
+            offsets.append(offset)
+            first_frames.append(len(timestamps))
+            timestamps.extend(chunk_timestamps.tolist())
+    return np.array(offsets, dtype=np.int64), np.array(first_frames, dtype=np.int64), np.array(timestamps, dtype=np.float64)
+
+
+def read_chunk(f, offset):
+    '''Returns (depth maps, timestamps) of the chunk at offset of the open file f'''
+    f.seek(offset)
+    header = read_chunk_header(f)
+    nb_frames = int(header['nb_frames'])
+    timestamps = np.frombuffer(f.read(8*nb_frames), dtype=np.float64)
+    shape = (nb_frames, int(header['height']), int(header['width']))
+    frames = decode_depth_frames(f.read(int(header['payload_size'])), header['codec'].decode(), shape)
+    return frames, timestamps
+
+
+def read_depth_chunks(path):
+    '''Yields (depth maps, timestamps) of every chunk of path'''
+    offsets, _, _ = load_chunks_index(path)
+    with open(path, 'rb') as f:
+        for offset in offsets:
+            yield read_chunk(f, offset)
+
+
+def read_depth_frame(path, frame_index, index = None):
+    '''Decodes a single frame, using the chunks index as seek table : only the chunk holding the frame is read'''
+    offsets, first_frames, _ = load_chunks_index(path) if index is None else index
+    chunk_index = np.searchsorted(first_frames, frame_index, side='right') - 1
+    with open(path, 'rb') as f:
+        frames, _ = read_chunk(f, offsets[chunk_index])
+    return frames[frame_index - first_frames[chunk_index]]
+
+
+def load_depth_chunks(path):
+    '''Loads a chunked depth recording as the DataFrame saved by the former recorder (Depth_maps, Date, Timestamps)'''
+    depth_maps, timestamps = [], []
+    for frames, chunk_timestamps in read_depth_chunks(path):
+        depth_maps.extend(frames)
+        timestamps.append(chunk_timestamps)
+    timestamps = np.concatenate(timestamps) if len(timestamps) > 0 else np.empty(0)
+    df = pd.DataFrame({'Depth_maps': depth_maps,
+                       'Date': pd.to_datetime(timestamps, unit='s')})
+    df['Timestamps'] = load_recorded_timestamps(path)
+    return df
+
+
+def depth_recording_path(recording_path, sequence = None):
+    '''Returns the depth file of a recording (path without suffix), chunked if available, gzip pickle otherwise'''
+    if sequence is not None:
+        recording_path = recording_path + '_depth_map_' + sequence
+    else:
+        recording_path = recording_path + '_depth_map'
+    chunks_path = recording_path + DEPTH_CHUNKS_SUFFIX
+    if os.path.exists(chunks_path):
+        return chunks_path
+    return recording_path + '.gzip'
+
+
+def read_depth_recording(path):
+    '''Loads a depth recording, whatever its format, as a DataFrame (Depth_maps, Date, Timestamps)'''
+    t = time.time()
+    if path.endswith(DEPTH_CHUNKS_SUFFIX):
+        df = load_depth_chunks(path)
+    else:
+        df = pd.read_pickle(path, compression='gzip')
+    print(f'{path} loaded in {time.time()-t:.2f} s')
+    return df
+
+
+DEPTH_STORE_SUFFIX = '.store.npy'
+DEPTH_STORE_TIMESTAMPS_SUFFIX = '.store_replay_timestamps.npy'
+
+
+class DepthStore:
+    def __init__(self, frames_path, timestamps_path) -> None:
+        '''Replay-side depth maps of a recording, memory-mapped : frames are read from disk only when accessed,
+        as read-only views, by index or by timestamp. Built once per recording with DepthStore.from_recording'''
+        self.frames = np.load(frames_path, mmap_mode='r')
+        # recorded Timestamps (s from the first frame), the exact values of the timestamps files
+        self.timestamps = np.load(timestamps_path)
+
+    @classmethod
+    def from_recording(cls, path):
+        '''Opens the store of a depth recording (.chunks or .gzip), converting the recording the first time.
+        The store is rebuilt when the recording is newer than it'''
+        frames_path = path + DEPTH_STORE_SUFFIX
+        timestamps_path = path + DEPTH_STORE_TIMESTAMPS_SUFFIX
+        if not (os.path.exists(frames_path) and os.path.exists(timestamps_path)
+                and os.path.getmtime(frames_path) >= os.path.getmtime(path)):
+            t = time.time()
+            convert_to_depth_store(path, frames_path, timestamps_path)
+            print(f'{path} converted to a depth store in {time.time()-t:.2f} s')
+        return cls(frames_path, timestamps_path)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def index_at(self, timestamp):
+        '''Index of the last frame at or before timestamp (s from the beginning of the recording)'''
+        return max(int(np.searchsorted(self.timestamps, timestamp, side='right')) - 1, 0)
+
+    def frame_at(self, timestamp):
+        return self.frames[self.index_at(timestamp)]
+
+    def to_replay(self):
+        '''Depth maps and timestamps in the layout expected by RgbdCamera.load_replay'''
+        return {'Depth_maps': self, 'Timestamps': self.timestamps}
+
+
+def convert_to_depth_store(path, frames_path, timestamps_path):
+    '''Writes the depth maps of a recording in a .npy file, chunk by chunk for chunked recordings.
+    Files are written under temporary names then renamed, so that an interrupted conversion is never used'''
+    # suffixed by the pid, so that processes converting the same recording do not write into the same files
+    tmp_frames_path = frames_path + f'.{os.getpid()}.tmp'
+    tmp_timestamps_path = timestamps_path + f'.{os.getpid()}.tmp'
+    if path.endswith(DEPTH_CHUNKS_SUFFIX):
+        offsets, first_frames, dates = load_chunks_index(path)
+        timestamps = load_recorded_timestamps(path)
+        frames = None
+        for chunk_index, (chunk, _) in enumerate(read_depth_chunks(path)):
+            if frames is None:
+                frames = np.lib.format.open_memmap(tmp_frames_path, mode='w+', dtype=np.uint16, shape=(len(dates),)+chunk.shape[1:])
+            frames[first_frames[chunk_index]:first_frames[chunk_index]+len(chunk)] = chunk
+        if frames is None:
+            frames = np.lib.format.open_memmap(tmp_frames_path, mode='w+', dtype=np.uint16, shape=(0, 0, 0))
+        frames.flush()
+        del frames
+    else:
+        df = pd.read_pickle(path, compression='gzip')
+        timestamps = df['Timestamps'].to_numpy(dtype=np.float64)
+        with open(tmp_frames_path, 'wb') as f:
+            np.save(f, np.stack(df['Depth_maps'].to_list()).astype(np.uint16) if len(df) > 0 else np.empty((0, 0, 0), dtype=np.uint16))
+        del df
+    with open(tmp_timestamps_path, 'wb') as f:
+        np.save(f, np.asarray(timestamps, dtype=np.float64))
+    os.replace(tmp_timestamps_path, timestamps_path)
+    os.replace(tmp_frames_path, frames_path)
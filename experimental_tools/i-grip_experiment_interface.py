@@ -868,6 +868,7 @@ if __name__ == "__main__":
     
     parser = argparse.ArgumentParser()
     parser.add_argument('-m', '--mode', choices=['record', 'pre_processing', 'replay', 'analysis'], default = 'replay', help="Mode of the interface")
+    parser.add_argument('-w', '--workers', type=int, default = 1, help="Number of worker processes for replay and analysis, trials are processed one after the other with 1")
     args = vars(parser.parse_args())
     if args['mode'] == 'record':
         interface = ExperimentRecordingInterface()
@@ -879,5 +880,6 @@ if __name__ == "__main__":
         interface = ExperimentAnalysisInterface()
     else:
         raise ValueError(f"Mode {args['mode']} not recognized")
+    interface.experiment.set_nb_workers(args['workers'])
     multiprocessing.set_start_method('spawn', force=True)
     interface.start()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_utils import build_main_data
+
+HAND_KEYS = ['Timestamps', 'x', 'y', 'z', 'Extrapolated']
+OBJECT_KEYS = ['Timestamps', 'x', 'y', 'z', 'qx', 'qy', 'qz', 'qw', 'Extrapolated']
+
+
+def build_main_data_by_merges(timestamps, hands_data, hand_keys, objects_data, object_keys):
+    '''Former assembly : one left merge per hand and per object, then duplicated timestamps dropped when saving'''
+    main_data = timestamps
+    for label, data, keys in [(hand_id, hand_data, hand_keys) for hand_id, hand_data in hands_data.items()] + [(object_id, object_data, object_keys) for object_id, object_data in objects_data.items()]:
+        summary = pd.DataFrame()
+        summary['Timestamps'] = data['Timestamps']
+        for key in keys:
+            if key != 'Timestamps':
+                summary[label + '_' + key] = data[key]
+        main_data = pd.merge(main_data, summary, on='Timestamps', how='left')
+    return main_data.drop_duplicates(subset=['Timestamps'])
+
+
+def make_trajectory(timestamps, keys, rng):
+    '''Trajectory tracked on a random part of the trial, with a few timestamps recorded twice'''
+    start = rng.integers(0, len(timestamps)//4)
+    stop = rng.integers(3*len(timestamps)//4, len(timestamps))
+    traj_timestamps = timestamps[start:stop]
+    traj_timestamps = np.sort(np.concatenate([traj_timestamps, rng.choice(traj_timestamps, size=len(traj_timestamps)//50)]))
+    traj = pd.DataFrame(rng.normal(size=(len(traj_timestamps), len(keys)-1)), columns=keys[1:])
+    traj.insert(0, 'Timestamps', traj_timestamps)
+    return traj
+
+
+def perturb_timestamps(trajectory, epoch = 1.7e9):
+    '''Trajectory whose timestamps went through epoch dates, as when they are recomputed from the dates of the frames :
+    they differ from the recorded ones by a rounding error of about 1e-7 s'''
+    trajectory = trajectory.copy()
+    trajectory['Timestamps'] = (trajectory['Timestamps'] + epoch) - epoch
+    return trajectory
+
+
+def make_trial(nb_frames, nb_objects, rng):
+    timestamps = np.cumsum(rng.uniform(0.03, 0.04, size=nb_frames))
+    hands_data = {f'{label}_hand': make_trajectory(timestamps, HAND_KEYS, rng) for label in ('left', 'right')}
+    objects_data = {f'obj_{i}': make_trajectory(timestamps, OBJECT_KEYS, rng) for i in range(nb_objects)}
+    return pd.DataFrame({'Timestamps': timestamps}), hands_data, objects_data
+
+
+def measure(function, args, repeats):
+    t = time.perf_counter()
+    for _ in range(repeats):
+        result = function(*args)
+    return result, (time.perf_counter()-t)/repeats
+
+
+def main(nb_frames, max_objects, repeats):
+    rng = np.random.default_rng(0)
+    for nb_objects in range(1, max_objects+1):
+        timestamps, hands_data, objects_data = make_trial(nb_frames, nb_objects, rng)
+        args = (timestamps, hands_data, HAND_KEYS, objects_data, OBJECT_KEYS)
+        merged, merges_time = measure(build_main_data_by_merges, args, repeats)
+        joined, join_time = measure(build_main_data, args, repeats)
+        pd.testing.assert_frame_equal(merged.reset_index(drop=True), joined.reset_index(drop=True))
+        # trajectories stamped with timestamps recomputed from the dates must still be aligned on the recorded frames
+        perturbed_hands = {hand_id: perturb_timestamps(hand_data) for hand_id, hand_data in hands_data.items()}
+        perturbed_objects = {object_id: perturb_timestamps(object_data) for object_id, object_data in objects_data.items()}
+        perturbed_args = (timestamps, perturbed_hands, HAND_KEYS, perturbed_objects, OBJECT_KEYS)
+        perturbed_merged = build_main_data_by_merges(*perturbed_args)
+        matched = perturbed_merged.drop(columns='Timestamps').notna().to_numpy().sum()/max(merged.drop(columns='Timestamps').notna().to_numpy().sum(), 1)
+        perturbed_joined = build_main_data(*perturbed_args)
+        pd.testing.assert_frame_equal(merged.reset_index(drop=True), perturbed_joined.reset_index(drop=True))
+        print(f'{nb_objects:>3} objects : merges {merges_time*1000:8.2f} ms, single join {join_time*1000:8.2f} ms, speed-up {merges_time/join_time:5.2f}, exact merges match {100*matched:5.1f} % of perturbed values')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compares the assembly of the trial main data by successive merges and by a single alignment, on exact and perturbed timestamps")
+    parser.add_argument('-n', '--nb_frames', type=int, default=600, help="Frames per trial")
+    parser.add_argument('-o', '--max_objects', type=int, default=20, help="Trials are built with 1 to max_objects objects")
+    parser.add_argument('-r', '--repeats', type=int, default=5, help="Repetitions of each measure")
+    args = vars(parser.parse_args())
+    main(**args)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+import numpy as np
+
+from i_grip.Hands3DDetectors import StereoInference
+
+# normalized points whose boxes cross or leave the borders of the image, with fractional pixel positions
+BORDER_POINTS = [(0.003, 0.5), (0.5, 0.004), (0.0031, 0.0042), (0.9972, 0.5), (0.5, 0.9981), (0.9973, 0.9984),
+                 (0., 0.), (1., 1.), (-0.004, 0.5), (0.5, -0.006), (-0.02, -0.03), (1.004, 0.5), (0.5, 1.006), (1.02, 1.03)]
+
+
+def calc_spatials_loop(stereo_inference, points, depth_map):
+    '''Former location of the hands : one calc_spatials per point'''
+    results = [stereo_inference.calc_spatials(point, depth_map) for point in points]
+    return np.array([position for position, _ in results]), [roi for _, roi in results]
+
+
+def check_equivalence(stereo_inference, points, depth_map):
+    positions, rois = calc_spatials_loop(stereo_inference, points, depth_map)
+    batch_positions, batch_rois = stereo_inference.calc_spatials_batch(points, depth_map)
+    for point, roi, batch_roi in zip(points, rois, batch_rois):
+        if tuple(roi) != tuple(batch_roi):
+            raise ValueError(f'point {tuple(point)} : calc_spatials box {tuple(roi)}, calc_spatials_batch box {tuple(batch_roi)}')
+    if not np.allclose(positions, batch_positions):
+        raise ValueError(f'calc_spatials and calc_spatials_batch positions differ by up to {np.abs(positions-batch_positions).max()} mm')
+
+
+def measure(function, args, repeats):
+    t = time.perf_counter()
+    for _ in range(repeats):
+        function(*args)
+    return (time.perf_counter()-t)/repeats
+
+
+def main(width, height, max_points, repeats):
+    rng = np.random.default_rng(0)
+    stereo_inference = StereoInference(dict(resolution=(width, height), hfov=72.))
+    depth_map = rng.integers(0, 4000, size=(height, width)).astype(np.uint16)
+    check_equivalence(stereo_inference, np.array(BORDER_POINTS), depth_map)
+    print(f'{len(BORDER_POINTS)} border points : calc_spatials and calc_spatials_batch match')
+    for nb_points in range(1, max_points+1):
+        points = rng.uniform(0., 1., size=(nb_points, 3))
+        check_equivalence(stereo_inference, points, depth_map)
+        loop_time = measure(calc_spatials_loop, (stereo_inference, points, depth_map), repeats)
+        batch_time = measure(stereo_inference.calc_spatials_batch, (points, depth_map), repeats)
+        print(f'{nb_points:>3} points : loop {loop_time*1000:8.3f} ms, batch {batch_time*1000:8.3f} ms, speed-up {loop_time/batch_time:5.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks that calc_spatials_batch locates points as calc_spatials does, border points included, and compares their durations")
+    parser.add_argument('-W', '--width', type=int, default=1280, help="Width of the depth map")
+    parser.add_argument('-H', '--height', type=int, default=720, help="Height of the depth map")
+    parser.add_argument('-n', '--max_points', type=int, default=8, help="Points are located by batches of 1 to max_points")
+    parser.add_argument('-r', '--repeats', type=int, default=100, help="Repetitions of each measure")
+    args = vars(parser.parse_args())
+    main(**args)
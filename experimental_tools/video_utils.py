@@ -1,3 +1,6 @@
+import queue
+import threading
+
 import cv2
 
 def concatenate_videos_horizontally(video1_path, video2_path, output_path, label1=None, label2=None):
@@ -66,3 +69,54 @@ def concatenate_videos_horizontally(video1_path, video2_path, output_path, label
     video2.release()
     out.release()
     cv2.destroyAllWindows()
+
+
+class VideoWriterThread:
+    def __init__(self, path, fourcc, fps, resolution, queue_size = 30) -> None:
+        '''cv2.VideoWriter encoding frames on its own thread, fed by a bounded queue.
+        write never blocks : frames arriving while the queue is full are dropped and counted,
+        so that a slow encoder never delays the acquisition'''
+        self.path = path
+        self.writer = cv2.VideoWriter(path, fourcc, fps, resolution)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.nb_written_frames = 0
+        self.nb_dropped_frames = 0
+        self.queue_high_water_mark = 0
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.write_task, daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        '''Queues frame for encoding, returns False if it was dropped'''
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.nb_dropped_frames += 1
+            return False
+        self.queue_high_water_mark = max(self.queue_high_water_mark, self.queue.qsize())
+        return True
+
+    def write_task(self):
+        while True:
+            try:
+                frame = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.finished.is_set():
+                    break
+                continue
+            self.writer.write(frame)
+            self.nb_written_frames += 1
+        self.writer.release()
+
+    def finish(self):
+        '''Ends the video once the queued frames are encoded, without waiting for them'''
+        self.finished.set()
+
+    def close(self):
+        '''Waits for every queued frame to be encoded and releases the video'''
+        if self.thread.is_alive():
+            self.finish()
+            self.thread.join()
+        print(f'{self.path} : {self.nb_written_frames} frames written, {self.nb_dropped_frames} dropped, '
+              f'at most {self.queue_high_water_mark}/{self.queue.maxsize} frames waiting')
+        return self.nb_dropped_frames
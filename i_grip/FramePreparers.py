@@ -0,0 +1,56 @@
+import cv2
+import numpy as np
+
+from i_grip.config import _CAMERA_COLOR_MODE, _FRAME_CONSUMERS_COLOR_MODES
+
+
+class FramePreparer:
+
+    _RGB_MODE = 'RGB'
+    _BGR_MODE = 'BGR'
+    _COLOR_MODES = [_RGB_MODE, _BGR_MODE]
+    _CONVERSIONS = {(_BGR_MODE, _RGB_MODE) : cv2.COLOR_BGR2RGB,
+                    (_RGB_MODE, _BGR_MODE) : cv2.COLOR_RGB2BGR}
+
+    def __init__(self, source_color_mode = _CAMERA_COLOR_MODE, consumers_color_modes = _FRAME_CONSUMERS_COLOR_MODES) -> None:
+        '''Computes, once per frame, every colour variant needed by the consumers of the camera frames.
+        Every variant is read-only and shared between all the consumers asking for the same colour order.'''
+        if source_color_mode not in self._COLOR_MODES:
+            raise ValueError(f'source_color_mode must be one of {self._COLOR_MODES}')
+        for consumer, color_mode in consumers_color_modes.items():
+            if color_mode not in self._COLOR_MODES:
+                raise ValueError(f'color mode of consumer {consumer} must be one of {self._COLOR_MODES}')
+        self.source_color_mode = source_color_mode
+        self.consumers_color_modes = dict(consumers_color_modes)
+        self.needed_color_modes = set(self.consumers_color_modes.values())
+        print(f'FramePreparer: source {self.source_color_mode}, consumers {self.consumers_color_modes}')
+
+    @classmethod
+    def from_camera(cls, rgbd_cam, consumers_color_modes = _FRAME_CONSUMERS_COLOR_MODES):
+        return cls(rgbd_cam.color_mode, consumers_color_modes)
+
+    def get_consumers(self):
+        return list(self.consumers_color_modes.keys())
+
+    def prepare(self, frame):
+        '''Returns a dict consumer -> read-only frame in the colour order expected by the consumer.
+        The input frame itself is left writable.'''
+        if frame is None:
+            return {consumer : None for consumer in self.consumers_color_modes}
+        variants = {}
+        for color_mode in self.needed_color_modes:
+            if color_mode == self.source_color_mode:
+                # a view shares the frame memory but can be made read-only on its own
+                variant = frame.view()
+            else:
+                variant = cv2.cvtColor(frame, self._CONVERSIONS[(self.source_color_mode, color_mode)])
+            variant.flags.writeable = False
+            variants[color_mode] = variant
+        return {consumer : variants[color_mode] for consumer, color_mode in self.consumers_color_modes.items()}
+
+
+def writable(img):
+    '''Returns img if it can be drawn on, a writable copy otherwise'''
+    if img is None or img.flags.writeable:
+        return img
+    return np.array(img)
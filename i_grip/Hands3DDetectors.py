@@ -2,20 +2,58 @@ import mediapipe as mp
 import cv2
 import numpy as np
 import math
+import threading
 import time
-from i_grip.config import _MEDIAPIPE_MODEL_PATH
+from itertools import chain
+from operator import attrgetter
+from i_grip.config import _MEDIAPIPE_MODEL_PATH, _HANDS_ROI_TRACKING_OPTIONS
 # import tensorflow as tf
 # print('TENSORFLOW GPU AVAILABLE:')
 # print(tf.config.list_physical_devices('GPU'))
 
+_NB_LANDMARKS = 21
+
+# fixed layout of one detected hand, to send hands between processes without pickling mediapipe objects
+HAND_RECORD_DTYPE = np.dtype([('label', 'U5'),
+                              ('score', 'f4'),
+                              ('normalized_landmarks', 'f8', (_NB_LANDMARKS, 3)),
+                              ('world_landmarks', 'f8', (_NB_LANDMARKS, 3)),
+                              ('position', 'f8', (3,)),
+                              ('roi', 'i4', (4,)),
+                              ('valid', '?')])
+
+_get_xyz = attrgetter('x', 'y', 'z')
+
+def landmarks_to_array(landmarks):
+    '''Converts a list of mediapipe landmarks to a (n, 3) float array in one pass'''
+    return np.fromiter(chain.from_iterable(map(_get_xyz, landmarks)), dtype=np.float64, count=3*len(landmarks)).reshape(-1, 3)
+
+def remap_landmarks(normalized_landmarks, crop_box, resolution):
+    '''Converts landmarks normalized in the crop (x1, y1, x2, y2) of an image to landmarks normalized in the full image'''
+    x1, y1, x2, y2 = crop_box
+    crop_width, crop_height = x2-x1, y2-y1
+    remapped = np.empty_like(normalized_landmarks)
+    remapped[:,0] = (normalized_landmarks[:,0]*crop_width + x1)/resolution[0]
+    remapped[:,1] = (normalized_landmarks[:,1]*crop_height + y1)/resolution[1]
+    # mediapipe depths are on the same scale as x
+    remapped[:,2] = normalized_landmarks[:,2]*crop_width/resolution[0]
+    return remapped
+
 class Hands3DDetector:
     
     LIVE_STREAM_MODE = 'LIVE_STREAM'
     VIDEO_FILE_MODE = 'VIDEO'
     _HANDS_MODE = ['left', 'right']
     
-    def __init__(self, cam_data, hands = _HANDS_MODE,running_mode = LIVE_STREAM_MODE,  mediapipe_model_path=_MEDIAPIPE_MODEL_PATH, use_gpu=True):
+    def __init__(self, cam_data, hands = _HANDS_MODE,running_mode = LIVE_STREAM_MODE,  mediapipe_model_path=_MEDIAPIPE_MODEL_PATH, use_gpu=True, 
+                 roi_tracking = False, roi_tracking_options = {}, result_callback = None, max_pending_age = 1.):
+        '''In VIDEO mode, roi_tracking runs the landmarker only on crops around the hands found in the previous frame,
+        and falls back to the full image detection when a hand is lost, leaves its crop, or every redetection_interval seconds.
+        In LIVE_STREAM mode, get_hands only submits the frame and returns the last hands found. Frames submitted while the
+        landmarker is busy are dropped. result_callback(records, frame_id, submit_time) is called from the mediapipe thread
+        with every new result. A submitted frame without result after max_pending_age seconds is forgotten'''
         self.cam_data = cam_data
+        self.resolution = cam_data['resolution']
         
         for hand in hands:
             if hand not in self._HANDS_MODE:
@@ -38,12 +76,12 @@ class Hands3DDetector:
             self.get_hands = self.get_hands_live_stream
             self.landmarker_options = mp.tasks.vision.HandLandmarkerOptions(
                 base_options=base_options,
-                running_mode=mp.tasks.vision.RunningMode.VIDEO,
+                running_mode=mp.tasks.vision.RunningMode.LIVE_STREAM,
                 num_hands=self.num_hands,
                 min_hand_presence_confidence=0.5,
                 min_hand_detection_confidence=0.5,
                 min_tracking_confidence=0.5,
-                result_callback=self.extract_hands,
+                result_callback=self.extract_hands_async,
             )
         elif running_mode == self.VIDEO_FILE_MODE:
             self.get_hands = self.get_hands_video
@@ -56,13 +94,40 @@ class Hands3DDetector:
                 min_tracking_confidence=0.5
             )
             
+        self.roi_tracking = roi_tracking and running_mode == self.VIDEO_FILE_MODE
+        self.roi_tracking_options = dict(_HANDS_ROI_TRACKING_OPTIONS)
+        self.roi_tracking_options.update(roi_tracking_options)
+        if self.roi_tracking:
+            # a crop holds a single hand, and consecutive crops are unrelated images
+            self.roi_landmarker_options = mp.tasks.vision.HandLandmarkerOptions(
+                base_options=base_options,
+                running_mode=mp.tasks.vision.RunningMode.IMAGE,
+                num_hands=1,
+                min_hand_presence_confidence=0.5,
+                min_hand_detection_confidence=0.5
+            )
+            
+        self.result_callback = result_callback
+        self.max_pending_age = max_pending_age
+        self.lock = threading.Lock()
+        self.nb_dropped_frames = 0
         self.init_landmarker()
         self.format=mp.ImageFormat.SRGB
         self.stereoInference = StereoInference(self.cam_data)
         
     def init_landmarker(self):
         self.hands_predictions = []
+        self.hands_records = np.zeros(len(self._HANDS_MODE), dtype=HAND_RECORD_DTYPE)
         self.landmarker = mp.tasks.vision.HandLandmarker.create_from_options(self.landmarker_options)
+        if self.roi_tracking:
+            self.roi_landmarker = mp.tasks.vision.HandLandmarker.create_from_options(self.roi_landmarker_options)
+        # label -> crop (x1, y1, x2, y2) in which to look for the hand in the next frame
+        self.tracked_rois = dict()
+        self.last_full_detection = None
+        # timestamp_ms -> (depth frame, frame id, submit time) of the frames submitted to the asynchronous landmarker
+        self.pending = dict()
+        self.last_timestamp_ms = -1
+        self.last_frame_id = -1
         
     def reset(self):
         self.init_landmarker()
@@ -82,9 +147,84 @@ class Hands3DDetector:
                 handedness = handedness_list[idx]
                 label = handedness[0].category_name.lower()
                 if len(hand_landmarks)>0 and self.depth_map is not None and label in self.hands_to_detect and label in self.hands_to_detect:
-                    hand = HandPrediction(handedness, hand_landmarks, hand_world_landmarks, self.depth_map, self.stereoInference)
+                    hand = HandPrediction(handedness, hand_landmarks, hand_world_landmarks, self.depth_map, self.stereoInference, locate=False)
                     hands_preds.append(hand)
-            self.hands_predictions = hands_preds
+            self.locate_hands(hands_preds, self.depth_map)
+            self.set_hands(hands_preds)
+
+    def extract_hands_async(self, detection_result: mp.tasks.vision.HandLandmarkerResult, output_image: mp.Image, timestamp_ms: int):
+        with self.lock:
+            submitted = self.pending.pop(timestamp_ms, None)
+            if submitted is None:
+                # forgotten in the meantime
+                return
+            self.depth_map, frame_id, submit_time = submitted
+            self.extract_hands(detection_result, output_image, timestamp_ms)
+            self.last_frame_id = frame_id
+            if self.result_callback is not None:
+                self.result_callback(self.hands_records, frame_id, submit_time)
+
+    def set_hands(self, hands_preds):
+        self.hands_predictions = hands_preds
+        self.hands_records['valid'] = False
+        for hand, record in zip(hands_preds, self.hands_records):
+            hand.to_record(record)
+        if self.roi_tracking:
+            self.tracked_rois = {hand.label : self.compute_roi(hand) for hand in hands_preds}
+
+    def compute_roi(self, hand):
+        '''Returns the square crop (x1, y1, x2, y2), in pixels, in which to look for hand in the next frame'''
+        x1, y1, x2, y2 = hand.get_bbox(self.resolution)
+        size = max(x2-x1, y2-y1)*(1+2*self.roi_tracking_options['padding'])
+        size = max(size, self.roi_tracking_options['min_crop_size'])
+        cx, cy = (x1+x2)/2, (y1+y2)/2
+        x1, x2 = np.clip([cx-size/2, cx+size/2], 0, self.resolution[0]).astype(int)
+        y1, y2 = np.clip([cy-size/2, cy+size/2], 0, self.resolution[1]).astype(int)
+        return x1, y1, x2, y2
+
+    def can_track(self, timestamp):
+        return (self.roi_tracking and len(self.tracked_rois) > 0 and self.last_full_detection is not None 
+                and timestamp - self.last_full_detection < self.roi_tracking_options['redetection_interval'])
+
+    def track_hands(self, frame, depth_frame):
+        '''Looks for each tracked hand in its crop only. 
+        Returns the new hands predictions, or None if any hand was lost and the full image must be processed'''
+        options = self.roi_tracking_options
+        hands_preds = []
+        for label, crop_box in self.tracked_rois.items():
+            x1, y1, x2, y2 = crop_box
+            if x2-x1 < 2 or y2-y1 < 2:
+                return None
+            mp_image = mp.Image(image_format=self.format, data=np.ascontiguousarray(frame[y1:y2, x1:x2]))
+            result = self.roi_landmarker.detect(mp_image)
+            if len(result.hand_landmarks) == 0:
+                return None
+            handedness = result.handedness[0]
+            if handedness[0].category_name.lower() != label or handedness[0].score < options['min_score']:
+                return None
+            landmarks = landmarks_to_array(result.hand_landmarks[0])
+            margin = options['border_margin']
+            if landmarks[:,:2].min() < margin or landmarks[:,:2].max() > 1-margin:
+                # leaving its crop, the full image is needed to find it
+                return None
+            hands_preds.append(HandPrediction(handedness, result.hand_landmarks[0], result.hand_world_landmarks[0], depth_frame, self.stereoInference, 
+                                              crop_box=crop_box, resolution=self.resolution, locate=False))
+        self.locate_hands(hands_preds, depth_frame)
+        return hands_preds
+
+    def locate_hands(self, hands_preds, depth_map):
+        '''Computes the 3D positions of all the hands at once, from a single depth sampling'''
+        if len(hands_preds) == 0:
+            return
+        points = np.array([hand.hand_point()[0][:2] for hand in hands_preds])
+        positions, rois = self.stereoInference.calc_spatials_batch(points, depth_map)
+        for hand, position, roi in zip(hands_preds, positions, rois):
+            hand.set_position(position, roi)
+
+    def get_hands_records(self):
+        '''Returns the preallocated HAND_RECORD_DTYPE array describing the last detected hands.
+        It is overwritten at each detection, copy it (or write it into shared memory) to keep it'''
+        return self.hands_records
 
     def get_hands_video(self, frame, depth_frame, timestamp):
         if frame is not None and depth_frame is not None:
@@ -93,8 +233,15 @@ class Hands3DDetector:
             # mp_frame = cv2.cvtColor(cv2.flip(self.frame,1), cv2.COLOR_BGR2RGB) 
             # mp_frame = cv2.flip(frame,1)
             # mp_frame=self.frame
+            if self.can_track(timestamp):
+                hands_preds = self.track_hands(frame, depth_frame)
+                if hands_preds is not None:
+                    self.depth_map = depth_frame
+                    self.set_hands(hands_preds)
+                    return self.hands_predictions
             frame_timestamp_ms = round(timestamp*1000)
             mp_image = mp.Image(image_format=self.format, data=frame)
+            self.last_full_detection = timestamp
             print(f'frame_timestamp_ms: {frame_timestamp_ms}')
             landmark_results = self.landmarker.detect_for_video(mp_image, frame_timestamp_ms)
             # landmark_results = self.landmarker.detect(mp_image)
@@ -103,8 +250,21 @@ class Hands3DDetector:
             self.new_frame = False
         return self.hands_predictions
     
-    def get_hands_live_stream(self, frame, depth_frame):
+    def is_busy(self):
+        '''True if a submitted frame is still being processed'''
+        with self.lock:
+            now = time.time()
+            for timestamp_ms, (_, _, submit_time) in list(self.pending.items()):
+                if now - submit_time > self.max_pending_age:
+                    # mediapipe may drop frames without calling back
+                    del self.pending[timestamp_ms]
+            return len(self.pending) > 0
+
+    def get_hands_live_stream(self, frame, depth_frame, timestamp = None, frame_id = -1):
         if frame is not None and depth_frame is not None:
+            if self.is_busy():
+                self.nb_dropped_frames += 1
+                return self.hands_predictions
         # if frame is not None and depthFrame is not None:
             # mp_frame = cv2.cvtColor(cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
             # mp_frame = cv2.cvtColor(cv2.flip(frame,1), cv2.COLOR_BGR2RGB)
@@ -112,34 +272,84 @@ class Hands3DDetector:
             # print('frame.shape', frame.shape)
             # print(frame)
             # mp_frame=self.frame
-            frame_timestamp_ms = round(time.time()*1000)
+            submit_time = time.time()
+            if timestamp is None:
+                timestamp = submit_time
+            # the landmarker requires strictly increasing timestamps
+            frame_timestamp_ms = max(round(timestamp*1000), self.last_timestamp_ms+1)
+            self.last_timestamp_ms = frame_timestamp_ms
             # print('frame_timestamp_ms', frame_timestamp_ms)
             mp_image = mp.Image(image_format=self.format, data=frame)
-            self.depth_map = depth_frame
+            with self.lock:
+                self.pending[frame_timestamp_ms] = (depth_frame, frame_id, submit_time)
             self.landmarker.detect_async(mp_image, frame_timestamp_ms)
             self.new_frame = False
         return self.hands_predictions
 
+    def stop(self):
+        self.landmarker.close()
+        if self.roi_tracking:
+            self.roi_landmarker.close()
+
 
 class HandPrediction:
-    def __init__(self, handedness, landmarks, world_landmarks, depth_map, stereo_inference) -> None:
+    def __init__(self, handedness, landmarks, world_landmarks, depth_map, stereo_inference, crop_box = None, resolution = None, locate = True) -> None:
+        '''crop_box (x1, y1, x2, y2) is the crop of the image of given resolution in which landmarks were detected, if any.
+        If locate is False, the 3D position is left to be set with set_position (e.g. computed for several hands at once)'''
         self.handedness = handedness
-        self.normalized_landmarks = np.array([[l.x,l.y,l.z] for l in landmarks])
+        self.score = handedness[0].score
+        self.normalized_landmarks = landmarks_to_array(landmarks)
+        if crop_box is not None:
+            self.normalized_landmarks = remap_landmarks(self.normalized_landmarks, crop_box, resolution)
         # self.landmarks = np.array([[max(min(1-l.x,1.),0.)*img_res[0], max(min(l.y,1.),0.)*img_res[1], l.z] for l in landmarks])
         # self.normalized_landmarks = landmarks
         # print('landmarks', landmarks)
         # print('world_landmarks', world_landmarks)
-        self.world_landmarks = np.array([[l.x,-l.y,l.z] for l in world_landmarks])*1000
+        self.world_landmarks = landmarks_to_array(world_landmarks)*np.array([1000., -1000., 1000.])
         # print('self.world_landmarks', self.world_landmarks)
         # self.world_landmarks = np.array([[l.x*img_res[0], l.y*img_res[1], l.z] for l in world_landmarks])
         self.label = handedness[0].category_name.lower()
-        hand_point2D, hand_point3D = self.hand_point()
-        self.position, self.roi = stereo_inference.calc_spatials(hand_point2D, depth_map)
+        self.position, self.roi = None, None
+        if locate:
+            hand_point2D, _ = self.hand_point()
+            position, roi = stereo_inference.calc_spatials(hand_point2D, depth_map)
+            self.set_position(position, roi)
+
+    def set_position(self, position, roi):
+        _, hand_point3D = self.hand_point()
+        self.position, self.roi = position, roi
         #add self.position to every world_landmarks lines
         hand_center = self.position.copy()
         # hand_center[1] = -hand_center[1]
         self.world_landmarks = self.world_landmarks + hand_center - hand_point3D
         # self.position = self.position/1000
+
+    @classmethod
+    def from_record(cls, record):
+        '''Rebuilds a HandPrediction from a HAND_RECORD_DTYPE record, its arrays being views of the record'''
+        hand = cls.__new__(cls)
+        hand.handedness = None
+        hand.label = str(record['label'])
+        hand.score = float(record['score'])
+        hand.normalized_landmarks = record['normalized_landmarks']
+        hand.world_landmarks = record['world_landmarks']
+        hand.position = record['position']
+        hand.roi = tuple(record['roi'].tolist())
+        return hand
+
+    @classmethod
+    def from_records(cls, records):
+        return [cls.from_record(record) for record in records if record['valid']]
+
+    def to_record(self, record):
+        record['label'] = self.label
+        record['score'] = self.score
+        record['normalized_landmarks'] = self.normalized_landmarks
+        record['world_landmarks'] = self.world_landmarks
+        record['position'] = self.position
+        record['roi'] = self.roi if self.roi is not None else (0, 0, 0, 0)
+        record['valid'] = True
+        return record
         
     def hand_point(self):
         # hand_point2D = self.normalized_landmarks[0,:] # wrist
@@ -151,6 +361,12 @@ class HandPrediction:
     def get_landmarks(self):
         return self.normalized_landmarks
     
+    def get_bbox(self, resolution):
+        '''Returns the (x1, y1, x2, y2) box of the hand landmarks, in pixels'''
+        xs = self.normalized_landmarks[:,0]*resolution[0]
+        ys = self.normalized_landmarks[:,1]*resolution[1]
+        return xs.min(), ys.min(), xs.max(), ys.max()
+    
 
 class StereoInference:
     def __init__(self, cam_data) -> None:
@@ -164,6 +380,9 @@ class StereoInference:
         self.depth_thres_high = 3000
         self.depth_thres_low = 50
         self.box_size = 10
+        # pixel offset to lateral position ratio, per mm of depth
+        self.tan_ratio = math.tan(self.hfov / 2.0) / (self.original_width / 2.0)
+        self.box_offsets = np.arange(2*self.box_size)
 
 
     def calc_angle(self, offset):
@@ -216,5 +435,45 @@ class StereoInference:
 
         # print(f"DEPTH MAP --- X: {x/10:3.0f}cm, Y: {y/10:3.0f} cm, Z: {z/10:3.0f} cm")
         return np.array([x,y,z]), (xmin, ymin, xmax, ymax)
+
+    def calc_boxes_bounds(self, centers, size):
+        '''Bounds [min, max) along an axis of size pixels of the boxes around centers (px), clamped exactly as in calc_spatials.
+        A box spans at most 2*box_size pixels of the image'''
+        low = np.maximum(np.trunc(centers-self.box_size).astype(int), 0)
+        high = np.minimum(np.trunc(centers+self.box_size).astype(int), size)
+        # bbox flipped
+        low, high = np.minimum(low, high), np.maximum(low, high)
+        high = np.where(low == high, low+self.box_size, high)
+        return low, high
+
+    def calc_spatials_batch(self, normalized_img_points, depth_map):
+        '''Vectorised calc_spatials (mean averaging) for n normalized image points at once.
+        The fixed size boxes around all the points are gathered in a single indexing, so the cost only depends on the number of points.
+        Returns the (n, 3) positions and the (n, 4) boxes (xmin, ymin, xmax, ymax)'''
+        n = len(normalized_img_points)
+        if depth_map is None:
+            print('No depth map available yet')
+            return np.zeros((n, 3)), [None]*n
+        height, width = depth_map.shape[:2]
+        points = np.asarray(normalized_img_points, dtype=np.float64)[:, :2]
+        x = points[:, 0]*self.original_width
+        y = points[:, 1]*self.original_height
+        xmin, xmax = self.calc_boxes_bounds(x, width)
+        ymin, ymax = self.calc_boxes_bounds(y, height)
+        xs = xmin[:, None] + self.box_offsets
+        ys = ymin[:, None] + self.box_offsets
+        # pixels of depth_map[ymin:ymax, xmin:xmax], a negative min only occurs with a null max (empty slice)
+        in_image = ((xs >= 0) & (xs < np.minimum(xmax, width)[:, None]))[:, None, :] & ((ys >= 0) & (ys < np.minimum(ymax, height)[:, None]))[:, :, None]
+        patches = depth_map[np.clip(ys, 0, height-1)[:, :, None], np.clip(xs, 0, width-1)[:, None, :]].astype(np.float64)
+        valid = in_image & (self.depth_thres_low < patches) & (patches < self.depth_thres_high)
+        counts = valid.sum(axis=(1, 2))
+        z = np.where(valid, patches, 0).sum(axis=(1, 2))/np.maximum(counts, 1)
+        
+        positions = np.empty((n, 3))
+        positions[:, 0] = z*self.tan_ratio*(x - int(width / 2))
+        positions[:, 1] = -z*self.tan_ratio*(y - int(height / 2))
+        positions[:, 2] = z
+        rois = [tuple(roi) for roi in np.stack([xmin, ymin, xmax, ymax], axis=1).tolist()]
+        return positions, rois
     
 
@@ -35,20 +35,21 @@ class GraspingHandTrajectory(Trajectory):
     def from_dataframe(cls, df: pd.DataFrame, headers_list=DEFAULT_DATA_KEYS, attributes_dict=None, limit_size=None):
         return cls(dataframe = df, headers_list=headers_list, attributes_dict=attributes_dict, limit_size=limit_size)
     
+    # columns read when replaying the trajectory : position, then timestamp
+    REPLAY_KEYS = ('x', 'y', 'z', 'Timestamps')
+
     def __next__(self):
         if self.current_line_index < len(self.data):
-            row = self.data.iloc[self.current_line_index]
-            # print(f'data : {self.data}')
-            # print('row', row)
+            row = self.get_values(self.REPLAY_KEYS)[self.current_line_index]
             self.current_line_index+=1
-            return Position(np.array([row['x'], row['y'], row['z']]), display='cm', swap_y=True), row['Timestamps']
+            return Position(np.array(row[:3]), display='cm', swap_y=True), row[3]
         else:
             raise StopIteration
         
     def __getitem__(self, index):
         if index < len(self.data):
-            row = self.data.iloc[index]
-            return Position(np.array([row['x'], row['y'], row['z']]), display='cm', swap_y=True), row['Timestamps']
+            row = self.get_values(self.REPLAY_KEYS)[index]
+            return Position(np.array(row[:3]), display='cm', swap_y=True), row[3]
         else:
             raise IndexError('Index out of range')
     
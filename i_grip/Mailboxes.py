@@ -0,0 +1,201 @@
+import io
+import multiprocessing
+import pickle
+
+import numpy as np
+
+
+class _HostPickler(pickle.Pickler):
+    '''Plain pickler refusing values living on a device (e.g. CUDA tensors) : mailboxes only carry host data'''
+
+    def reducer_override(self, obj):
+        device = getattr(obj, 'device', None)
+        if device is not None and getattr(device, 'type', 'cpu') != 'cpu':
+            raise ValueError(f'{type(obj).__name__} on {device} cannot be put in a mailbox, copy it to host memory first')
+        return NotImplemented
+
+
+class LatestValueMailbox:
+
+    _DEFAULT_CAPACITY = 1 << 20 # 1 MB
+
+    def __init__(self, capacity = _DEFAULT_CAPACITY, name = None, ctx = None) -> None:
+        '''Cross-process mailbox holding only the latest value written into it.
+        Writing overwrites the previous value, whether it was read or not, and increments a sequence number.
+        Readers keep the sequence number of the last value they read and ask for a newer one.
+        Must be built before the processes using it are started, and passed to them as an argument.
+        Values are copied into the mailbox : only host data (numpy arrays, DataFrames, plain objects) can be put, 
+        no handle to device or shared memory is passed, since an overwritten value may never be read.'''
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+        self.name = name
+        self.capacity = int(capacity)
+        self._buffer = ctx.RawArray('B', self.capacity)
+        self._size = ctx.RawValue('Q', 0)
+        self._seq = ctx.RawValue('Q', 0)
+        self._closed = ctx.RawValue('b', 0)
+        self._frame_id = ctx.RawValue('q', -1)
+        self._cond = ctx.Condition()
+        self._signals = []
+        # id of the camera frame the last value read by this process comes from
+        self.last_frame_id = -1
+
+    def attach(self, signal):
+        '''Makes every write (and closing) of this mailbox notify signal.
+        Must be called before the processes using the mailbox are started'''
+        self._signals.append(signal)
+        return self
+
+    def put(self, value, frame_id = -1):
+        '''Overwrites the current value, wakes up every waiting reader and returns the new sequence number.
+        frame_id is the id of the camera frame the value comes from, readable by readers in last_frame_id'''
+        payload = self._encode(value)
+        with self._cond:
+            self._write_payload(payload)
+            self._frame_id.value = frame_id
+            self._seq.value += 1
+            seq = self._seq.value
+            self._cond.notify_all()
+        for signal in self._signals:
+            signal.notify()
+        return seq
+
+    def get(self):
+        '''Returns (seq, value) of the latest value, (0, None) if nothing was ever written'''
+        with self._cond:
+            seq = self._seq.value
+            payload = self._read_payload() if seq > 0 else None
+            self.last_frame_id = self._frame_id.value
+        return seq, self._decode(payload)
+
+    def get_seq(self):
+        return self._seq.value
+
+    def poll(self, seq):
+        '''Non-blocking version of wait_newer'''
+        if self._seq.value <= seq:
+            return seq, None
+        return self.get()
+
+    def wait_newer(self, seq, timeout = None):
+        '''Blocks until a value newer than seq is available, the mailbox is closed or timeout (in s) expires.
+        Returns (new_seq, value) or (seq, None) if no newer value is available'''
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq.value > seq or self._closed.value, timeout)
+            if self._seq.value <= seq:
+                return seq, None
+            new_seq = self._seq.value
+            payload = self._read_payload()
+            self.last_frame_id = self._frame_id.value
+        return new_seq, self._decode(payload)
+
+    def close(self):
+        '''Wakes up every waiting reader, for good'''
+        with self._cond:
+            self._closed.value = 1
+            self._cond.notify_all()
+        for signal in self._signals:
+            signal.notify()
+
+    def is_closed(self):
+        return bool(self._closed.value)
+
+    def _encode(self, value):
+        buffer = io.BytesIO()
+        _HostPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(value)
+        return buffer.getvalue()
+
+    def _write_payload(self, payload):
+        size = len(payload)
+        if size > self.capacity:
+            raise ValueError(f'Mailbox {self.name} : value of {size} bytes exceeds mailbox capacity of {self.capacity} bytes')
+        memoryview(self._buffer).cast('B')[:size] = payload
+        self._size.value = size
+
+    def _read_payload(self):
+        return bytes(memoryview(self._buffer).cast('B')[:self._size.value])
+
+    def _decode(self, payload):
+        if payload is None:
+            return None
+        return pickle.loads(payload)
+
+    def __repr__(self) -> str:
+        return f'LatestValueMailbox({self.name}, seq={self._seq.value}, capacity={self.capacity})'
+
+
+class LatestArrayMailbox(LatestValueMailbox):
+
+    def __init__(self, dtype, shape, name = None, ctx = None) -> None:
+        '''Latest value mailbox for numpy arrays of fixed dtype and shape (e.g. structured records).
+        Values are copied straight into shared memory and read back as copies, without pickling.'''
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(np.atleast_1d(shape))
+        super().__init__(self.dtype.itemsize*int(np.prod(self.shape)), name=name, ctx=ctx)
+
+    def _shared_array(self):
+        return np.frombuffer(self._buffer, dtype=self.dtype).reshape(self.shape)
+
+    def _encode(self, value):
+        value = np.asarray(value, dtype=self.dtype)
+        if value.shape != self.shape:
+            raise ValueError(f'Mailbox {self.name} : expected an array of shape {self.shape}, got {value.shape}')
+        return value
+
+    def _write_payload(self, payload):
+        np.copyto(self._shared_array(), payload)
+        self._size.value = self.capacity
+
+    def _read_payload(self):
+        return self._shared_array().copy()
+
+    def _decode(self, payload):
+        return payload
+
+    def __repr__(self) -> str:
+        return f'LatestArrayMailbox({self.name}, seq={self._seq.value}, dtype={self.dtype}, shape={self.shape})'
+
+
+class ReadinessSignal:
+
+    def __init__(self, name = None, ctx = None) -> None:
+        '''Cross-process signal waking up a consumer as soon as any of the mailboxes attached to it receives a new value, 
+        or when it is stopped. Lets a consumer with several inputs block instead of polling each of them.'''
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+        self.name = name
+        self._count = ctx.RawValue('Q', 0)
+        self._stopped = ctx.RawValue('b', 0)
+        self._cond = ctx.Condition()
+
+    def notify(self):
+        with self._cond:
+            self._count.value += 1
+            self._cond.notify_all()
+
+    def wait(self, count = 0, timeout = None):
+        '''Blocks until something was notified since count, the signal is stopped or timeout (in s) expires.
+        Returns the new count, to be passed to the next call'''
+        with self._cond:
+            self._cond.wait_for(lambda: self._count.value > count or self._stopped.value, timeout)
+            return self._count.value
+
+    def stop(self):
+        with self._cond:
+            self._stopped.value = 1
+            self._cond.notify_all()
+
+    def is_stopped(self):
+        return bool(self._stopped.value)
+
+    def __repr__(self) -> str:
+        return f'ReadinessSignal({self.name}, count={self._count.value})'
+
+
+def frame_mailbox_capacity(resolution, nb_channels = 3, with_depth = False, margin = 1 << 16):
+    '''Bytes needed to send one uint8 image (and optionally one uint16 depth map) of the given resolution'''
+    nb_pixels = int(resolution[0])*int(resolution[1])
+    capacity = nb_pixels*nb_channels
+    if with_depth:
+        capacity += nb_pixels*2
+    return capacity + margin
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+from i_grip.config import _OBJECT_MOTION_GATE_OPTIONS
+
+
+class ObjectMotionGate:
+
+    REASON_NEW = 'new'
+    REASON_MOTION = 'motion'
+    REASON_OCCLUSION = 'occlusion'
+    REASON_AGE = 'age'
+
+    def __init__(self, options = _OBJECT_MOTION_GATE_OPTIONS) -> None:
+        '''Decides which objects need their pose re-estimated, from the image change inside their last box.
+        An object is refreshed when its box content changed, when a hand overlaps it, or when its pose is too old.
+        Boxes are (x1, y1, x2, y2) in pixels of the full resolution image.'''
+        self.options = dict(_OBJECT_MOTION_GATE_OPTIONS)
+        self.options.update(options)
+        self.downscale = self.options['downscale']
+        self.reset()
+
+    def reset(self):
+        # label -> (reference crop, box in downscaled pixels, timestamp of the estimation)
+        self.references = dict()
+        self.gray = None
+
+    def prepare(self, image):
+        '''Computes the downscaled grey image used for all the boxes of the frame'''
+        if image.ndim == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            gray = image
+        self.gray = cv2.resize(gray, (gray.shape[1]//self.downscale, gray.shape[0]//self.downscale), interpolation=cv2.INTER_AREA)
+        return self.gray
+
+    def scale_box(self, box):
+        h, w = self.gray.shape
+        x1, y1, x2, y2 = (np.asarray(box, dtype=np.float64)/self.downscale).astype(int)
+        x1, x2 = np.clip([x1, x2], 0, w)
+        y1, y2 = np.clip([y1, y2], 0, h)
+        return x1, y1, x2, y2
+
+    def update_reference(self, label, box, timestamp):
+        '''Stores the content of box in the current frame as reference for label, after its pose was estimated'''
+        x1, y1, x2, y2 = self.scale_box(box)
+        self.references[label] = (self.gray[y1:y2, x1:x2].copy(), (x1, y1, x2, y2), timestamp)
+
+    def forget(self, label):
+        self.references.pop(label, None)
+
+    def get_age(self, label, timestamp):
+        if label not in self.references:
+            return None
+        return timestamp - self.references[label][2]
+
+    def has_moved(self, label):
+        reference, (x1, y1, x2, y2), _ = self.references[label]
+        if reference.size == 0:
+            return True
+        diff = cv2.absdiff(self.gray[y1:y2, x1:x2], reference)
+        changed = np.count_nonzero(diff > self.options['pixel_threshold'])
+        return changed > self.options['changed_fraction']*diff.size
+
+    def is_occluded(self, label, occluders):
+        _, (x1, y1, x2, y2), _ = self.references[label]
+        margin = self.options['occluder_margin']/self.downscale
+        for occluder in occluders:
+            ox1, oy1, ox2, oy2 = np.asarray(occluder, dtype=np.float64)/self.downscale
+            if ox1-margin < x2 and x1 < ox2+margin and oy1-margin < y2 and y1 < oy2+margin:
+                return True
+        return False
+
+    def select(self, labels, timestamp, occluders = ()):
+        '''Returns a dict label -> reason for every label of labels whose pose must be re-estimated.
+        prepare must have been called on the current frame'''
+        to_refresh = {}
+        for label in labels:
+            if label not in self.references:
+                to_refresh[label] = self.REASON_NEW
+            elif self.get_age(label, timestamp) > self.options['max_age']:
+                to_refresh[label] = self.REASON_AGE
+            elif self.is_occluded(label, occluders):
+                to_refresh[label] = self.REASON_OCCLUSION
+            elif self.has_moved(label):
+                to_refresh[label] = self.REASON_MOTION
+        return to_refresh
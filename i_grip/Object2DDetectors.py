@@ -3,16 +3,34 @@ import torch
 import os
 import numpy as np
 from i_grip.model_utils import load_detector
+from i_grip.image_utils import ImageTensorConverter
+from i_grip.inference_utils import get_inference_options, setup_inference, inference_context, LatencyMeter
 import cv2
 import torch.multiprocessing as mp
 from i_grip.config import _YCVB_MESH_PATH, _TLESS_MESH_PATH, TLESS_DETECTOR_ID, YCVB_DETECTOR_ID
+from cosypose.utils.tensor_collection import PandasTensorCollection
 
 mp = mp.get_context('spawn')
+
+
+def detections_to_host(detections):
+    '''Copies detections to host memory, as a dict of their infos DataFrame and their tensors as numpy arrays, 
+    e.g. to send them to another process'''
+    return dict(infos=detections.infos, tensors={key: tensor.cpu().numpy() for key, tensor in detections.tensors.items()})
+
+def detections_from_host(host_detections, device):
+    '''Rebuilds the detections copied by detections_to_host, with their tensors on device'''
+    tensors = {key: torch.as_tensor(array, device=device) for key, array in host_detections['tensors'].items()}
+    return PandasTensorCollection(infos=host_detections['infos'], **tensors)
+
 class Object2DDetector:
     def __init__(self, dataset,
                  cam_data,
-                 detection_threshold=0.8):
+                 detection_threshold=0.8,
+                 inference_options=None):
         print('Building Object2DDetector')
+        self.inference_options = get_inference_options(inference_options)
+        self.device = setup_inference(self.inference_options)
         self.dataset = dataset
         if(dataset == "ycbv"):
             object_detector_run_id = TLESS_DETECTOR_ID
@@ -26,8 +44,10 @@ class Object2DDetector:
         print('dataset',dataset)
         print('object_detector_run_id',object_detector_run_id)
         self.img_resolution = cam_data['resolution']
-        os.system('nvidia-smi | grep python')
-        self.detector = load_detector(object_detector_run_id)
+        if self.device.type == 'cuda':
+            os.system('nvidia-smi | grep python')
+        self.detector = load_detector(object_detector_run_id, device=self.device, channels_last=self.inference_options['channels_last'])
+        self.image_converter = ImageTensorConverter(self.device, channels_last=self.inference_options['channels_last'])
         #os.system("nvidia-smi | grep 'python' | awk '{ print $5 }' | xargs -n1 kill -9")
         #os.system('nvidia-smi | grep python')
         # self.detector_windows = load_detector(object_detector_run_id) 
@@ -42,10 +62,25 @@ class Object2DDetector:
         self.prediction_score_threshold = 0.8
         self.detections = None
         self.it =0
+        self.latency_meter = LatencyMeter('Object2DDetector', report_every=self.inference_options['report_latency_every'])
+        self.warmup(self.inference_options['warmup_iterations'])
         print('Object2DDetector built')
 
+    def warmup(self, nb_iterations):
+        '''Runs the detector on blank images, so that the first real frames do not pay for lazy initialisations'''
+        if nb_iterations <= 0:
+            return
+        image = np.zeros((int(self.img_resolution[1]), int(self.img_resolution[0]), 3), dtype=np.uint8)
+        for _ in range(nb_iterations):
+            self.detect(image)
+        self.detections = None
+        self.latency_meter.report()
+        self.latency_meter.latencies.clear()
+        print(f'Object2DDetector warmed up ({nb_iterations} iterations)')
+
     def forward_pass_full_detector(self):
-        self.detections = self.detector(self.image_full,**self.detector_kwargs)
+        with self.latency_meter.measure(self.device), inference_context(self.inference_options, self.device):
+            self.detections = self.detector(self.image_full,**self.detector_kwargs)
 
     def forward_pass_windows_detector(self):
         self.detections_windows = self.detector_windows(self.image_full,**self.detector_kwargs)
@@ -73,7 +108,7 @@ class Object2DDetector:
         
         # os.system('nvidia-smi | grep python')
         # self.image_full = torch.as_tensor(np.stack([image, ])).pin_memory().cuda().float() / 255
-        self.image_full = torch.as_tensor(np.stack([image, ])).permute(0, 3, 1, 2).cuda().float() / 255
+        self.image_full = self.image_converter(image)
         # print('models loaded, not run yet : ')
         # os.system('nvidia-smi | grep python')
         if self.detecting:
@@ -161,7 +196,7 @@ class Object2DDetector:
         
         # os.system('nvidia-smi | grep python')
         # self.image_full = torch.as_tensor(np.stack([image, ])).pin_memory().cuda().float() / 255
-        self.image_full = torch.as_tensor(np.stack([image, ])).permute(0, 3, 1, 2).cuda().float() / 255
+        self.image_full = torch.as_tensor(np.stack([image, ])).permute(0, 3, 1, 2).to(self.device).float() / 255
         # print('models loaded, not run yet : ')
         # os.system('nvidia-smi | grep python')
         if self.detecting:
@@ -194,7 +229,7 @@ class Object2DDetector:
                 ids = filtered_det_win_infos.index
                 im_ids = [i - 1 for i in filtered_det_win_infos['batch_im_id']]
                 gaps = [[w[0][0], w[0][0], w[1][0], w[1][0]] for w in [self.windows[j] for j in im_ids]]
-                gaps = torch.as_tensor(gaps).cuda().float()
+                gaps = torch.as_tensor(gaps).to(self.device).float()
                 print(filtered_det_win_infos)
                 print(gaps)
                 det_win_tensors = detections_windows.tensors['bboxes']
@@ -272,8 +307,8 @@ def find_overlapping_windows(res, max_obj_size, window_size):
     #     width_filled = True
     # while not width_filled:
     #     x=0
-def get_object_detector( dataset, cam_data):
+def get_object_detector( dataset, cam_data, inference_options = None):
 
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
-    detector = Object2DDetector(dataset, cam_data)
+    detector = Object2DDetector(dataset, cam_data, inference_options=inference_options)
     return detector
\ No newline at end of file
@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 import torch
 import os
+import time
 import cv2
 import numpy as np
 import pandas as pd
-from i_grip.image_utils import make_cameras
+from i_grip.image_utils import make_cameras, ImageTensorConverter
 from i_grip.model_utils import load_pose_predictor
-from cosypose.utils.tensor_collection import PandasTensorCollection
-from i_grip.config import TLESS_COARSE_ESTIMATOR_ID, TLESS_REFINER_ESTIMATOR_ID, YCVB_COARSE_ESTIMATOR_ID, YCVB_REFINER_ESTIMATOR_ID
+from i_grip.inference_utils import get_inference_options, setup_inference, inference_context, LatencyMeter
+from cosypose.utils.tensor_collection import PandasTensorCollection, concatenate
+from i_grip.MotionGates import ObjectMotionGate
+from i_grip.config import _POSE_REFINEMENT_OPTIONS, TLESS_COARSE_ESTIMATOR_ID, TLESS_REFINER_ESTIMATOR_ID, YCVB_COARSE_ESTIMATOR_ID, YCVB_REFINER_ESTIMATOR_ID
 
 
 class KnownObjectPoseEstimator:
     def __init__(self, dataset, cam_data, render_txt =False, render_overlay = False, render_bboxes = True, 
-                    use_tracking = True, fuse_detections = True):
+                    use_tracking = True, fuse_detections = True, inference_options = None, motion_gating = True, motion_gate_options = {}, refinement_options = {}):
         print('Building KnownObjectPoseEstimator')
+        self.inference_options = get_inference_options(inference_options)
+        self.device = setup_inference(self.inference_options)
         cam_mat = cam_data['matrix']
         img_resolution = cam_data['resolution']
         self.render_txt = render_txt
@@ -47,13 +52,25 @@ class KnownObjectPoseEstimator:
         self.pose_predictor = load_pose_predictor(object_coarse_run_id,
                                                   object_refiner_run_id,
                                                   preload_cache=True,
-                                                  n_workers=6 )
+                                                  n_workers=6,
+                                                  device=self.device,
+                                                  channels_last=self.inference_options['channels_last'])
         self.use_prior = use_tracking
         self.threshold_nb_iter = 20
 
-        self.K = self.cameras.K.cuda().float()
-        self.n_refiner_iterations = 1
-        # self.emptyPrediction = KnownObjectPoseEstimator.emptyPrediction()
+        # built once, shared by every call
+        self.K = self.cameras.K.to(self.device).float()
+        self.image_converter = ImageTensorConverter(self.device, channels_last=self.inference_options['channels_last'])
+        # the refiner is run one iteration at a time, until the poses stop moving
+        self.refinement_options = dict(_POSE_REFINEMENT_OPTIONS)
+        self.refinement_options.update(refinement_options)
+        self.refinement_stats = dict()
+        self.refinement_iterations = dict()
+        self.nb_refinements = 0
+        self.nb_refiner_iterations = 0
+        # reused pinned host buffer receiving the poses and boxes of all objects of a frame at once
+        self.host_buffer = None
+        # self.emptyPrediction = self.emptyPrediction()
 
         self.scene_objects = dict()
         self.fuse_detections = fuse_detections
@@ -61,25 +78,61 @@ class KnownObjectPoseEstimator:
             self.predict = self.pose_predictor.get_predictions_fused
         else:
             self.predict = self.pose_predictor.get_predictions
+        self.img_resolution = img_resolution
+        # skips the re-estimation of the objects whose image did not change
+        self.motion_gate = ObjectMotionGate(motion_gate_options) if motion_gating and use_tracking else None
+        self.latency_meter = LatencyMeter('KnownObjectPoseEstimator', report_every=self.inference_options['report_latency_every'])
+        self.warmup(self.inference_options['warmup_iterations'])
         self.reset()
         print('KnownObjectPoseEstimator built')
         
+    def warmup(self, nb_iterations):
+        '''Runs the coarse and refiner models on a blank image with a fake detection,
+        so that the first real frames do not pay for lazy initialisations'''
+        if nb_iterations <= 0:
+            return
+        width, height = int(self.img_resolution[0]), int(self.img_resolution[1])
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        label = self.pose_predictor.coarse_model.mesh_db.infos['label'].iloc[0]
+        detections = PandasTensorCollection(infos=pd.DataFrame(dict(label=[label], batch_im_id=[0], score=[1.])),
+                                            bboxes=torch.tensor([[width/4, height/4, 3*width/4, 3*height/4]], 
+                                                                dtype=torch.float32, device=self.device))
+        for _ in range(nb_iterations):
+            self.reset()
+            self.estimate(image, detections=detections)
+        self.latency_meter.report()
+        self.latency_meter.latencies.clear()
+        self.nb_refinements = 0
+        self.nb_refiner_iterations = 0
+        print(f'KnownObjectPoseEstimator warmed up ({nb_iterations} iterations)')
+        
     def reset(self):
         self.pose_estimation_prior = None
         self.pose_predictions = None
+        self.objects_cache = dict()
+        self.refinement_stats = dict()
+        self.refinement_iterations = dict()
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
         self.it = 0
     
-    def estimate(self, image, detections = None):
+    def estimate(self, image, detections = None, occluders = (), timestamp = None):
+        '''Returns a dict label -> ObjectPoseEstimation.
+        When tracking, only the objects selected by the motion gate are re-estimated, the others keep their last pose, 
+        and the age of their estimation. occluders are (x1, y1, x2, y2) boxes (e.g. hands) forcing the refresh of the objects they overlap'''
         if image is None:
             return {}
+        if timestamp is None:
+            timestamp = time.time()
         # Predict poses using cosypose
         #print(detections)
         # print(f'pose_estimation_prior {self.pose_estimation_prior}')
         # print(f'detections {detections.bboxes}')
         predict = self.pose_estimation_prior is not None or detections is not None
+        refreshed_predictions = None
         if predict:
-            # image = torch.as_tensor(np.stack([self.format_crop(image), ])).permute(0, 3, 1, 2).cuda().float() / 255
-            img = torch.as_tensor(np.stack([image, ])).permute(0, 3, 1, 2).cuda().float() / 255
+            if self.motion_gate is not None:
+                self.motion_gate.prepare(image)
             # cv2.imwrite('/home/emoullet/GitHub/i-GRIP/tset/img.png', image)
             # save detections.bboxes as file
             # np.savetxt('/home/emoullet/GitHub/i-GRIP/tset/detections.txt', detections.copy().cpu().bboxes)
@@ -95,8 +148,14 @@ class KnownObjectPoseEstimator:
 
             if self.pose_estimation_prior is None or self.fuse_detections:
                 n_coarse_iterations=1
+                prior = self.pose_estimation_prior
+                kept_prior = None
+                self.objects_cache = dict()
+                if self.motion_gate is not None:
+                    self.motion_gate.reset()
             else:
                 n_coarse_iterations = 0
+                prior, kept_prior = self.gate_prior(self.pose_estimation_prior, occluders, timestamp)
             # inps = dict(
             #     images=img, K=self.K,
             #     data_TCO_init=self.pose_estimation_prior,
@@ -104,13 +163,18 @@ class KnownObjectPoseEstimator:
             #     n_refiner_iterations=self.n_refiner_iterations,
             #     detections=detections)
             # print(f'inps : {inps}')
-            self.pose_predictions, _ = self.predict(
-                images=img, K=self.K,
-                data_TCO_init=self.pose_estimation_prior,
-                n_coarse_iterations=n_coarse_iterations,
-                n_refiner_iterations=self.n_refiner_iterations,
-                detections=detections
-            )
+            if prior is None and n_coarse_iterations == 0:
+                # nothing moved, the networks are not run
+                self.pose_predictions = kept_prior
+            else:
+                # image = torch.as_tensor(np.stack([self.format_crop(image), ])).permute(0, 3, 1, 2).cuda().float() / 255
+                img = self.image_converter(image)
+                with self.latency_meter.measure(self.device), inference_context(self.inference_options, self.device):
+                    refreshed_predictions = self.refine(img, prior, n_coarse_iterations, detections)
+                if kept_prior is not None:
+                    self.pose_predictions = concatenate([refreshed_predictions, kept_prior])
+                else:
+                    self.pose_predictions = refreshed_predictions
             # print('ITER')
             # print(self.pose_predictions.poses)
             # print(self.pose_predictions.poses_input)
@@ -132,16 +196,150 @@ class KnownObjectPoseEstimator:
             #     self.nb_iter_without_detection = 0
             #     self.pose_estimation_prior = None
             #     self.detect = True          
+        if self.pose_predictions is None:
+            self.objects_cache = dict()
+            return {}
+        if refreshed_predictions is not None:  
+            poses, render_boxes, updates = self.predictions_to_host(refreshed_predictions)
+            labels = refreshed_predictions.infos['label'].tolist()
+            self.update_refinement_stats(labels, updates)
+            scores = refreshed_predictions.infos['score'].tolist()
+            for label, pose, render_box, score in zip(labels, poses, render_boxes, scores):
+                self.objects_cache[label] = ObjectPoseEstimation(label, pose, render_box, score, self.dataset, 
+                                                                 refinement=self.refinement_stats.get(label))
+                if self.motion_gate is not None:
+                    self.motion_gate.update_reference(label, render_box, timestamp)
         objects_predictions = {}
-        if self.pose_predictions is not None:  
-            for n in range(len(self.pose_predictions)):
-                label=self.pose_predictions.infos.loc[n, 'label']
-                pose=self.pose_predictions.poses[n]
-                render_box=self.pose_predictions.boxes_rend[n]                
-                score=self.pose_predictions.infos['score'][n]
-                objects_predictions[label] = ObjectPoseEstimation(label, pose, render_box, score, self.dataset)
+        for label, object_prediction in self.objects_cache.items():
+            if self.motion_gate is not None:
+                object_prediction.age = self.motion_gate.get_age(label, timestamp)
+            objects_predictions[label] = object_prediction
         return objects_predictions
     
+    def refine(self, images, prior, n_coarse_iterations, detections):
+        '''Runs the coarse model if asked for, then the refiner one iteration at a time. 
+        An object leaves the batch as soon as its pose update falls below the convergence thresholds, 
+        and the refinement stops when every object converged or after max_iterations 
+        (tracking_max_iterations when starting from the previous poses). 
+        The updates are only brought to host memory between two iterations : with a budget of 1 iteration nothing is measured here.
+        Iterations of each object are stored in refinement_iterations, their last updates are measured by predictions_to_host'''
+        options = self.refinement_options
+        if n_coarse_iterations > 0:
+            max_iterations = options['max_iterations']
+        else:
+            max_iterations = options['tracking_max_iterations']
+        predictions, _ = self.predict(
+            images=images, K=self.K,
+            data_TCO_init=prior,
+            n_coarse_iterations=n_coarse_iterations,
+            n_refiner_iterations=1,
+            detections=detections
+        )
+        finished = []
+        self.refinement_iterations = dict()
+        for iteration in range(1, max_iterations+1):
+            if iteration == max_iterations:
+                finished.append(predictions)
+                self.refinement_iterations.update({label: iteration for label in predictions.infos['label'].tolist()})
+                break
+            translation_updates, rotation_updates = self.pose_updates(predictions)
+            converged = self.has_converged(translation_updates, rotation_updates)
+            if converged.all():
+                finished.append(predictions)
+                self.refinement_iterations.update({label: iteration for label in predictions.infos['label'].tolist()})
+                break
+            if converged.any():
+                converged_predictions = predictions[np.flatnonzero(converged).tolist()]
+                finished.append(converged_predictions)
+                self.refinement_iterations.update({label: iteration for label in converged_predictions.infos['label'].tolist()})
+                predictions = predictions[np.flatnonzero(~converged).tolist()]
+            predictions, _ = self.pose_predictor.get_predictions(
+                images=images, K=self.K,
+                data_TCO_init=predictions,
+                n_coarse_iterations=0,
+                n_refiner_iterations=1
+            )
+        if len(finished) == 1:
+            return finished[0]
+        return concatenate(finished)
+    
+    def has_converged(self, translation_updates, rotation_updates):
+        options = self.refinement_options
+        return (translation_updates < options['translation_threshold']) & (rotation_updates < options['rotation_threshold'])
+    
+    def pose_updates_on_device(self, predictions):
+        '''Returns the translation (m) and rotation (deg) updates made by the last refiner iteration on each pose, 
+        as a (n, 2) tensor left on the device of the predictions'''
+        poses = predictions.poses.float()
+        poses_input = predictions.poses_input.float()
+        translation_updates = torch.linalg.norm(poses[:, :3, 3] - poses_input[:, :3, 3], dim=1)
+        # angle of R_input^T R
+        traces = torch.einsum('nij,nij->n', poses_input[:, :3, :3], poses[:, :3, :3])
+        rotation_updates = torch.rad2deg(torch.arccos(torch.clamp((traces - 1)/2, -1, 1)))
+        return torch.stack([translation_updates, rotation_updates], dim=1)
+    
+    def pose_updates(self, predictions):
+        '''Returns the translation (m) and rotation (deg) updates made by the last refiner iteration on each pose, in host memory'''
+        if len(predictions) == 0:
+            return np.empty(0), np.empty(0)
+        updates = self.pose_updates_on_device(predictions).cpu().numpy()
+        return updates[:, 0], updates[:, 1]
+    
+    def update_refinement_stats(self, labels, updates):
+        '''Builds the RefinementStats of the refined objects from their last updates, copied to host with their poses'''
+        converged = self.has_converged(updates[:, 0], updates[:, 1])
+        self.refinement_stats = dict()
+        for label, (translation_update, rotation_update), has_converged in zip(labels, updates, converged):
+            self.refinement_stats[label] = RefinementStats(self.refinement_iterations.get(label, 1), bool(has_converged), 
+                                                           float(translation_update), float(rotation_update))
+        self.report_refinement()
+    
+    def report_refinement(self):
+        self.nb_refinements += 1
+        self.nb_refiner_iterations += sum([stats.iterations for stats in self.refinement_stats.values()])
+        report_every = self.refinement_options['report_every']
+        if report_every and self.nb_refinements % report_every == 0:
+            stats = ', '.join([f'{label} : {stats}' for label, stats in self.refinement_stats.items()])
+            print(f'KnownObjectPoseEstimator: {self.nb_refiner_iterations/self.nb_refinements:.2f} refiner iterations per frame on average, last frame {stats}')
+    
+    def gate_prior(self, prior, occluders, timestamp):
+        '''Splits the tracking prior between the objects to re-estimate and the objects to keep as they are.
+        Returns (prior to re-estimate or None, prior kept or None)'''
+        if self.motion_gate is None:
+            return prior, None
+        labels = prior.infos['label'].tolist()
+        to_refresh = self.motion_gate.select(labels, timestamp, occluders)
+        refresh_ids = [i for i, label in enumerate(labels) if label in to_refresh]
+        kept_ids = [i for i, label in enumerate(labels) if label not in to_refresh]
+        if len(kept_ids) == 0:
+            return prior, None
+        if len(refresh_ids) == 0:
+            return None, prior
+        print(f'KnownObjectPoseEstimator: re-estimating {to_refresh}')
+        return prior[refresh_ids], prior[kept_ids]
+    
+    def predictions_to_host(self, predictions):
+        '''Copies the poses, render boxes and last refiner updates (see pose_updates) of every predicted object to host memory in a single transfer.
+        Returns three arrays of shape (n, 4, 4), (n, 4) and (n, 2)'''
+        n = len(predictions)
+        if n == 0:
+            return np.empty((0, 4, 4), dtype=np.float32), np.empty((0, 4), dtype=np.float32), np.empty((0, 2), dtype=np.float32)
+        # float() also brings bfloat16 autocast outputs back to float32
+        packed = torch.cat([predictions.poses.reshape(n, 16).float(), predictions.boxes_rend.reshape(n, 4).float(), 
+                            self.pose_updates_on_device(predictions)], dim=1)
+        if packed.is_cuda:
+            if self.host_buffer is None or self.host_buffer.shape[0] < n:
+                self.host_buffer = torch.empty((max(n, 8), packed.shape[1]), dtype=packed.dtype, pin_memory=True)
+            host = self.host_buffer[:n]
+            host.copy_(packed, non_blocking=True)
+            # only sync point of the frame, whatever the number of objects
+            torch.cuda.current_stream(packed.device).synchronize()
+        else:
+            host = packed
+        # copied out of the reused buffer, since objects keep references to their pose
+        packed = host.numpy().copy()
+        return packed[:, :16].reshape(n, 4, 4), packed[:, 16:20], packed[:, 20:]
+    
     def format(self, img):
         padded_img = cv2.copyMakeBorder(img, 0,self.pad_h,0,0,cv2.BORDER_CONSTANT)
         print(padded_img.shape)
@@ -157,21 +355,38 @@ class KnownObjectPoseEstimator:
         self.pose_predictor.stop()
         pass
 
-    def emptyPrediction():
+    def emptyPrediction(self):
         return PandasTensorCollection(infos=pd.DataFrame(dict(label=[],)),
-                                      poses=torch.empty((0, 4, 4)).float().cuda())
+                                      poses=torch.empty((0, 4, 4), dtype=torch.float32, device=self.device))
+class RefinementStats:
+    def __init__(self, iterations, converged, translation_update, rotation_update) -> None:
+        '''Refiner iterations run on an object, whether its pose converged, 
+        and the last translation (m) and rotation (deg) updates of its pose'''
+        self.iterations = iterations
+        self.converged = converged
+        self.translation_update = translation_update
+        self.rotation_update = rotation_update
+    
+    def __repr__(self) -> str:
+        status = 'converged' if self.converged else 'not converged'
+        return f'{self.iterations} it. {status} (dt {self.translation_update*1000:.1f} mm, dr {self.rotation_update:.2f} deg)'
+
 class ObjectPoseEstimation:
-    def __init__(self, label , pose, render_box = None, score = None, dataset=None) -> None:
+    def __init__(self, label , pose, render_box = None, score = None, dataset=None, age = 0., refinement = None) -> None:
         self.label = label
         self.pose = pose
         self.render_box = render_box
         self.score = score
         self.dataset = dataset
+        # time (s) since the pose was estimated
+        self.age = age
+        # RefinementStats of the estimation
+        self.refinement = refinement
         
-def get_pose_estimator(dataset, cam_data, use_tracking = True, fuse_detections = False):
+def get_pose_estimator(dataset, cam_data, use_tracking = True, fuse_detections = False, inference_options = None, motion_gating = True, refinement_options = {}):
 
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
-    detector = KnownObjectPoseEstimator(dataset, cam_data, use_tracking=use_tracking, fuse_detections=fuse_detections)
+    detector = KnownObjectPoseEstimator(dataset, cam_data, use_tracking=use_tracking, fuse_detections=fuse_detections, inference_options=inference_options, motion_gating=motion_gating, refinement_options=refinement_options)
     return detector
 
 if __name__ == '__main__':
@@ -5,7 +5,7 @@ import os
 import cv2
 import time
 
-from i_grip.utils2 import Bbox, State, Trajectory, Pose, Entity
+from i_grip.utils2 import Bbox, State, Trajectory, Pose, Entity, PosePropagator
 from i_grip import ObjectPoseEstimators as ope
 import matplotlib.colors as mcolors
 
@@ -18,18 +18,21 @@ class RigidObjectTrajectory(Trajectory):
     def __init__(self, state = None, headers_list = DEFAULT_DATA_KEYS, attributes_dict=DEFAULT_ATTRIBUTES, file = None, dataframe = None, limit_size=None) -> None:
         super().__init__(state, headers_list, attributes_dict, file, dataframe, limit_size)
 
+    # columns read when replaying the trajectory : translation, quaternion, then timestamp
+    REPLAY_KEYS = ('x', 'y', 'z', 'qx', 'qy', 'qz', 'qw', 'Timestamps')
+
     def __next__(self):
         if self.current_line_index < len(self.data):
-            row = self.data.iloc[self.current_line_index]
+            row = self.get_values(self.REPLAY_KEYS)[self.current_line_index]
             self.current_line_index+=1
-            return Pose.from_vector_and_quat(np.array([row['x'], row['y'], row['z']]), np.array([row['qx'], row['qy'], row['qz'], row['qw']])), row['Timestamps']
+            return Pose.from_vector_and_quat(np.array(row[:3]), np.array(row[3:7])), row[7]
         else:
             raise ValueError('No more data in trajectory')
     
     def __getitem__(self, index):
         if index < len(self.data):
-            row = self.data.iloc[index]
-            return Pose.from_vector_and_quat(np.array([row['x'], row['y'], row['z']]), np.array([row['qx'], row['qy'], row['qz'], row['qw']])), row['Timestamps']
+            row = self.get_values(self.REPLAY_KEYS)[index]
+            return Pose.from_vector_and_quat(np.array(row[:3]), np.array(row[3:7])), row[7]
         else:
             raise IndexError('Index out of range')
         
@@ -179,7 +182,12 @@ class RigidObject(Entity):
             pose, timestamp = self.state.__next__()
         else:
             pose, timestamp = self.state[index]
-        self.state.update(pose)
+        self.state.update(pose, timestamp)
+        self.state.propagate(timestamp)
+        self.set_mesh_updated(False)
+    
+    def propagate(self, timestamp):
+        '''Extrapolates the object pose to timestamp, e.g. the timestamp of the last hands detection'''
         self.state.propagate(timestamp)
         self.set_mesh_updated(False)
         
@@ -187,10 +195,11 @@ class RigidObject(Entity):
         # print('update obj mesh try')
         if self.was_mesh_updated():
             return
-        self.mesh_pos = self.state.pose_filtered.position.v*np.array([-1,1,1])
+        pose = self.state.get_propagated_pose()
+        self.mesh_pos = pose.position.v*np.array([-1,1,1])
         # mesh_orient_quat = [self.pose.orientation.q[i] for i in range(4)]
         # mesh_orient_angles = self.pose.orientation.v*np.array([-1,-1,-1])+np.pi*np.array([1  ,1,0])
-        mesh_orient_angles = self.state.pose_filtered.orientation.v*np.array([1,1,1])+np.pi*np.array([0 ,0,1])
+        mesh_orient_angles = pose.orientation.v*np.array([1,1,1])+np.pi*np.array([0 ,0,1])
         # x_reflection_matrix = tm.transformations.reflection_matrix(np.array([0,0,0]), np.array([1,0,0]))
         #mesh_transform = tm.transformations.translation_matrix(mesh_pos)  @ tm.transformations.quaternion_matrix(mesh_orient_quat)
         rot_mat = tm.transformations.euler_matrix(mesh_orient_angles[0],mesh_orient_angles[1],mesh_orient_angles[2])
@@ -342,6 +351,8 @@ class RigidObjectState(State):
         self.position_factor = position_factor
         self.orientation_factor = orientation_factor
         self.flip_pos_y = flip_pos_y
+        self.propagator = PosePropagator()
+        self.pose_propagated = None
         if pose is None or timestamp is None:
             self.pose = None
             self.last_timestamp = None
@@ -349,6 +360,7 @@ class RigidObjectState(State):
             self.pose = Pose(pose, position_factor, orientation_factor, flip_pos_y=flip_pos_y)
             self.pose_filtered = Pose(pose, position_factor, orientation_factor, filtered=True, flip_pos_y=flip_pos_y)
             self.last_timestamp = timestamp
+            self.propagator.add(self.pose_filtered, timestamp)
         if trajectory is None:
             self.trajectory = RigidObjectTrajectory.from_state(self)
         else:
@@ -368,6 +380,9 @@ class RigidObjectState(State):
         self.pose.update(pose, flip_pos_y=self.flip_pos_y)
         self.pose_filtered.update(pose, flip_pos_y=self.flip_pos_y)
         self.last_timestamp = timestamp
+        self.pose_propagated = None
+        if timestamp is not None:
+            self.propagator.add(self.pose_filtered, timestamp)
     
     def update_from_vector_and_quat(self, translation_vector, quaternion, timestamp=None):
         self.pose.update_from_vector_and_quat(translation_vector, quaternion, flip_pos_y=self.flip_pos_y)
@@ -375,9 +390,20 @@ class RigidObjectState(State):
         self.last_timestamp = timestamp
     
     def propagate(self, timestamp):
-        # self.last_timestamp = timestamp
-        pass
-        #TODO: propagate pose for tracking moving objects
+        '''Extrapolates the filtered pose to timestamp with the velocities of the last poses'''
+        if timestamp is None or self.last_timestamp is None or timestamp <= self.last_timestamp:
+            self.pose_propagated = None
+            return
+        mat = self.propagator.predict(timestamp)
+        if mat is not None:
+            # already scaled and flipped like pose_filtered
+            self.pose_propagated = Pose(mat)
+    
+    def get_propagated_pose(self):
+        '''Returns the pose extrapolated at the last propagation timestamp, or the last filtered pose'''
+        if self.pose_propagated is None:
+            return self.pose_filtered
+        return self.pose_propagated
     
     def as_list(self, timestamp=True, pose=True, pose_filtered=False):
         repr_list = []
@@ -1,6 +1,8 @@
 import depthai as dai
 import cv2
 import numpy as np
+import queue
+import threading
 import time
 import pandas as pd
 
@@ -21,7 +23,8 @@ class RgbdCamera:
                  resolution = _480P, 
                  print_rgb_stereo_latency = False, 
                  show_disparity=False,
-                 color_mode = _BGR_MODE) -> None:
+                 color_mode = _BGR_MODE,
+                 replay_prefetch = 8) -> None:
         """_summary_
 
         Args:
@@ -35,6 +38,7 @@ class RgbdCamera:
             mediapipe_model_path (_type_, optional): _description_. Defaults to _MEDIAPIPE_MODEL_PATH.
             print_rgb_stereo_latency (bool, optional): _description_. Defaults to False.
             show_disparity (bool, optional): _description_. Defaults to False.
+            replay_prefetch (int, optional): number of replay frames decoded ahead on a background thread, 0 to decode them on demand. Defaults to 8.
         """
         print('Building RGBd Camera...')
         self.cam_auto_mode = True
@@ -48,6 +52,8 @@ class RgbdCamera:
         if color_mode not in [self._RGB_MODE, self._BGR_MODE]:
             raise ValueError(f'color_mode must be one of {self._RGB_MODE} or {self._BGR_MODE}')
         self.color_mode = color_mode
+        self.replay_prefetch = replay_prefetch
+        self.prefetcher = None
         
         print(f'fps: {fps}, resolution: {resolution}')
         if self.replay :
@@ -63,6 +69,9 @@ class RgbdCamera:
 
         self.frame = None
         self.new_frame = False
+        # id and monotonic time of reception of the last frame, to follow it through the pipeline
+        self.frame_id = -1
+        self.capture_timestamp = None
 
         print(f'RGBd Camera built: replay={replay}')
     
@@ -188,11 +197,17 @@ class RgbdCamera:
         print(replay.keys())
         self.timestamps = replay['Timestamps']
         self.depth_maps = replay['Depth_maps']
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        if self.replay_prefetch > 0:
+            self.prefetcher = ReplayPrefetcher(self.video, self.depth_maps, self.timestamps, self.nb_frames, self.replay_prefetch)
         
     def next_frame_livestream(self):
         self.timestamp = time.time()
         d_frame = self.depthQ.get()
         r_frame = self.rgbQ.get()
+        self.new_frame_id()
         if d_frame is not None:
             frame = d_frame.getFrame()
             frame = cv2.resize(frame, self.cam_data['resolution'])
@@ -231,16 +246,27 @@ class RgbdCamera:
     
     
     def next_frame_video(self):
-        success, frame = self.video.read()
+        if self.prefetcher is not None:
+            success, frame, self.depth_map, self.timestamp = self.prefetcher.get()
+        else:
+            success, frame = self.video.read()
+            self.depth_map = self.depth_maps[self.current_frame_index]
+            self.timestamp = self.timestamps[self.current_frame_index]
+        self.new_frame_id()
         # frame = cv2.resize(frame, self.cam_data['resolution'])
         self.frame = frame
-        self.depth_map = self.depth_maps[self.current_frame_index]
         # self.depth_map = cv2.resize(self.depth_map, self.cam_data['resolution'])
-        self.timestamp = self.timestamps[self.current_frame_index]
         self.current_frame_index += 1
         self.new_frame = True
         return success, self.frame, self.depth_map
     
+    def new_frame_id(self):
+        self.frame_id += 1
+        self.capture_timestamp = time.monotonic()
+
+    def get_frame_info(self):
+        return self.frame_id, self.capture_timestamp
+    
     def get_depth_map(self):
         return self.depth_map
 
@@ -249,6 +275,9 @@ class RgbdCamera:
     
     def stop(self):
         self.on = False
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
         #wait for 50ms
         if not self.replay:
             time.sleep(0.05)
@@ -274,6 +303,53 @@ class RgbdCamera:
         return self.current_frame_index<self.nb_frames
 
 
+class ReplayPrefetcher:
+    def __init__(self, video, depth_maps, timestamps, nb_frames, buffer_size = 8) -> None:
+        '''Decodes the replay frames ahead on a background thread : video frames are read and depth maps paged in 
+        (e.g. from a memory-mapped depth store) into a bounded buffer of ready (success, frame, depth map, timestamp)'''
+        self.video = video
+        self.depth_maps = depth_maps
+        self.timestamps = timestamps
+        self.nb_frames = nb_frames
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.decode_task, daemon=True)
+        self.thread.start()
+
+    def decode_task(self):
+        for index in range(min(self.nb_frames, len(self.timestamps))):
+            success, frame = self.video.read()
+            # copied, so that the read happens here and not on first access
+            depth_map = np.array(self.depth_maps[index])
+            if not self.put((success, frame, depth_map, self.timestamps[index])):
+                return
+        # end of the replay
+        self.put(None)
+
+    def put(self, item):
+        '''Waits for room in the buffer, returns False if stopped meanwhile'''
+        while not self.stop_event.is_set():
+            try:
+                self.buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        '''Returns the next (success, frame, depth map, timestamp), with success False past the end of the replay'''
+        item = self.buffer.get()
+        if item is None:
+            # stays at the end for later calls
+            self.buffer.put(None)
+            return False, None, None, None
+        return item
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
 class RgbdReader:
     def __init__(self, file_path) -> None:
         self.load_cam_data(file_path)
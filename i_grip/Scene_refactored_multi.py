@@ -96,10 +96,11 @@ class Scene :
         return s
 
     def reset(self):   
-        if self.scene_window is None:
+        if self.draw_mesh and self.scene_window is None:
             return
         print('reset scene')
-        self.stop()
+        if self.draw_mesh:
+            self.stop()
         # self.hands_to_delete = self.hands
         # self.objects_to_delete = self.objects
         self.hands = dict()
@@ -115,8 +116,9 @@ class Scene :
         self.new_object_meshes = []
         self.scene_callback_period = 1.0/self.fps
         self.timestep_index = 0
-        self.resume_scene_display()
-        self.define_mesh_scene()
+        if self.draw_mesh:
+            self.resume_scene_display()
+            self.define_mesh_scene()
     
 
     def define_mesh_scene(self):
@@ -173,6 +175,9 @@ class Scene :
             obj.update_from_trajectory()
         self.timestep_index +=1
         print('timestep index : '+str(self.timestep_index))
+        if not self.draw_mesh and self.detect_grasping:
+            # no viewer callback to check the targets, they are checked at the recorded timestamp
+            self.check_targets(timestamp=timestamp)
         self.fetch_all_targets(timestamp=timestamp)
 
     def new_hand(self, label, input= None, timestamp = None):
@@ -203,6 +208,8 @@ class Scene :
                 self.hands[hand_pred.label].update(hand_pred)
         self.clean_hands(hands_predictions)
         self.propagate_hands( timestamp = timestamp)
+        # objects are estimated less often than hands, bring them to the hands timestamp for the targets checks
+        self.propagate_objects( timestamp = timestamp)
         
         # keys = self.target_detectors.copy().keys()
         # for label in keys:
@@ -214,6 +221,11 @@ class Scene :
         for hand_label in keys:
             self.hands[hand_label].propagate(timestamp = timestamp)
     
+    def propagate_objects(self, timestamp = None):
+        # objects may be added by another thread meanwhile
+        for obj in list(self.objects.values()):
+            obj.propagate(timestamp = timestamp)
+    
     def clean_hands(self, newhands):
         hands_label = [hand.label for hand in newhands]
         hands = self.hands.copy()
@@ -403,6 +415,16 @@ class Scene :
             print(f'check_all_targets time for hand {label} : {(time.time()-t)*1000:.2f} ms')
         print(f'check_all_targets time : {(time.time()-tall)*1000:.2f} ms')
 
+    def check_targets(self, timestamp = None):
+        '''Headless counterpart of update_meshes : brings the hands and objects meshes up to date, then checks all targets'''
+        for hand in list(self.hands.values()):
+            hand.update_mesh()
+        for obj in list(self.objects.values()):
+            obj.update_mesh()
+        for detector in list(self.target_detectors.values()):
+            detector.make_rays_from_trajectory()
+            detector.check_all_targets(timestamp = timestamp)
+
     def fetch_all_targets(self, timestamp = None):
         t = time.time()
         targets = {}
@@ -485,6 +507,8 @@ class Scene :
         cv2.putText(img,'fps objects: {:.0f}'.format(self.fps_objects),(10,115),cv2.FONT_HERSHEY_SIMPLEX,1,(255,0,0),2)
 
     def stop(self):
+        if not self.draw_mesh:
+            return
         #stop the callback thread
         print('stopped pyglet app inside scene')
         self.scene_window.on_close()
@@ -567,8 +591,8 @@ class ReplayScene(Scene):
                                                     show_velocity_cone = True,
                                                     fps = 30)
     
-    def __init__(self, cam_data, name='Grasping experiment',   video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, dataset = None) -> None:
-        super().__init__(cam_data, name, video_rendering_options, scene_rendering_options, detect_grasping=False, dataset=dataset)
+    def __init__(self, cam_data, name='Grasping experiment',   video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, dataset = None, draw_mesh = True) -> None:
+        super().__init__(cam_data, name, video_rendering_options, scene_rendering_options, detect_grasping=False, dataset=dataset, draw_mesh=draw_mesh)
     
     def render(self, img):  
         # self.compute_distances()
@@ -596,8 +620,8 @@ class AnalysisScene(Scene):
                                                     draw_grid = True,
                                                     show_velocity_cone = True)
     
-    def __init__(self, cam_data, name='Grasping experiment',   video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, fps=30) -> None:
-        super().__init__(cam_data, name, video_rendering_options, scene_rendering_options, detect_grasping=True, fps=fps)
+    def __init__(self, cam_data, name='Grasping experiment',   video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, fps=30, draw_mesh = True) -> None:
+        super().__init__(cam_data, name, video_rendering_options, scene_rendering_options, detect_grasping=True, fps=fps, draw_mesh=draw_mesh)
 
     def create_void_hands(self):
         labels = ('left', 'right')
@@ -18,6 +18,7 @@ from i_grip.Objects import RigidObject
 from i_grip.Targets_refactored_fullmulti_multichecker import TargetDetector
 # from i_grip.Targets_refactored_multi import TargetDetector
 from i_grip.clean_scene import CleanScene
+from i_grip.Tracing import FrameTracer
 
 class MeshScene(tm.Scene):
     def __init__(self, *args, **kwargs):
@@ -50,7 +51,7 @@ class Scene :
                                                     show_velocity_cone = True
                                                     )
     
-    def __init__(self, cam_data, name = 'Grasping experiment',  video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, fps = 30.0, detect_grasping = True, draw_mesh = True, dataset = None, plotter=None) -> None:
+    def __init__(self, cam_data, name = 'Grasping experiment',  video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, fps = 30.0, detect_grasping = True, draw_mesh = True, dataset = None, plotter=None, tracer = None) -> None:
         self.hands = dict()
         self.objects = dict()
         self.target_detectors = dict()
@@ -73,6 +74,11 @@ class Scene :
         self.draw_mesh = draw_mesh
         self.dataset= dataset
         self.plotter = plotter
+        if tracer is None:
+            tracer = FrameTracer(name)
+        self.tracer = tracer
+        # id of the camera frame of the last hands update, to trace the decisions it leads to
+        self.frame_id = -1
         
         self.timestep_index = 0
         
@@ -205,6 +211,8 @@ class Scene :
                 self.hands[hand_pred.label].update(hand_pred)
         self.clean_hands(hands_predictions)
         self.propagate_hands( timestamp = timestamp)
+        # objects are estimated less often than hands, bring them to the hands timestamp for the targets checks
+        self.propagate_objects( timestamp = timestamp)
         
         # keys = self.target_detectors.copy().keys()
         # for label in keys:
@@ -216,6 +224,11 @@ class Scene :
         for hand_label in keys:
             self.hands[hand_label].propagate(timestamp = timestamp)
     
+    def propagate_objects(self, timestamp = None):
+        # objects may be added by another thread meanwhile
+        for obj in list(self.objects.values()):
+            obj.propagate(timestamp = timestamp)
+    
     def clean_hands(self, newhands):
         hands_label = [hand.label for hand in newhands]
         hands = self.hands.copy()
@@ -283,10 +296,13 @@ class Scene :
             print(f'update_trajectory_meshes time : {(time.time()-t)*1000:.2f} ms')
             t = time.time()
             if self.detect_grasping:
-                self.check_all_targets(scene)
+                frame_id = self.frame_id
+                with self.tracer.span('target_check', frame_id):
+                    self.check_all_targets(scene)
                 print(f'check_all_targets time : {(time.time()-t)*1000:.2f} ms')
                 t = time.time()
-                self.fetch_all_targets()
+                with self.tracer.span('decision', frame_id):
+                    self.fetch_all_targets()
                 print(f'fetch_all_targets time : {(time.time()-t)*1000:.2f} ms')
         print(f'update_meshes time : {(time.time()-ttot)*1000:.2f} ms')
 
@@ -550,8 +566,8 @@ class LiveScene(Scene):
                                                     draw_grid = True,
                                                     show_velocity_cone = True)
         
-    def __init__(self, cam_data, name='Grasping experiment',   video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, dataset='ycbv', plotter=None, fps = 40) -> None:
-        super().__init__(cam_data, name, video_rendering_options, scene_rendering_options, dataset=dataset, plotter=plotter, fps=fps)
+    def __init__(self, cam_data, name='Grasping experiment',   video_rendering_options = _DEFAULT_VIDEO_RENDERING_OPTIONS, scene_rendering_options = _DEFAULT_VIRTUAL_SCENE_RENDERING_OPTIONS, dataset='ycbv', plotter=None, fps = 40, tracer = None) -> None:
+        super().__init__(cam_data, name, video_rendering_options, scene_rendering_options, dataset=dataset, plotter=plotter, fps=fps, tracer=tracer)
     
     def render(self, img):
         # self.compute_distances()
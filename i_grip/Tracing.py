@@ -0,0 +1,169 @@
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# stages of the live pipeline, in the order a frame goes through them
+TRACE_STAGES = ['capture', 'hands', 'object_detection', 'object_estimation',
+                'scene_update_hands', 'scene_update_objects', 'scene_render', 'target_check', 'decision']
+
+_TRACE_RECORD_DTYPE = np.dtype([('stage', 'i2'),
+                                ('frame_id', 'i8'),
+                                ('t_enter', 'f8'),
+                                ('t_exit', 'f8'),
+                                ('thread', 'i8')])
+
+
+def trace_clock():
+    '''Clock used for every trace record, shared by all the processes of the machine'''
+    return time.monotonic()
+
+
+class FrameTracer:
+
+    _DEFAULT_CAPACITY = 1 << 16
+
+    def __init__(self, process_name, trace_dir = None, stages = TRACE_STAGES, capacity = _DEFAULT_CAPACITY) -> None:
+        '''Records, for each pipeline stage, when a frame enters and leaves it, in a fixed size in-memory ring.
+        Writing a record only takes a slot from an atomic counter, so the threads of a process never wait for each other.
+        Frames a stage never saw (skipped because a newer one was available) are counted as drops of that stage.
+        Tracing is disabled when trace_dir is None, and every method then returns immediately.'''
+        self.process_name = process_name
+        self.trace_dir = trace_dir
+        self.enabled = trace_dir is not None
+        self.stages = list(stages)
+        self.stages_ids = {stage : i for i, stage in enumerate(self.stages)}
+        self.capacity = capacity if self.enabled else 0
+        self.records = np.zeros(self.capacity, dtype=_TRACE_RECORD_DTYPE)
+        self.counter = itertools.count()
+        self.nb_records = 0
+        self.drops = np.zeros(len(self.stages), dtype=np.int64)
+        self.last_frame_ids = np.full(len(self.stages), -1, dtype=np.int64)
+
+    def record(self, stage, frame_id, t_enter, t_exit = None):
+        if not self.enabled:
+            return
+        if t_exit is None:
+            t_exit = trace_clock()
+        n = next(self.counter)
+        self.records[n % self.capacity] = (self.stages_ids[stage], frame_id, t_enter, t_exit, _thread_id())
+        self.nb_records = n + 1
+
+    @contextmanager
+    def span(self, stage, frame_id):
+        if not self.enabled:
+            yield
+            return
+        t_enter = trace_clock()
+        try:
+            yield
+        finally:
+            self.record(stage, frame_id, t_enter)
+
+    def observe_frame(self, stage, frame_id):
+        '''Counts the frames skipped by stage since the last frame it observed'''
+        if not self.enabled or frame_id is None or frame_id < 0:
+            return
+        stage_id = self.stages_ids[stage]
+        last_frame_id = self.last_frame_ids[stage_id]
+        if last_frame_id >= 0 and frame_id > last_frame_id + 1:
+            self.drops[stage_id] += frame_id - last_frame_id - 1
+        self.last_frame_ids[stage_id] = max(frame_id, last_frame_id)
+
+    def get_records(self):
+        '''Returns the records still in the ring, oldest first'''
+        nb_records = self.nb_records
+        if nb_records <= self.capacity:
+            return self.records[:nb_records].copy()
+        start = nb_records % self.capacity
+        return np.concatenate([self.records[start:], self.records[:start]])
+
+    def dump(self):
+        '''Saves the records of this process in trace_dir, to be merged with merge_traces'''
+        if not self.enabled:
+            return None
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f'{self.process_name}_{os.getpid()}.npz')
+        np.savez(path, records=self.get_records(), drops=self.drops, stages=np.array(self.stages),
+                 process_name=np.array(self.process_name), pid=np.array(os.getpid()))
+        print(f'FrameTracer: {self.process_name} trace saved in {path}')
+        return path
+
+
+def _thread_id():
+    return threading.get_ident() & 0x7fffffff
+
+
+def load_traces(trace_dir):
+    traces = []
+    for file_name in sorted(os.listdir(trace_dir)):
+        if not file_name.endswith('.npz'):
+            continue
+        with np.load(os.path.join(trace_dir, file_name)) as data:
+            traces.append(dict(records=data['records'], drops=data['drops'], stages=list(data['stages']),
+                               process_name=str(data['process_name']), pid=int(data['pid'])))
+    return traces
+
+
+def to_chrome_events(traces):
+    '''Converts the traces of every process to Chrome trace events, readable by chrome://tracing and Perfetto'''
+    events = []
+    t0 = min([trace['records']['t_enter'].min() for trace in traces if len(trace['records'])], default=0.)
+    for trace in traces:
+        pid = trace['pid']
+        events.append(dict(name='process_name', ph='M', pid=pid, tid=0, args=dict(name=trace['process_name'])))
+        for record in trace['records']:
+            events.append(dict(name=trace['stages'][record['stage']], ph='X', pid=pid, tid=int(record['thread']),
+                               ts=(record['t_enter']-t0)*1e6, dur=(record['t_exit']-record['t_enter'])*1e6,
+                               args=dict(frame_id=int(record['frame_id']))))
+        for stage, nb_drops in zip(trace['stages'], trace['drops']):
+            if nb_drops > 0:
+                events.append(dict(name=f'{stage} dropped frames', ph='C', pid=pid, tid=0, ts=0,
+                                   args=dict(dropped=int(nb_drops))))
+    return events
+
+
+def summarize_traces(traces, first_stage = 'capture', last_stage = 'decision'):
+    '''Returns per-stage durations and drops, and the latency from first_stage to last_stage of every frame'''
+    summary = {}
+    enters = {}
+    exits = {}
+    for trace in traces:
+        records = trace['records']
+        for stage_id, stage in enumerate(trace['stages']):
+            stage_records = records[records['stage'] == stage_id]
+            stage_summary = summary.setdefault(stage, dict(count=0, durations=[], dropped=0))
+            stage_summary['count'] += len(stage_records)
+            stage_summary['durations'].append(stage_records['t_exit']-stage_records['t_enter'])
+            stage_summary['dropped'] += int(trace['drops'][stage_id])
+            if stage == first_stage:
+                enters.update(zip(stage_records['frame_id'].tolist(), stage_records['t_enter'].tolist()))
+            elif stage == last_stage:
+                exits.update(zip(stage_records['frame_id'].tolist(), stage_records['t_exit'].tolist()))
+    for stage_summary in summary.values():
+        durations = np.concatenate(stage_summary.pop('durations'))*1000
+        stage_summary['mean_ms'] = float(durations.mean()) if len(durations) else None
+        stage_summary['p95_ms'] = float(np.percentile(durations, 95)) if len(durations) else None
+    latencies = np.array([exits[frame_id]-enters[frame_id] for frame_id in exits if frame_id in enters])*1000
+    summary['latency'] = dict(first_stage=first_stage, last_stage=last_stage, count=len(latencies),
+                              mean_ms=float(latencies.mean()) if len(latencies) else None,
+                              p95_ms=float(np.percentile(latencies, 95)) if len(latencies) else None)
+    return summary
+
+
+def merge_traces(trace_dir, output_path = None):
+    '''Merges the traces dumped by every process of trace_dir into a single Chrome trace file'''
+    traces = load_traces(trace_dir)
+    if output_path is None:
+        output_path = os.path.join(trace_dir, 'trace.json')
+    with open(output_path, 'w') as f:
+        json.dump(dict(traceEvents=to_chrome_events(traces), displayTimeUnit='ms'), f)
+    summary = summarize_traces(traces)
+    for stage, stage_summary in summary.items():
+        print(f'{stage}: {stage_summary}')
+    print(f'Trace saved in {output_path}')
+    return output_path, summary
@@ -22,4 +22,69 @@ TLESS_REFINER_ESTIMATOR_ID = 'refiner-bop-tless-synt+real--881314'
 
 YCVB_DETECTOR_ID =  'detector-bop-tless-synt+real--452847'
 YCVB_COARSE_ESTIMATOR_ID = 'coarse-bop-ycbv-synt+real--822463'
-YCVB_REFINER_ESTIMATOR_ID = 'refiner-bop-ycbv-synt+real--631598'
\ No newline at end of file
+YCVB_REFINER_ESTIMATOR_ID = 'refiner-bop-ycbv-synt+real--631598'
+
+# On-disk cache of the configs, state dicts and mesh databases of the CosyPose models (see model_utils).
+# Entries are keyed by model id, checkpoint hash and torch version, stale ones are simply never read again
+_MODEL_CACHE_DIR = LOCAL_DATA_DIR / 'i_grip_model_cache'
+_USE_MODEL_CACHE = True
+
+# Colour order of the frames delivered by the camera, and colour order expected by each consumer of these frames.
+# Each distinct colour order is computed only once per frame (see FramePreparers.FramePreparer)
+_CAMERA_COLOR_MODE = 'BGR'
+_FRAME_CONSUMERS_COLOR_MODES = dict(hands = 'RGB',
+                                    object_detection = 'RGB',
+                                    object_estimation = 'RGB',
+                                    scene = 'BGR')
+
+# Inference options of the CosyPose object detector and pose estimator (see inference_utils)
+_DEFAULT_INFERENCE_OPTIONS = dict(device = 'cuda',
+                                  num_threads = None,
+                                  channels_last = False,
+                                  bf16_autocast = False,
+                                  inference_mode = True,
+                                  warmup_iterations = 1,
+                                  report_latency_every = 100)
+# for machines without GPU : every core for intra-op parallelism, channels-last convolutions
+_CPU_INFERENCE_OPTIONS = dict(_DEFAULT_INFERENCE_OPTIONS,
+                              device = 'cpu',
+                              num_threads = 0,
+                              channels_last = True,
+                              warmup_iterations = 2)
+
+# Gating of the object pose re-estimation on image motion (see MotionGates.ObjectMotionGate)
+# downscale : image reduction factor for the frame difference
+# pixel_threshold : grey level difference above which a pixel has changed
+# changed_fraction : fraction of changed pixels of a box above which its object has moved
+# max_age : maximum age (s) of a pose before it is re-estimated anyway
+# occluder_margin : margin (px) around hands boxes for an object to count as occluded
+_OBJECT_MOTION_GATE_OPTIONS = dict(downscale = 4,
+                                   pixel_threshold = 12,
+                                   changed_fraction = 0.02,
+                                   max_age = 1.0,
+                                   occluder_margin = 10)
+
+# Adaptive refinement of the object poses (see ObjectPoseEstimators.KnownObjectPoseEstimator.refine)
+# max_iterations : refiner iterations at most after a coarse estimate
+# tracking_max_iterations : refiner iterations at most when starting from the previous pose
+# Both are kept at the single refiner iteration that was run and benchmarked before : larger budgets add refiner work on hard frames
+# translation_threshold : translation update (m) below which a pose has converged
+# rotation_threshold : rotation update (deg) below which a pose has converged
+# report_every : number of refinements between two prints of the iterations statistics (0 to never print)
+_POSE_REFINEMENT_OPTIONS = dict(max_iterations = 1,
+                                tracking_max_iterations = 1,
+                                translation_threshold = 0.002,
+                                rotation_threshold = 1.0,
+                                report_every = 100)
+
+# Tracking of the hands in crops around their previous landmarks (see Hands3DDetectors.Hands3DDetector)
+# padding : margin added on each side of the landmarks box, relative to its largest side
+# min_crop_size : minimal side (px) of a crop
+# min_score : handedness score below which the full image detection is run again
+# border_margin : normalized distance to the crop border under which a hand is considered leaving its crop
+# redetection_interval : maximal time (s) between two full image detections
+_HANDS_ROI_TRACKING_OPTIONS = dict(padding = 0.5,
+                                   min_crop_size = 128,
+                                   min_score = 0.7,
+                                   border_margin = 0.02,
+                                   redetection_interval = 1.0)
@@ -31,3 +31,43 @@ def make_cameras(list_dict_intrinsics):
         K=torch.stack(K)
     )
     return cameras
+
+
+class ImageTensorConverter:
+    def __init__(self, device, channels_last = False) -> None:
+        '''Converts HxWxC uint8 frames to 1xCxHxW float tensors in [0, 1] on device.
+        The host, device and output tensors are allocated once per resolution and reused for every frame, 
+        the uint8 to float conversion and the normalisation are done in a single operation.
+        The returned tensor is overwritten by the next call.'''
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        self.buffers = dict()
+
+    def get_buffers(self, shape):
+        if shape not in self.buffers:
+            height, width, nb_channels = shape
+            pin_memory = self.device.type == 'cuda'
+            host = torch.empty(shape, dtype=torch.uint8, pin_memory=pin_memory)
+            if pin_memory:
+                device_u8 = torch.empty(shape, dtype=torch.uint8, device=self.device)
+                copy_done = torch.cuda.Event()
+            else:
+                device_u8 = host
+                copy_done = None
+            memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+            out = torch.empty((1, nb_channels, height, width), dtype=torch.float32, device=self.device, memory_format=memory_format)
+            self.buffers[shape] = (host, device_u8, out, copy_done)
+            print(f'ImageTensorConverter: buffers allocated for shape {shape} on {self.device}')
+        return self.buffers[shape]
+
+    def __call__(self, image):
+        host, device_u8, out, copy_done = self.get_buffers(image.shape)
+        if copy_done is not None:
+            # the previous frame must have left the pinned buffer before it is overwritten
+            copy_done.synchronize()
+        np.copyto(host.numpy(), image)
+        if copy_done is not None:
+            device_u8.copy_(host, non_blocking=True)
+            copy_done.record()
+        torch.mul(device_u8.permute(2, 0, 1).unsqueeze(0), 1/255, out=out)
+        return out
@@ -0,0 +1,103 @@
+import os
+import time
+from collections import deque
+from contextlib import ExitStack
+
+import numpy as np
+import torch
+
+from i_grip.config import _DEFAULT_INFERENCE_OPTIONS
+
+
+def get_inference_options(inference_options = None):
+    '''Completes inference_options with the default ones'''
+    options = dict(_DEFAULT_INFERENCE_OPTIONS)
+    if inference_options is not None:
+        options.update(inference_options)
+    return options
+
+
+def setup_inference(options):
+    '''Returns the torch device described by options, falling back to cpu when cuda is not available,
+    and sets the number of intra-op threads (0 for every core)'''
+    device = torch.device(options['device'])
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        print('setup_inference: cuda not available, running on cpu')
+        device = torch.device('cpu')
+    num_threads = options['num_threads']
+    if num_threads is not None:
+        if num_threads <= 0:
+            num_threads = os.cpu_count()
+        torch.set_num_threads(num_threads)
+    print(f'setup_inference: device {device}, {torch.get_num_threads()} threads, channels_last {options["channels_last"]}, bf16 {options["bf16_autocast"]}')
+    return device
+
+
+def inference_context(options, device):
+    '''Context in which to run the networks : no autograd, and bfloat16 autocast if asked for'''
+    stack = ExitStack()
+    if options['inference_mode']:
+        stack.enter_context(torch.inference_mode())
+    else:
+        stack.enter_context(torch.no_grad())
+    if options['bf16_autocast']:
+        stack.enter_context(torch.autocast(device_type=device.type, dtype=torch.bfloat16))
+    return stack
+
+
+def prepare_model(model, device, channels_last = False):
+    model = model.to(device).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class LatencyMeter:
+    def __init__(self, name, report_every = 100, window = 100) -> None:
+        '''Measures the latency of successive calls, and prints its mean and 95th percentile every report_every calls'''
+        self.name = name
+        self.report_every = report_every
+        self.latencies = deque(maxlen=window)
+        self.nb_calls = 0
+
+    def add(self, latency):
+        self.latencies.append(latency)
+        self.nb_calls += 1
+        if self.report_every and self.nb_calls % self.report_every == 0:
+            self.report()
+
+    def measure(self, device = None):
+        return _LatencyMeasure(self, device)
+
+    def get_stats(self):
+        if len(self.latencies) == 0:
+            return None, None
+        latencies = np.array(self.latencies)*1000
+        return latencies.mean(), np.percentile(latencies, 95)
+
+    def report(self):
+        mean, p95 = self.get_stats()
+        if mean is not None:
+            print(f'{self.name} latency : mean {mean:.2f} ms, p95 {p95:.2f} ms over the last {len(self.latencies)} calls')
+
+
+class _LatencyMeasure:
+    def __init__(self, meter, device) -> None:
+        self.meter = meter
+        self.device = device
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device is not None:
+            # asynchronous devices would otherwise only report the launch time
+            synchronize(self.device)
+        self.meter.add(time.perf_counter()-self.t)
+        return False
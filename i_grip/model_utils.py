@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+import time
 import yaml
 from pathlib import Path
 import numpy as np
@@ -17,10 +21,105 @@ from cosypose.lib3d.rigid_mesh_database import MeshDataBase as RigidMeshDataBase
 from cosypose.training.detector_models_cfg import create_model_detector
 from cosypose.integrated.detector import Detector
 
+from i_grip.inference_utils import prepare_model
+from i_grip.config import _MODEL_CACHE_DIR, _USE_MODEL_CACHE
 
-def load_torch_model(run_id, *args, model_type='rigid'):
+
+def file_fingerprint(path):
+    '''Sha256 of a file, memoized in the cache directory as long as the file size and modification time do not change'''
+    path = Path(path)
+    stat = path.stat()
+    index_path = _MODEL_CACHE_DIR / 'hashes.json'
+    index = json.loads(index_path.read_text()) if index_path.exists() else {}
+    entry = index.get(str(path))
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha.update(block)
+    index[str(path)] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha.hexdigest())
+    _atomic_write(index_path, lambda tmp_path: Path(tmp_path).write_text(json.dumps(index, indent=1)))
+    return sha.hexdigest()
+
+
+def cache_path(name, fingerprint):
+    torch_version = torch.__version__.replace('+', '_')
+    return _MODEL_CACHE_DIR / f'{name}-{fingerprint[:16]}-torch{torch_version}.pt'
+
+
+def _atomic_write(path, write_fn):
+    # written next to its final place then renamed, so that a crash never leaves a truncated entry
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = path.with_name(path.name + f'.{os.getpid()}.tmp')
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_cache_entry(path):
+    '''Returns the object stored in path, memory-mapped when torch supports it, None if there is no valid entry'''
+    if not path.exists():
+        return None
+    try:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+        except TypeError:
+            # torch < 2.1 has no mmap option
+            return torch.load(path, map_location='cpu')
+    except Exception as e:
+        print(f'load_cache_entry: ignoring unreadable cache entry {path} ({e})')
+        return None
+
+
+def save_cache_entry(path, obj):
+    try:
+        _atomic_write(path, lambda tmp_path: torch.save(obj, tmp_path))
+    except OSError as e:
+        print(f'save_cache_entry: could not write cache entry {path} ({e})')
+
+
+def load_model_data(run_id, use_cache = _USE_MODEL_CACHE):
+    '''Returns the parsed config and the flat state dict of a CosyPose run.
+    Served from the model cache when possible, the yaml config and the checkpoint are parsed and cached otherwise'''
     run_dir = EXP_DIR / run_id
+    checkpoint_path = run_dir / 'checkpoint.pth.tar'
+    t = time.perf_counter()
+    if use_cache:
+        path = cache_path(run_id, file_fingerprint(checkpoint_path))
+        model_data = load_cache_entry(path)
+        if model_data is not None:
+            print(f'load_model_data: {run_id} loaded from cache in {time.perf_counter()-t:.2f} s')
+            return model_data['cfg'], model_data['state_dict']
     cfg = yaml.load((run_dir / 'config.yaml').read_text(), Loader=yaml.UnsafeLoader)
+    state_dict = torch.load(checkpoint_path, map_location='cpu')['state_dict']
+    if use_cache:
+        save_cache_entry(path, dict(cfg=cfg, state_dict=state_dict))
+    print(f'load_model_data: {run_id} loaded from checkpoint in {time.perf_counter()-t:.2f} s')
+    return cfg, state_dict
+
+
+def load_mesh_db(object_ds_name, device='cuda', use_cache = _USE_MODEL_CACHE):
+    '''Returns the batched mesh database of an object dataset, on device. 
+    Its tensors are cached, keyed by the names, sizes and modification times of the meshes'''
+    object_ds = make_object_dataset(object_ds_name)
+    if not use_cache:
+        return RigidMeshDataBase.from_object_ds(object_ds).batched().to(device)
+    sha = hashlib.sha256()
+    for obj in object_ds:
+        stat = os.stat(obj['mesh_path'])
+        sha.update(f"{obj['label']}:{obj['mesh_path']}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    path = cache_path(f'meshes-{object_ds_name}', sha.hexdigest())
+    mesh_db = load_cache_entry(path)
+    if mesh_db is None:
+        mesh_db = RigidMeshDataBase.from_object_ds(object_ds).batched()
+        save_cache_entry(path, mesh_db)
+    return mesh_db.to(device)
+
+
+def load_torch_model(run_id, *args, model_type='rigid', device='cuda', channels_last=False, model_data=None):
+    if model_data is None:
+        model_data = load_model_data(run_id)
+    cfg, state_dict = model_data
     if model_type == 'rigid':
         create_model_fn = create_model_rigid
     elif model_type == 'detector':
@@ -30,35 +129,34 @@ def load_torch_model(run_id, *args, model_type='rigid'):
     else:
         raise ValueError('Unknown model type', model_type)
     model = create_model_fn(cfg, *args)
-    ckpt = torch.load(run_dir / 'checkpoint.pth.tar')
-    ckpt = ckpt['state_dict']
-    model.load_state_dict(ckpt)
-    model = model.cuda().eval()
+    model.load_state_dict(state_dict)
+    model = prepare_model(model, device, channels_last=channels_last)
     model.cfg = cfg
     model.config = cfg
     model_type = 'rigid' # if 'ycbv' in coarse_run_id else 'articulated'
     return model
 
 
-def load_pose_predictor(coarse_run_id, refiner_run_id, n_workers=1, preload_cache=False):
+def load_pose_predictor(coarse_run_id, refiner_run_id, n_workers=1, preload_cache=False, device='cuda', channels_last=False):
     run_dir = EXP_DIR
     print('run_dir',run_dir)
-    coarse_run_dir = EXP_DIR / coarse_run_id
-    coarse_cfg = yaml.load((coarse_run_dir / 'config.yaml').read_text(), Loader=yaml.UnsafeLoader)
+    coarse_model_data = load_model_data(coarse_run_id)
+    coarse_cfg = coarse_model_data[0]
 
     renderer = BulletBatchRenderer(coarse_cfg.urdf_ds_name, preload_cache=preload_cache, n_workers=n_workers)
-    object_ds = make_object_dataset(coarse_cfg.object_ds_name)
-    mesh_db = RigidMeshDataBase.from_object_ds(object_ds).batched().cuda()
+    mesh_db = load_mesh_db(coarse_cfg.object_ds_name, device=device)
 
-    coarse_model = load_torch_model(coarse_run_id, renderer, mesh_db, model_type='rigid')
-    refiner_model = load_torch_model(refiner_run_id, renderer, mesh_db, model_type='rigid')
+    coarse_model = load_torch_model(coarse_run_id, renderer, mesh_db, model_type='rigid', device=device, channels_last=channels_last, model_data=coarse_model_data)
+    refiner_model = load_torch_model(refiner_run_id, renderer, mesh_db, model_type='rigid', device=device, channels_last=channels_last)
 
     return RigidPosePredictor(coarse_model, refiner_model)
 
 
-def load_detector(detector_run_id):
-    detector_model = load_torch_model(detector_run_id, model_type='detector')
+def load_detector(detector_run_id, device='cuda', channels_last=False):
+    detector_model = load_torch_model(detector_run_id, model_type='detector', device=device, channels_last=channels_last)
     model = Detector(detector_model)
+    # cosypose's Detector moves its outputs to cuda
+    model.cast = lambda obj: obj.to(device)
     return model
 
 
@@ -202,6 +202,8 @@ class Pose:
         elif hasattr(tensor_or_mat, 'cpu'):
             tensor_or_mat = tensor_or_mat.cpu().numpy()
             self.update_from_mat(tensor_or_mat, flip_pos_y = flip_pos_y)
+        elif isinstance(tensor_or_mat, np.ndarray):
+            self.update_from_mat(tensor_or_mat, flip_pos_y = flip_pos_y)
         else:
             raise TypeError('Pose must be updated with a 4x4 matrix, a Pose object or a translation vector and a quaternion')
     
@@ -243,6 +245,56 @@ class Pose:
     def as_list(self):
         return self.position.as_list()+self.orientation.as_list()
     
+class PosePropagator:
+    def __init__(self, window_size = 5, max_extrapolation = 0.5) -> None:
+        '''Constant velocity pose extrapolation.
+        Linear and angular velocities are estimated from the last window_size poses, 
+        the pose is then extrapolated on SO(3) x R3 to any query timestamp, at most max_extrapolation seconds after the last pose'''
+        self.window_size = window_size
+        self.max_extrapolation = max_extrapolation
+        self.reset()
+    
+    def reset(self):
+        self.timestamps = []
+        self.positions = []
+        self.rotations = []
+        self.linear_velocity = np.zeros(3)
+        self.angular_velocity = np.zeros(3)
+    
+    def add(self, pose:'Pose', timestamp):
+        if len(self.timestamps) > 0 and timestamp <= self.timestamps[-1]:
+            return
+        self.timestamps.append(timestamp)
+        self.positions.append(pose.position.v)
+        self.rotations.append(pose.orientation.r)
+        if len(self.timestamps) > self.window_size:
+            del self.timestamps[0], self.positions[0], self.rotations[0]
+        self.estimate_velocities()
+    
+    def estimate_velocities(self):
+        if len(self.timestamps) < 2:
+            self.linear_velocity = np.zeros(3)
+            self.angular_velocity = np.zeros(3)
+            return
+        times = np.array(self.timestamps) - self.timestamps[-1]
+        # least squares slope of each coordinate
+        positions = np.vstack(self.positions)
+        times_centered = times - times.mean()
+        self.linear_velocity = times_centered @ (positions - positions.mean(axis=0)) / (times_centered @ times_centered)
+        # mean rotation rate between the oldest and the newest pose of the window, in the scene frame
+        elapsed = self.timestamps[-1] - self.timestamps[0]
+        self.angular_velocity = (self.rotations[-1] * self.rotations[0].inv()).as_rotvec() / elapsed
+    
+    def predict(self, timestamp):
+        '''Returns the 4x4 pose extrapolated at timestamp, None if no pose was added yet'''
+        if len(self.timestamps) == 0:
+            return None
+        elapsed = np.clip(timestamp - self.timestamps[-1], 0, self.max_extrapolation)
+        mat = np.identity(4)
+        mat[:3,:3] = (R.from_rotvec(self.angular_velocity*elapsed) * self.rotations[-1]).as_matrix()
+        mat[:3,3] = self.positions[-1] + self.linear_velocity*elapsed
+        return mat
+    
 class Bbox:
 
     _IMAGE_RESOLUTION = (1280, 720)
@@ -264,7 +316,9 @@ class Bbox:
         cv2.rectangle(img, self.corner1, self.corner2, self.color, self.thickness)
     
     def update_coordinates(self,tensor):
-        box = self.filter.apply(tensor.cpu().numpy())
+        if hasattr(tensor, 'cpu'):
+            tensor = tensor.cpu().numpy()
+        box = self.filter.apply(tensor)
         self.corner1 = (min(int(box[0]), self.img_resolution[0]-self.thickness), min(int(box[1]), self.img_resolution[1]-self.thickness))
         self.corner2 = (min(int(box[2]), self.img_resolution[0]-self.thickness), min(int(box[3]), self.img_resolution[1]-self.thickness))
 
@@ -458,6 +512,8 @@ class Trajectory():
             self.add(state)
         self.current_state = None
         self.current_line_index = 0
+        # columns read by the replays of the trajectory, as arrays extracted once (see get_values)
+        self.values_cache = {}
         # self.states = []
         
     @classmethod
@@ -481,17 +537,27 @@ class Trajectory():
             else:
                 new_entries = new_state.as_list(**self.attributes_dict)+[extrapolated]
                 self.data.loc[len(self.data)] = new_entries
+                self.values_cache = {}
         if self.limit_size is not None:
             if len(self.data)>self.limit_size:
                 #delete the first line
                 self.data = self.data.iloc[1:,:]
                 #reset the index
                 self.data.reset_index(drop=True, inplace=True)
+                self.values_cache = {}
             # self.states.append(new_state)
             
     def get_data(self):
         return self.data
 
+    def get_values(self, keys):
+        '''Returns the keys columns as a float array, extracted once from data and kept until a state is added,
+        so that replaying a trajectory row by row does not go through pandas at each row'''
+        keys = tuple(keys)
+        if keys not in self.values_cache:
+            self.values_cache[keys] = self.data[list(keys)].to_numpy(dtype=np.float64)
+        return self.values_cache[keys]
+
     def __iter__(self):
         self.current_line_index = 0
         return self
@@ -6,8 +6,8 @@ import torch
 import gc
 import os
 import cv2
-import tracemalloc
 import time
+import threading
 
 from i_grip import RgbdCameras as rgbd
 from i_grip import Hands3DDetectors as hd
@@ -22,8 +22,15 @@ from i_grip import Scene_refactored_multi_fullthread as sc
 from i_grip import Plotters3 as pl
 # from i_grip import Plotters_queue as pl
 from i_grip.utils import kill_gpu_processes
-from i_grip.config import _DEFAULT_YCBV_TEST_PICTURES
+from i_grip.FramePreparers import FramePreparer, writable
+from i_grip.Mailboxes import LatestValueMailbox, LatestArrayMailbox, ReadinessSignal, frame_mailbox_capacity
+from i_grip.Tracing import FrameTracer, trace_clock, merge_traces
+from i_grip.config import _DEFAULT_YCBV_TEST_PICTURES, _CAMERA_COLOR_MODE, _DEFAULT_INFERENCE_OPTIONS, _CPU_INFERENCE_OPTIONS
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+
+# period (in ms) of the display and key handling loop of the scene analysis task
+_UI_PERIOD_MS = 30
+
 def report_gpu():
    print(torch.cuda.list_gpu_processes())
    gc.collect()
@@ -31,142 +38,176 @@ def report_gpu():
    torch.cuda.empty_cache()
 
 
-def detect_hands_task( cam_data,hands, stop_event, img_depth_queue, detected_hands_queue):
+def detect_hands_task( cam_data,hands, stop_event, rgbd_frame_mailbox, detected_hands_mailbox, trace_dir = None, roi_tracking = False, async_detection = False):
+    tracer = FrameTracer('hands_detection', trace_dir)
+    if async_detection:
+        detect_hands_async(cam_data, hands, stop_event, rgbd_frame_mailbox, detected_hands_mailbox, tracer)
+        tracer.dump()
+        return
     hand_detector = hd.Hands3DDetector(cam_data, hands = hands, running_mode =
-                                            hd.Hands3DDetector.VIDEO_FILE_MODE, use_gpu=True)
+                                            hd.Hands3DDetector.VIDEO_FILE_MODE, use_gpu=True, roi_tracking=roi_tracking)
     print('detect_hands_task: started')
-    while True:
-        if stop_event.is_set():
-            break
-        print('detect_hands_task: waiting for img')
-        my_img, my_depth_map = img_depth_queue.get()
-        # print('detect_hands_task: got img')
-        # print(my_img)
-        t = time.time()
-        detected_hands = hand_detector.get_hands(my_img, my_depth_map,time.time())
-        print('detect_hands_task: updated hands')
-        print(f'detect_hands_task: {(time.time()-t)*1000:.2f} ms')
+    frame_seq = 0
+    while not stop_event.is_set():
+        frame_seq, rgbd_frame = rgbd_frame_mailbox.wait_newer(frame_seq)
+        if rgbd_frame is None:
+            continue
+        my_img, my_depth_map = rgbd_frame
+        frame_id = rgbd_frame_mailbox.last_frame_id
+        tracer.observe_frame('hands', frame_id)
+        with tracer.span('hands', frame_id):
+            detected_hands = hand_detector.get_hands(my_img, my_depth_map,time.time())
         if detected_hands is not None:
-            # print('detect_hands_task: got hands')
-            # print(detected_hands)
-            detected_hands_queue.put(detected_hands)
-            # print('detect_hands_task: sent hands')
-        if not img_depth_queue.empty():
-            img_depth_queue.get()
+            detected_hands_mailbox.put(hand_detector.get_hands_records(), frame_id=frame_id)
     hand_detector.stop()
+    tracer.dump()
 
-def detect_objects_task(dataset, cam_data, stop_event, detect_event, img_queue, detected_objects_queue):
-    object_detector = o2d.get_object_detector(dataset, cam_data)
-    while True:
-        t = time.time()
-        if stop_event.is_set():
-            break
-        detect_flag = detect_event.wait(0.5)
-        if detect_flag:
-            my_img = img_queue.get()
-            # print('detect_objects_task: got img')
-            # print(my_img.shape)
+
+def detect_hands_async(cam_data, hands, stop_event, rgbd_frame_mailbox, detected_hands_mailbox, tracer):
+    '''Feeds the newest frames to the LIVE_STREAM landmarker, whose results are published from its own thread'''
+    def publish(records, frame_id, submit_time):
+        t_enter = trace_clock() - (time.time() - submit_time)
+        detected_hands_mailbox.put(records, frame_id=frame_id)
+        tracer.record('hands', frame_id, t_enter)
+    hand_detector = hd.Hands3DDetector(cam_data, hands = hands, running_mode =
+                                            hd.Hands3DDetector.LIVE_STREAM_MODE, use_gpu=True, result_callback=publish)
+    print('detect_hands_task: started in asynchronous mode')
+    frame_seq = 0
+    while not stop_event.is_set():
+        frame_seq, rgbd_frame = rgbd_frame_mailbox.wait_newer(frame_seq)
+        if rgbd_frame is None:
+            continue
+        my_img, my_depth_map = rgbd_frame
+        frame_id = rgbd_frame_mailbox.last_frame_id
+        tracer.observe_frame('hands', frame_id)
+        hand_detector.get_hands(my_img, my_depth_map, time.time(), frame_id)
+    print(f'detect_hands_task: {hand_detector.nb_dropped_frames} frames dropped while the landmarker was busy')
+    hand_detector.stop()
+
+def detect_objects_task(dataset, cam_data, stop_event, detect_event, img_mailbox, detected_objects_mailbox, trace_dir = None, inference_options = None):
+    tracer = FrameTracer('object_detection', trace_dir)
+    object_detector = o2d.get_object_detector(dataset, cam_data, inference_options=inference_options)
+    img_seq = 0
+    while not stop_event.is_set():
+        # set again on shutdown to release the task
+        detect_event.wait()
+        img_seq, my_img = img_mailbox.wait_newer(img_seq)
+        if my_img is None:
+            continue
+        frame_id = img_mailbox.last_frame_id
+        with tracer.span('object_detection', frame_id):
             detected_objects = object_detector.detect(my_img)
-            if detected_objects is not None:
-                # print('detect_objects_task: got objects')
-                # print(detected_objects)
-                detected_objects_queue.put(detected_objects)
-                # print('detect_objects_task: sent objects')
-                detect_event.clear()
-        if not img_queue.empty():
-            img_queue.get()
-        # print('detect_objects_task: updated objects')
-        print(f'detect_objects_task: {(time.time()-t)*1000:.2f} ms')
+        if detected_objects is not None:
+            # mailboxes carry host data only
+            detected_objects_mailbox.put(o2d.detections_to_host(detected_objects), frame_id=frame_id)
+            detect_event.clear()
     object_detector.stop()
+    tracer.dump()
         
-def estimate_objects_task(dataset, cam_data, stop_event, img_queue, object_detections_queue, estimated_objects_queue):
+def estimate_objects_task(dataset, cam_data, stop_event, img_mailbox, object_detections_mailbox, estimated_objects_mailbox, hands_mailbox, trace_dir = None, inference_options = None):
+    tracer = FrameTracer('object_estimation', trace_dir)
     object_pose_estimator = ope.get_pose_estimator(dataset,
                                                         cam_data,
                                                         use_tracking = True,
-                                                        fuse_detections=False)
-    while True:
-        t = time.time()
-        if stop_event.is_set():
-            break
-        my_img = img_queue.get()
-        # print('estimate_objects_task: got img')
-        # print(my_img.shape)
-        if not object_detections_queue.empty():
-            my_object_detections = object_detections_queue.get()
-        else:
-            my_object_detections = None
-        # print('estimate_objects_task: got objects')
-        # print(my_object_detections)
-        my_estimated_objects = object_pose_estimator.estimate(my_img, detections = my_object_detections)
+                                                        fuse_detections=False,
+                                                        inference_options=inference_options)
+    img_seq = 0
+    detections_seq = 0
+    hands_seq = 0
+    hands_boxes = []
+    while not stop_event.is_set():
+        img_seq, my_img = img_mailbox.wait_newer(img_seq)
+        if my_img is None:
+            continue
+        frame_id = img_mailbox.last_frame_id
+        tracer.observe_frame('object_estimation', frame_id)
+        # each detection is used only once, then the estimator tracks the objects
+        detections_seq, my_object_detections = object_detections_mailbox.poll(detections_seq)
+        if my_object_detections is not None:
+            my_object_detections = o2d.detections_from_host(my_object_detections, object_pose_estimator.device)
+        # hands force the re-estimation of the objects they occlude
+        hands_seq, hands_records = hands_mailbox.poll(hands_seq)
+        if hands_records is not None:
+            hands_boxes = [hand.get_bbox(cam_data['resolution']) for hand in hd.HandPrediction.from_records(hands_records)]
+        with tracer.span('object_estimation', frame_id):
+            my_estimated_objects = object_pose_estimator.estimate(my_img, detections = my_object_detections, occluders = hands_boxes)
         if my_estimated_objects is not None:
-            # print('estimate_objects_task: got estimated objects')
-            # print(my_estimated_objects)
-            estimated_objects_queue.put(my_estimated_objects)
-            # print('estimate_objects_task: sent estimated objects')
-        if not img_queue.empty():
-            img_queue.get()
-        # print('estimate_objects_task: updated estimated objects')
-        print(f'estimate_objects_task: {(time.time()-t)*1000:.2f} ms')
+            estimated_objects_mailbox.put(my_estimated_objects, frame_id=frame_id)
         
     object_pose_estimator.stop()
+    tracer.dump()
         
 
-def scene_analysis_task(cam_data, stop_event, detect_event, img_queue, hands_queue, object_estimation_queue):
-    plotter = pl.NBPlot()
-    scene = sc.LiveScene(cam_data, name='Full tracking', plotter=plotter, )
-    while True:
+def scene_analysis_worker(scene, stop_event, scene_signal, img_mailbox, hands_mailbox, object_estimation_mailbox, rendered):
+    tracer = scene.tracer
+    hands_seq = 0
+    objects_seq = 0
+    img_seq = 0
+    signal_count = 0
+    while not stop_event.is_set():
+        # sleeps until any input has new data or the task is stopped
+        signal_count = scene_signal.wait(signal_count)
+        if scene_signal.is_stopped():
+            break
         # HANDS
-        t_s = time.time()
-        t = time.time()
-        if not hands_queue.empty():
-            estimated_hands = hands_queue.get()
-        else:
-            estimated_hands = None
-            # print(f'got hands')
-            # print(detected_hands)
-        if estimated_hands is not None:
-            scene.update_hands(estimated_hands)
-            print(f'scene update hands: {(time.time()-t)*1000:.2f} ms')
-                # print(f'updated hands')
+        hands_seq, hands_records = hands_mailbox.poll(hands_seq)
+        if hands_records is not None:
+            frame_id = hands_mailbox.last_frame_id
+            estimated_hands = hd.HandPrediction.from_records(hands_records)
+            with tracer.span('scene_update_hands', frame_id):
+                scene.update_hands(estimated_hands)
+            scene.frame_id = frame_id
         
         # OBJECTS
-        t = time.time()
-        estimated_objects = None
-        # print('waiting for estimated objects')
-        # print(out_object_estimation.poll())
-        if not object_estimation_queue.empty():
-            estimated_objects = object_estimation_queue.get()
-        #     print(f'got estimated objects')
-        #     print(estimated_objects)
-        # print('finished waiting for estimated objects')
+        objects_seq, estimated_objects = object_estimation_mailbox.poll(objects_seq)
         if estimated_objects is not None:
-            scene.update_objects(estimated_objects)
-            print(f'scene update objects: {(time.time()-t)*1000:.2f} ms')
-            # print(f'updated estimated objects')
+            with tracer.span('scene_update_objects', object_estimation_mailbox.last_frame_id):
+                scene.update_objects(estimated_objects)
         
         # IMAGE
-        k = cv2.waitKey(1)
-        t = time.time()
-        img = None
-        if not img_queue.empty():
-            img = img_queue.get()
-            # print(f'got img')
-            # print(img.shape)
-        print(f'get_queue time : {(time.time()-t)*1000:.2f} ms')
+        img_seq, img = img_mailbox.poll(img_seq)
+        if img is not None:
+            frame_id = img_mailbox.last_frame_id
+            tracer.observe_frame('scene_render', frame_id)
+            with tracer.span('scene_render', frame_id):
+                img = writable(img)
+                scene.render(img)
+            with rendered['lock']:
+                rendered['img'] = img
+
+def scene_analysis_task(cam_data, stop_event, detect_event, scene_signal, img_mailbox, hands_mailbox, object_estimation_mailbox, trace_dir = None):
+    plotter = pl.NBPlot()
+    tracer = FrameTracer('scene_analysis', trace_dir)
+    scene = sc.LiveScene(cam_data, name='Full tracking', plotter=plotter, tracer=tracer)
+    rendered = dict(lock=threading.Lock(), img=None)
+    t_worker = threading.Thread(target=scene_analysis_worker, 
+                                args=(scene, stop_event, scene_signal, img_mailbox, hands_mailbox, object_estimation_mailbox, rendered))
+    t_worker.start()
+    
+    # display and keys are handled at a low rate, independently of the analysis
+    window_shown = False
+    while not stop_event.is_set():
+        with rendered['lock']:
+            img = rendered['img']
+            rendered['img'] = None
         if img is not None:
-            t = time.time()
-            scene.render(img)
-            print(f'scene render: {(time.time()-t)*1000:.2f} ms')
             cv2.imshow('render_img', img)
-            print(f'updated img : {(time.time()-t)*1000:.2f} ms')
+            window_shown = True
+        if not window_shown:
+            # cv2.waitKey does not wait without a window
+            stop_event.wait(_UI_PERIOD_MS/1000)
+            continue
+        k = cv2.waitKey(_UI_PERIOD_MS)
         if k == 27:
             print('end')
             break
-        print(f'scene analysis task: {(time.time()-t_s)*1000:.2f} ms')
     stop_event.set()
+    scene_signal.stop()
+    t_worker.join()
+    tracer.dump()
         
 class GraspingDetector:
-    def __init__(self, hands, dataset, fps, images) -> None:
+    def __init__(self, hands, dataset, fps, images, trace = None, device = 'cuda', hands_roi_tracking = False, hands_async = False) -> None:
         if hands == 'both':
             self.hands = ['left', 'right']
         else:
@@ -174,37 +215,53 @@ class GraspingDetector:
         self.dataset = dataset
         self.fps = fps
         self.obj_images = images
+        # directory where the frame traces of every process are saved, no tracing if None
+        self.trace_dir = trace
+        if device == 'cpu':
+            self.inference_options = _CPU_INFERENCE_OPTIONS
+        else:
+            self.inference_options = dict(_DEFAULT_INFERENCE_OPTIONS, device=device)
+        self.hands_roi_tracking = hands_roi_tracking
+        self.hands_async = hands_async
     
     def run(self):
-        tracemalloc.start()
         multiprocessing.set_start_method('spawn', force=True)
-        rgbd_cam = rgbd.RgbdCamera(fps=self.fps)
+        rgbd_cam = rgbd.RgbdCamera(fps=self.fps, color_mode=_CAMERA_COLOR_MODE)
         cam_data = rgbd_cam.get_device_data()
+        frame_preparer = FramePreparer.from_camera(rgbd_cam)
         
         stop_event = multiprocessing.Event()
         detect_event = multiprocessing.Event()
         
         
-        queue_rgbd_frame_hands = multiprocessing.Queue(maxsize=1)
-        queue_rgb_frame_object_detection = multiprocessing.Queue(maxsize=1)
-        queue_rgb_frame_object_estimation = multiprocessing.Queue(maxsize=1)
-        queue_rgb_frame_scene_analysis = multiprocessing.Queue(maxsize=1)
+        frame_capacity = frame_mailbox_capacity(cam_data['resolution'])
+        rgbd_frame_capacity = frame_mailbox_capacity(cam_data['resolution'], with_depth=True)
+        mailbox_rgbd_frame_hands = LatestValueMailbox(rgbd_frame_capacity, name='rgbd_frame_hands')
+        mailbox_rgb_frame_object_detection = LatestValueMailbox(frame_capacity, name='rgb_frame_object_detection')
+        mailbox_rgb_frame_object_estimation = LatestValueMailbox(frame_capacity, name='rgb_frame_object_estimation')
+        mailbox_rgb_frame_scene_analysis = LatestValueMailbox(frame_capacity, name='rgb_frame_scene_analysis')
         
-        queue_hands = multiprocessing.Queue(maxsize=1)
-        queue_object_detection = multiprocessing.Queue(maxsize=1)
-        queue_object_estimation = multiprocessing.Queue(maxsize=1)
+        mailbox_hands = LatestArrayMailbox(hd.HAND_RECORD_DTYPE, len(hd.Hands3DDetector._HANDS_MODE), name='hands')
+        mailbox_object_detection = LatestValueMailbox(name='object_detection')
+        mailbox_object_estimation = LatestValueMailbox(name='object_estimation')
+        
+        # wakes the scene analysis up when any of its inputs is updated
+        scene_signal = ReadinessSignal(name='scene_analysis')
+        mailbox_rgb_frame_scene_analysis.attach(scene_signal)
+        mailbox_hands.attach(scene_signal)
+        mailbox_object_estimation.attach(scene_signal)
         
         process_hands_detection = multiprocessing.Process(target=detect_hands_task, 
-                                                          args=(cam_data, self.hands, stop_event, queue_rgbd_frame_hands, queue_hands,))
+                                                          args=(cam_data, self.hands, stop_event, mailbox_rgbd_frame_hands, mailbox_hands, self.trace_dir, self.hands_roi_tracking, self.hands_async,))
         
         process_object_detection = multiprocessing.Process(target=detect_objects_task, 
-                                                           args=(self.dataset, cam_data, stop_event, detect_event, queue_rgb_frame_object_detection, queue_object_detection,))
+                                                           args=(self.dataset, cam_data, stop_event, detect_event, mailbox_rgb_frame_object_detection, mailbox_object_detection, self.trace_dir, self.inference_options,))
         
         process_object_estimation = multiprocessing.Process(target=estimate_objects_task, 
-                                                            args=(self.dataset,cam_data, stop_event, queue_rgb_frame_object_estimation, queue_object_detection, queue_object_estimation,))
+                                                            args=(self.dataset,cam_data, stop_event, mailbox_rgb_frame_object_estimation, mailbox_object_detection, mailbox_object_estimation, mailbox_hands, self.trace_dir, self.inference_options,))
         
         process_scene_analysis = multiprocessing.Process(target=scene_analysis_task, 
-                                                        args=(cam_data, stop_event, detect_event, queue_rgb_frame_scene_analysis,queue_hands, queue_object_estimation))
+                                                        args=(cam_data, stop_event, detect_event, scene_signal, mailbox_rgb_frame_scene_analysis, mailbox_hands, mailbox_object_estimation, self.trace_dir))
         
         process_hands_detection.start()
         process_object_detection.start()
@@ -219,24 +276,16 @@ class GraspingDetector:
             obj_imgs.append(obj_img)
         
         detect_event.set()
+        tracer = FrameTracer('camera', self.trace_dir)
+        
+        mailboxes = [mailbox_rgbd_frame_hands, mailbox_rgb_frame_object_detection, mailbox_rgb_frame_object_estimation,
+                     mailbox_rgb_frame_scene_analysis, mailbox_hands, mailbox_object_detection, mailbox_object_estimation]
         
-        while rgbd_cam.is_on():
-            t = time.time()
+        while rgbd_cam.is_on() and not stop_event.is_set():
             success, img, depth_map = rgbd_cam.next_frame()
-            print(f'frame collection time : {(time.time()-t)*1000:.2f} ms')
             if not success:
                 continue
             
-            t2 = time.time()
-            
-            # HANDS
-            if not queue_rgbd_frame_hands.full():
-                img_for_hands = img.copy()
-                img_for_hands = cv2.cvtColor(img_for_hands, cv2.COLOR_RGB2BGR)
-                img_for_hands.flags.writeable = False
-                rgbd_frame = (img_for_hands, depth_map)
-                queue_rgbd_frame_hands.put(rgbd_frame)
-            
             # OBJECTS INSERTION
             for i, obj_img in enumerate(obj_imgs):
                 if i == 0:
@@ -248,42 +297,37 @@ class GraspingDetector:
                 elif i == 3:
                     img[img.shape[0]-obj_img.shape[0]:, img.shape[1]-obj_img.shape[1]:] = obj_img
             
+            # FRAME PREPARATION
+            frame_id, capture_timestamp = rgbd_cam.get_frame_info()
+            prepared_frames = frame_preparer.prepare(img)
+            
+            # HANDS
+            mailbox_rgbd_frame_hands.put((prepared_frames['hands'], depth_map), frame_id=frame_id)
+            
             # OBJECT DETECTION
             if detect_event.is_set():                
-                if not queue_rgb_frame_object_detection.full():
-                    img_for_objects = img.copy()
-                    img_for_objects = cv2.cvtColor(img_for_objects, cv2.COLOR_RGB2BGR)
-                    img_for_objects.flags.writeable = False
-                    queue_rgb_frame_object_detection.put(img_for_objects)
+                mailbox_rgb_frame_object_detection.put(prepared_frames['object_detection'], frame_id=frame_id)
 
             # OBJECT ESTIMATION
-            if not queue_rgb_frame_object_estimation.full():
-                img_for_objects = img.copy()
-                img_for_objects = cv2.cvtColor(img_for_objects, cv2.COLOR_RGB2BGR)
-                img_for_objects.flags.writeable = False
-                queue_rgb_frame_object_estimation.put(img_for_objects)
-                # print(f'updated img for objects')
+            mailbox_rgb_frame_object_estimation.put(prepared_frames['object_estimation'], frame_id=frame_id)
             
             # SCENE
-            img_for_scene = img.copy()
-            t = time.time()
-            if not queue_rgb_frame_scene_analysis.full():
-                print(f'polling time : {(time.time()-t)*1000:.2f} ms')
-                t= time.time()
-                queue_rgb_frame_scene_analysis.put( img_for_scene)
-                print(f'sending time : {(time.time()-t)*1000:.2f} ms')
-                # print(f'updated img for scene')
-            
-            print(f'frame sending time : {(time.time()-t2)*1000:.2f} ms')
-            print('-------------------')
-            current, peak = tracemalloc.get_traced_memory()
-            print(f"Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
-        tracemalloc.stop()
+            mailbox_rgb_frame_scene_analysis.put(prepared_frames['scene'], frame_id=frame_id)
+            tracer.record('capture', frame_id, capture_timestamp, trace_clock())
+        stop_event.set()
+        # wake up the tasks still waiting for data so that they see the stop event
+        detect_event.set()
+        for mailbox in mailboxes:
+            mailbox.close()
+        scene_signal.stop()
         process_hands_detection.join()
         process_object_detection.join()
         process_object_estimation.join()
         process_scene_analysis.join()
         rgbd_cam.stop()
+        if self.trace_dir is not None:
+            tracer.dump()
+            merge_traces(self.trace_dir)
         exit()
 
 
@@ -297,6 +341,10 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--fps', type=int, default=40, help="Frames per second for the camera")
     # parser.add_argument('-i', '--images', nargs='+', help="Path to the image(s) to use for object detection", default=['./YCBV_test_pictures/javel.png'])
     parser.add_argument('-i', '--images', nargs='+', help="Path to the image(s) to use for object detection", default=_DEFAULT_YCBV_TEST_PICTURES)
+    parser.add_argument('-t', '--trace', default=None, help="Directory where to save a Chrome/Perfetto trace of every frame through the pipeline")
+    parser.add_argument('-dev', '--device', choices=['cuda', 'cpu'], default='cuda', help="Device running object detection and pose estimation")
+    parser.add_argument('-roi', '--hands_roi_tracking', action='store_true', help="Track the hands in crops around their previous position, instead of processing the full image every frame")
+    parser.add_argument('-as', '--hands_async', action='store_true', help="Run the hands detection asynchronously, dropping the frames arriving while it is busy")
     args = vars(parser.parse_args())
 
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'